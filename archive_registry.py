@@ -0,0 +1,313 @@
+import hashlib
+import os
+import re
+import threading
+import zipfile
+from collections import defaultdict
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Set, Union
+
+from json_store import read_json, write_json
+from log_setup import log
+
+CHUNK_SIZE = 1024 * 1024
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".webp"]
+INVALID_FILENAME_CHARS_PATTERN = re.compile(r'[:<>|"?*]')
+SKIP_DUPLICATE_ARCHIVES = os.getenv("SKIP_DUPLICATE_ARCHIVES", "true").lower() == "true"
+LINK_DUPLICATE_PAGES = os.getenv("LINK_DUPLICATE_PAGES", "true").lower() == "true"
+
+data_dir = Path.cwd() / "data"
+archive_hashes_json = Path.cwd() / "archive_hashes.json"
+
+# archives: archive hash -> extracted entry path, pages: page hash -> page path,
+# both relative to data_dir. only the first path seen for some content is kept,
+# every later copy of it gets hard-linked to that one and listed in duplicates:
+# page path -> page hash. pages of entries stored as cbz are paths below their
+# archive and only get listed. skipped: url -> entry path of the archive it duplicated
+registry_data: Dict[str, Dict[str, str]] = {
+    "archives": {},
+    "pages": {},
+    "duplicates": {},
+    "skipped": {},
+}
+registry_data.update(read_json(archive_hashes_json, {}))
+page_hashes_by_path = {
+    **{path: h for h, path in registry_data["pages"].items()},
+    **registry_data["duplicates"],
+}
+archive_hashes_by_path = {path: h for h, path in registry_data["archives"].items()}
+registry_dirty = False
+# mtime of archive_hashes.json as last read or written here
+registry_mtime = (
+    archive_hashes_json.stat().st_mtime_ns if archive_hashes_json.exists() else None
+)
+reclaimed_bytes = 0
+# held by every change to the registry, the cbz index or index.json, which the
+# extract and metadata threads of pipeline.py both make
+state_lock = threading.RLock()
+
+
+def locked(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with state_lock:
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_file(path: Path) -> str:
+    hasher = new_hasher()
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def relative_path(path: Path) -> str:
+    return path.relative_to(data_dir).as_posix()
+
+
+def get_entry_key(path: str) -> str:
+    """ "artist/entry" of a registered path, renames never cross it"""
+    return "/".join(path.split("/")[:2])
+
+
+# entry key -> registered page paths below it, so renames only look at one entry
+page_paths_by_entry: Dict[str, Set[str]] = defaultdict(set)
+for page_path in page_hashes_by_path.keys():
+    page_paths_by_entry[get_entry_key(page_path)].add(page_path)
+
+
+@locked
+def reload_registry():
+    """reads archive_hashes.json again when another process wrote it since, in
+    place so modules holding the registry see it. skipped while changes are unsaved"""
+    global registry_mtime
+    if registry_dirty or not archive_hashes_json.exists():
+        return
+    mtime = archive_hashes_json.stat().st_mtime_ns
+    if mtime == registry_mtime:
+        return
+    loaded = read_json(archive_hashes_json, {})
+    for section in registry_data.keys():
+        registry_data[section] = loaded.get(section, {})
+    page_hashes_by_path.clear()
+    page_hashes_by_path.update({path: h for h, path in registry_data["pages"].items()})
+    page_hashes_by_path.update(registry_data["duplicates"])
+    archive_hashes_by_path.clear()
+    archive_hashes_by_path.update(
+        {path: h for h, path in registry_data["archives"].items()}
+    )
+    page_paths_by_entry.clear()
+    for page_path in page_hashes_by_path.keys():
+        page_paths_by_entry[get_entry_key(page_path)].add(page_path)
+    registry_mtime = mtime
+
+
+def add_page_path(page_path: str, page_hash: str):
+    page_hashes_by_path[page_path] = page_hash
+    page_paths_by_entry[get_entry_key(page_path)].add(page_path)
+
+
+def remove_page_path(page_path: str) -> Union[str, None]:
+    page_paths_by_entry[get_entry_key(page_path)].discard(page_path)
+    return page_hashes_by_path.pop(page_path, None)
+
+
+def find_duplicate_archive(archive_hash: str) -> Union[str, None]:
+    entry = registry_data["archives"].get(archive_hash)
+    if entry and (data_dir / entry).exists():
+        return entry
+    return None
+
+
+@locked
+def register_archive(archive_hash: str, entry_path: Path):
+    global registry_dirty
+    archive_hashes_by_path.pop(registry_data["archives"].get(archive_hash, ""), None)
+    registry_data["archives"][archive_hash] = relative_path(entry_path)
+    archive_hashes_by_path[relative_path(entry_path)] = archive_hash
+    registry_dirty = True
+
+
+@locked
+def register_skipped(url: str, duplicate: str):
+    """remembers that the archive of url wasn't extracted for being a duplicate"""
+    global registry_dirty
+    registry_data["skipped"][url] = duplicate
+    registry_dirty = True
+
+
+def get_skipped(url: str) -> Union[str, None]:
+    """entry path the archive of url duplicated, while that entry still exists"""
+    duplicate = registry_data["skipped"].get(url)
+    if duplicate and (data_dir / duplicate).exists():
+        return duplicate
+    return None
+
+
+def is_archive_member(page: Path) -> bool:
+    return any(parent.suffix == ".cbz" and parent.is_file() for parent in page.parents)
+
+
+def page_exists(page: Path) -> bool:
+    return page.exists() or is_archive_member(page)
+
+
+@locked
+def register_page(page: Path, page_hash: str):
+    global registry_dirty
+    global reclaimed_bytes
+    page_path = relative_path(page)
+    known_path = registry_data["pages"].get(page_hash)
+    if known_path and known_path != page_path and page_exists(data_dir / known_path):
+        known_page = data_dir / known_path
+        if (
+            LINK_DUPLICATE_PAGES
+            and not is_archive_member(page)
+            and not is_archive_member(known_page)
+            and not known_page.samefile(page)
+        ):
+            size = page.stat().st_size
+            link_path = page.with_name(f"{page.name}.link")
+            try:
+                os.link(known_page, link_path)
+                os.replace(link_path, page)
+                reclaimed_bytes += size
+                log.debug(f"hard-linked {page_path} to identical {known_path}")
+            except OSError as err:
+                link_path.unlink(missing_ok=True)
+                log.debug(f"could not hard-link {page_path}: {err}")
+        registry_data["duplicates"][page_path] = page_hash
+        add_page_path(page_path, page_hash)
+        registry_dirty = True
+        return
+    registry_data["pages"][page_hash] = page_path
+    add_page_path(page_path, page_hash)
+    registry_dirty = True
+
+
+@locked
+def rename_registered_path(source: Path, dest: Path):
+    """keeps the registry in sync when a page or a whole entry directory is renamed"""
+    global registry_dirty
+    source_path = relative_path(source)
+    dest_path = relative_path(dest)
+    prefix = f"{source_path}/"
+    for page_path in [
+        page_path
+        for page_path in page_paths_by_entry.get(get_entry_key(source_path), [])
+        if page_path == source_path or page_path.startswith(prefix)
+    ]:
+        page_hash = remove_page_path(page_path)
+        new_page_path = f"{dest_path}{page_path[len(source_path):]}"
+        if registry_data["duplicates"].pop(page_path, None):
+            registry_data["duplicates"][new_page_path] = page_hash
+        else:
+            registry_data["pages"][page_hash] = new_page_path
+        add_page_path(new_page_path, page_hash)
+        registry_dirty = True
+    if archive_hash := archive_hashes_by_path.pop(source_path, None):
+        registry_data["archives"][archive_hash] = dest_path
+        archive_hashes_by_path[dest_path] = archive_hash
+        registry_dirty = True
+    if source_path != get_entry_key(source_path):
+        return
+    for url, duplicate in registry_data["skipped"].items():
+        if duplicate == source_path:
+            registry_data["skipped"][url] = dest_path
+            registry_dirty = True
+
+
+@locked
+def update_page_hash(page: Path, new_page: Path):
+    """re-registers a page whose content was rewritten, possibly under a new name"""
+    global registry_dirty
+    page_hash = remove_page_path(relative_path(page))
+    if page_hash and registry_data["pages"].get(page_hash) == relative_path(page):
+        del registry_data["pages"][page_hash]
+        registry_dirty = True
+    if registry_data["duplicates"].pop(relative_path(page), None):
+        registry_dirty = True
+    register_page(new_page, hash_file(new_page))
+
+
+def get_member_parts(filename: str) -> List[str]:
+    """path parts of an archive member that are safe to create below an entry"""
+    return [
+        INVALID_FILENAME_CHARS_PATTERN.sub("_", part).rstrip(".")
+        for part in filename.replace("\\", "/").split("/")
+        if part not in ["", ".", ".."]
+    ]
+
+
+def extract_archive(archive: Path, dest: Path):
+    """extracts an archive, hashing every page while it is being written"""
+    with zipfile.ZipFile(archive, "r") as zip:
+        for member in zip.infolist():
+            parts = get_member_parts(member.filename)
+            if not parts:
+                continue
+            target = dest.joinpath(*parts)
+            if member.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            hasher = new_hasher()
+            with zip.open(member) as src, target.open("wb") as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    dst.write(chunk)
+            if target.suffix.lower() in IMAGE_SUFFIXES:
+                register_page(target, hasher.hexdigest())
+
+
+@locked
+def save_registry():
+    global registry_dirty, registry_mtime
+    if not registry_dirty:
+        return
+    write_json(archive_hashes_json, registry_data, sort_keys=True)
+    registry_mtime = archive_hashes_json.stat().st_mtime_ns
+    registry_dirty = False
+    if reclaimed_bytes:
+        log.info(
+            f"reclaimed {reclaimed_bytes / 1024 / 1024:.1f} MiB of duplicate pages"
+        )
+
+
+def register_library():
+    log.info("========== hashing library pages ==========")
+    for artist in data_dir.iterdir():
+        for page in sorted(
+            page
+            for page in artist.glob("**/*")
+            if page.suffix.lower() in IMAGE_SUFFIXES
+            and relative_path(page) not in page_hashes_by_path
+        ):
+            register_page(page, hash_file(page))
+        for archive in sorted(artist.glob("*.cbz")):
+            with zipfile.ZipFile(archive, "r") as zip:
+                for member in zip.infolist():
+                    page = archive / member.filename
+                    if (
+                        page.suffix.lower() not in IMAGE_SUFFIXES
+                        or relative_path(page) in page_hashes_by_path
+                    ):
+                        continue
+                    hasher = new_hasher()
+                    with zip.open(member) as src:
+                        while chunk := src.read(CHUNK_SIZE):
+                            hasher.update(chunk)
+                    register_page(page, hasher.hexdigest())
+    save_registry()
+
+
+if __name__ == "__main__":
+    register_library()
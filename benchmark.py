@@ -0,0 +1,379 @@
+import io
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from PIL import Image
+
+import fixture_site
+import replay_server
+from json_store import read_json, write_json
+from log_setup import log
+
+BENCH_ARTISTS = int(os.getenv("BENCH_ARTISTS", 20))
+BENCH_ENTRIES = int(os.getenv("BENCH_ENTRIES", 10))
+BENCH_PAGES = int(os.getenv("BENCH_PAGES", 30))
+# share of the entries that are still cbz archives in downloaded/
+BENCH_NEW_SHARE = float(os.getenv("BENCH_NEW_SHARE", 0.3))
+BENCH_MULTI_SHARE = float(os.getenv("BENCH_MULTI_SHARE", 0.1))
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", 3))
+BENCH_SEED = int(os.getenv("BENCH_SEED", 0))
+# a stage is a regression when it's this much slower than the baseline...
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", 0.2))
+# ...and at least this many seconds, so tiny stages don't flap
+BENCH_MIN_DELTA = float(os.getenv("BENCH_MIN_DELTA", 0.05))
+BENCH_UPDATE_BASELINE = os.getenv("BENCH_UPDATE_BASELINE", "false").lower() == "true"
+
+repo_dir = Path(__file__).resolve().parent
+bench_baseline_json = Path.cwd() / "bench_baseline.json"
+
+# every filename style clean_filenames knows, page number -> file stem
+PAGE_STYLES: Dict[str, Callable[[int], str]] = {
+    "standard": lambda n: f"{n}",
+    "fakku": lambda n: f"p{n:03}",
+    "underscores": lambda n: f"book_{n:03}_x3200",
+    "million_zeros": lambda n: f"book-{n:06}",
+    "irodori": lambda n: f"Page_{n}_Image_0001",
+    "irodori_index": lambda n: f"index-{n}_1",
+    "wtf_is_that": lambda n: f"book_3200x_{n:03}",
+}
+
+# name -> (script arguments, extra environment, page styles, scripts run untimed
+# before it). "{replay}" and "{fixture}" in the environment are the urls of
+# replay_server.py and fixture_site.py. legacy/refresh_index.py predates irodori_index
+SCENARIOS: Dict[str, Tuple[List[str], Dict[str, str], List[str], List[List[str]]]] = {
+    "process_downloaded": (
+        [str(repo_dir / "process_downloaded.py")],
+        {},
+        list(PAGE_STYLES.keys()),
+        [],
+    ),
+    "process_downloaded_cbz": (
+        [str(repo_dir / "process_downloaded.py")],
+        {"STORAGE_MODE": "cbz"},
+        list(PAGE_STYLES.keys()),
+        [],
+    ),
+    "refresh_index": (
+        ["-m", "legacy.refresh_index"],
+        {},
+        [style for style in PAGE_STYLES.keys() if style != "irodori_index"],
+        [],
+    ),
+    "fetch_metadata": (
+        [str(repo_dir / "fetch_metadata.py")],
+        {
+            "F_BASE_URL": "{replay}/f",
+            "I_BASE_URL": "{replay}/i",
+            "FETCH_BACKOFF": "0.1",
+        },
+        list(PAGE_STYLES.keys()),
+        [[str(repo_dir / "process_downloaded.py")]],
+    ),
+    "fetch_favorited_links": (
+        [str(repo_dir / "fetch_favorited_links.py")],
+        {"BASE_URL": "{fixture}", "IGNORE_ALREADY_PROCESSED": "false"},
+        list(PAGE_STYLES.keys()),
+        [],
+    ),
+    "download_all_favorites": (
+        [str(repo_dir / "download_all_favorites.py")],
+        {"BASE_URL": "{fixture}", "SET_DOWNLOAD_DIR": "true"},
+        list(PAGE_STYLES.keys()),
+        [[str(repo_dir / "fetch_favorited_links.py")]],
+    ),
+}
+# the browser scenarios need chrome, so they only run when asked for
+BROWSER_SCENARIOS = ["fetch_favorited_links", "download_all_favorites"]
+
+
+def get_page_templates() -> Dict[str, bytes]:
+    templates = {}
+    for suffix, format in [(".jpg", "JPEG"), (".png", "PNG")]:
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 90), (200, 200, 200)).save(buffer, format=format)
+        templates[suffix] = buffer.getvalue()
+    return templates
+
+
+def get_pages(
+    rng: random.Random, style: str, templates: Dict[str, bytes], salt: str
+) -> Dict[str, bytes]:
+    """trailing bytes after the image data keep every page unique for the registry"""
+    suffix = rng.choice([".jpg", ".jpg", ".png"])
+    return {
+        f"{PAGE_STYLES[style](n)}{suffix}": templates[suffix]
+        + f"{salt}/{n}".encode("utf-8")
+        for n in range(1, BENCH_PAGES + 1)
+    }
+
+
+def generate_library(root: Path, styles: List[str]):
+    """data/, downloaded/ and the state files for a made up collection, the same one
+    for the same BENCH_* settings"""
+    rng = random.Random(BENCH_SEED)
+    templates = get_page_templates()
+    (root / "data").mkdir()
+    (root / "downloaded").mkdir()
+    index_data: Dict[str, Dict[str, str]] = {}
+    downloaded_data: Dict[str, str] = {}
+    multi_entries: List[str] = []
+
+    for a in range(BENCH_ARTISTS):
+        artist = f"Artist {a:03}"
+        index_data[artist] = {}
+        for e in range(BENCH_ENTRIES):
+            title = f"Title {a:03}-{e:03}"
+            url = f"https://example.org/g/{a * BENCH_ENTRIES + e}/{rng.getrandbits(48):012x}"
+            download_name = f"[{artist}] {title} {{tag {e}}}"
+            index_data[artist][title] = url
+            downloaded_data[url] = download_name
+            style = styles[(a * BENCH_ENTRIES + e) % len(styles)]
+            is_multi = rng.random() < BENCH_MULTI_SHARE
+            if is_multi:
+                multi_entries.append(str(Path(artist) / title))
+            pages: Dict[str, bytes] = {}
+            for volume in [f"Vol {v}/" for v in [1, 2]] if is_multi else [""]:
+                for name, data in get_pages(
+                    rng, style, templates, url + volume
+                ).items():
+                    pages[f"{volume}{name}"] = data
+
+            if rng.random() < BENCH_NEW_SHARE:
+                with zipfile.ZipFile(
+                    root / "downloaded" / f"{download_name}.cbz",
+                    "w",
+                    zipfile.ZIP_DEFLATED,
+                ) as zip:
+                    for name, data in pages.items():
+                        zip.writestr(name, data)
+                continue
+            entry_path = root / "data" / artist / title
+            for name, data in pages.items():
+                (entry_path / name).parent.mkdir(parents=True, exist_ok=True)
+                (entry_path / name).write_bytes(data)
+
+    write_json(root / "index.json", index_data, sort_keys=True)
+    write_json(root / "downloaded.json", downloaded_data, sort_by_value=True)
+    write_json(root / "multi_entries.json", sorted(multi_entries))
+    write_json(root / "original_sources.json", {})
+    write_json(root / "fallback_metadata.json", {})
+    write_json(root / "favorited.json", {})
+    (root / "f_cookies.txt").write_text("session=benchmark")
+    (root / "a_cookies.txt").write_text("session=benchmark")
+
+
+def run_script(
+    args: List[str], env: Dict[str, str], cwd: Path
+) -> Tuple[float, Union[int, None]]:
+    """(seconds, peak rss in KiB), the rss is only known where os.wait4 exists"""
+    started = perf_counter()
+    # a file instead of a pipe, a chatty script would block on a full pipe while we
+    # wait for it to exit
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            [sys.executable, *args],
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr_file,
+        )
+        if hasattr(os, "wait4"):
+            _pid, status, rusage = os.wait4(process.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+            process.returncode = returncode
+            peak_rss = rusage.ru_maxrss
+        else:
+            returncode = process.wait()
+            peak_rss = None
+        elapsed = perf_counter() - started
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", "replace")
+            raise Exception(f"{' '.join(args)} failed with {returncode}:\n{stderr}")
+    return elapsed, peak_rss
+
+
+def run_scenario(name: str, template: Path, urls: Dict[str, str]) -> Dict[str, Any]:
+    args, extra_env, _styles, setup = SCENARIOS[name]
+    samples: Dict[str, List[float]] = {}
+    rates: Dict[str, List[float]] = {}
+    peak_rss: List[int] = []
+    for repeat in range(BENCH_REPEAT):
+        with tempfile.TemporaryDirectory(prefix="bench-") as tmp_dir:
+            cwd = Path(tmp_dir) / "library"
+            shutil.copytree(template, cwd)
+            env = {
+                **os.environ,
+                **{key: value.format(**urls) for key, value in extra_env.items()},
+                "PYTHONPATH": str(repo_dir),
+                "METRICS_SUMMARY": "false",
+            }
+            for setup_args in setup:
+                run_script(setup_args, env, cwd)
+            metrics_json = Path(tmp_dir) / "metrics.json"
+            elapsed, rss = run_script(
+                args, {**env, "METRICS_JSON": str(metrics_json)}, cwd
+            )
+            samples.setdefault("total", []).append(elapsed)
+            if rss is not None:
+                peak_rss.append(rss)
+            if metrics_json.exists():
+                metrics = read_json(metrics_json)
+                # hosts are dropped, the servers get a new port every run
+                for key, histogram in metrics["histograms"].items():
+                    stage = key.split("{")[0]
+                    samples.setdefault(stage, []).append(histogram["sum"])
+                    if histogram["count"] > 1:
+                        samples.setdefault(f"{stage} p50", []).append(histogram["p50"])
+                        samples.setdefault(f"{stage} p99", []).append(histogram["p99"])
+                for key, counter in metrics["counters"].items():
+                    if "per_second" in counter:
+                        rates.setdefault(key.split("{")[0], []).append(
+                            counter["per_second"]
+                        )
+        log.info(f"{name} run {repeat + 1}/{BENCH_REPEAT}: {elapsed:.2f}s")
+    return {
+        "stages": {
+            stage: statistics.median(values) for stage, values in samples.items()
+        },
+        "rates": {rate: statistics.median(values) for rate, values in rates.items()},
+        "peak_rss_kib": max(peak_rss) if peak_rss else None,
+    }
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any]) -> List[str]:
+    regressions = []
+    if baseline.get("settings") != get_settings():
+        log.warning("baseline was recorded with different BENCH_* settings")
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for stage, seconds in result["stages"].items():
+            base_seconds = base["stages"].get(stage)
+            if base_seconds is None:
+                continue
+            change = (seconds - base_seconds) / base_seconds if base_seconds else 0
+            log.info(
+                f"{name} {stage}: {seconds:.3f}s vs {base_seconds:.3f}s ({change:+.0%})"
+            )
+            if (
+                seconds > base_seconds * (1 + BENCH_TOLERANCE)
+                and seconds - base_seconds > BENCH_MIN_DELTA
+            ):
+                regressions.append(f"{name} {stage}")
+        for rate, per_second in result["rates"].items():
+            base_per_second = base.get("rates", {}).get(rate)
+            if not base_per_second:
+                continue
+            log.info(
+                f"{name} {rate}: {per_second:.1f}/s vs {base_per_second:.1f}/s "
+                f"({per_second / base_per_second - 1:+.0%})"
+            )
+            if per_second < base_per_second * (1 - BENCH_TOLERANCE):
+                regressions.append(f"{name} {rate}")
+        if result["peak_rss_kib"] and base.get("peak_rss_kib"):
+            log.info(
+                f"{name} peak rss: {result['peak_rss_kib'] / 1024:.1f} MiB vs "
+                f"{base['peak_rss_kib'] / 1024:.1f} MiB"
+            )
+            if result["peak_rss_kib"] > base["peak_rss_kib"] * (1 + BENCH_TOLERANCE):
+                regressions.append(f"{name} peak rss")
+    return regressions
+
+
+def get_settings() -> Dict[str, Union[int, float]]:
+    return {
+        "artists": BENCH_ARTISTS,
+        "entries": BENCH_ENTRIES,
+        "pages": BENCH_PAGES,
+        "new_share": BENCH_NEW_SHARE,
+        "multi_share": BENCH_MULTI_SHARE,
+        "seed": BENCH_SEED,
+    }
+
+
+def benchmark():
+    log.info("========== benchmarking ==========")
+    scenarios = [
+        name
+        for name in os.getenv(
+            "BENCH_SCENARIOS",
+            ",".join(
+                name for name in SCENARIOS.keys() if name not in BROWSER_SCENARIOS
+            ),
+        ).split(",")
+        if name
+    ]
+    results: Dict[str, Dict[str, Any]] = {}
+    # "replay"/"fixture" -> server, started for the first scenario needing it
+    servers: Dict[str, ThreadingHTTPServer] = {}
+    with tempfile.TemporaryDirectory(prefix="bench-template-") as tmp_dir:
+        # one generated library per set of page styles, shared by the scenarios using it
+        templates: Dict[Tuple[str, ...], Path] = {}
+        for name in scenarios:
+            styles = tuple(SCENARIOS[name][2])
+            if styles not in templates:
+                template = Path(tmp_dir) / f"library-{len(templates)}"
+                template.mkdir()
+                started = perf_counter()
+                generate_library(template, list(styles))
+                log.info(
+                    f"generated {BENCH_ARTISTS * BENCH_ENTRIES} entries in "
+                    f"{perf_counter() - started:.1f}s"
+                )
+                templates[styles] = template
+            env_values = "".join(SCENARIOS[name][1].values())
+            if "{replay}" in env_values:
+                replay_server.load_catalog(templates[styles] / "index.json")
+            for kind, module in [("replay", replay_server), ("fixture", fixture_site)]:
+                if f"{{{kind}}}" in env_values and kind not in servers:
+                    servers[kind] = module.make_server(port=0)
+                    threading.Thread(
+                        target=servers[kind].serve_forever, daemon=True
+                    ).start()
+            urls = {
+                kind: "http://{}:{}".format(*server.server_address[:2])
+                for kind, server in servers.items()
+            }
+            results[name] = run_scenario(name, templates[styles], urls)
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+    for name, result in results.items():
+        for stage, seconds in result["stages"].items():
+            log.info(f"{name} {stage}: {seconds:.3f}s")
+        for rate, per_second in result["rates"].items():
+            log.info(f"{name} {rate}: {per_second:.1f}/s")
+        if result["peak_rss_kib"]:
+            log.info(f"{name} peak rss: {result['peak_rss_kib'] / 1024:.1f} MiB")
+
+    if BENCH_UPDATE_BASELINE or not bench_baseline_json.exists():
+        write_json(
+            bench_baseline_json,
+            {"settings": get_settings(), "scenarios": results},
+            sort_keys=True,
+        )
+        log.info(f"wrote baseline to {bench_baseline_json}")
+        return
+    regressions = compare(results, read_json(bench_baseline_json))
+    if regressions:
+        log.error(f"regressions: {', '.join(regressions)}")
+        sys.exit(1)
+    log.info("no regressions")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,9 +1,13 @@
+import atexit
+import collections
 import logging
 import os
 import sys
+from contextlib import contextmanager
 from pathlib import Path
-from time import sleep
-from typing import Any, Callable, Tuple, Union
+from time import perf_counter, sleep
+from typing import Any, Callable, Deque, Dict, Iterator, List, Tuple, Union
+from urllib.parse import urlparse
 
 from monkey_patches import patch_undetected_chromedriver
 
@@ -11,13 +15,14 @@ patch_undetected_chromedriver()
 
 import undetected_chromedriver as uc
 from dotenv import load_dotenv
+from selenium import webdriver
 from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 
-from log_setup import log
+from log_setup import get_host, log, observe
 
 load_dotenv()
 
@@ -29,11 +34,93 @@ CAPTCHA = os.getenv("CAPTCHA", "false").lower() == "true"
 if CAPTCHA:
     HEADLESS = False
 
+DEBUGGER_ADDRESS = os.getenv("DEBUGGER_ADDRESS")
+POLL_FREQUENCY = float(os.getenv("POLL_FREQUENCY", 0.1))
+MIN_TIMEOUT = float(os.getenv("MIN_TIMEOUT", 1))
+# least time an action like a download click gets to take effect before it's repeated
+RETRIGGER_TIMEOUT = float(os.getenv("RETRIGGER_TIMEOUT", 1))
+MIN_WAIT_SAMPLES = 5
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "true").lower() == "true"
+# tells chrome to save downloads into downloaded/ instead of its own download folder
+SET_DOWNLOAD_DIR = os.getenv("SET_DOWNLOAD_DIR", "false").lower() == "true"
+
+IMAGE_URL_PATTERNS = ["*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.avif*"]
+FONT_URL_PATTERNS = ["*.woff*", "*.ttf*", "*.otf*"]
+MEDIA_URL_PATTERNS = ["*.mp4*", "*.webm*", "*.mp3*", "*.ogg*"]
+THIRD_PARTY_SCRIPT_URL_PATTERNS = [
+    "*googletagmanager.com*",
+    "*google-analytics.com*",
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*cloudflareinsights.com*",
+]
+# what each kind of page doesn't need to load; the captcha needs its images and scripts
+BLOCK_PROFILES = {
+    "listing": [
+        *IMAGE_URL_PATTERNS,
+        *FONT_URL_PATTERNS,
+        *MEDIA_URL_PATTERNS,
+        *THIRD_PARTY_SCRIPT_URL_PATTERNS,
+    ],
+    "gallery": [
+        *FONT_URL_PATTERNS,
+        *MEDIA_URL_PATTERNS,
+        *([] if CAPTCHA else [*IMAGE_URL_PATTERNS, *THIRD_PARTY_SCRIPT_URL_PATTERNS]),
+    ],
+    "none": [],
+}
+# reads fields of every element matching a selector in one round-trip; fields map
+# a name to [sub-selector ("" for the element itself), property, all matches?]
+EXTRACT_ELEMENTS_SCRIPT = """
+const [selector, fields] = arguments;
+// not chrome's full accessible name computation, fetch_favorited_links.check_names()
+// compares the two and falls back to WebElement.accessible_name when they disagree
+const accessibleName = (el) =>
+  (
+    el.getAttribute("aria-label") ||
+    el.innerText ||
+    el.querySelector("img")?.alt ||
+    el.title ||
+    ""
+  )
+    .replace(/\s+/g, " ")
+    .trim();
+const read = (el, property) => {
+  if (property === "name") return accessibleName(el);
+  if (property === "text") return el.innerText.trim();
+  if (property === "href") return el.href;
+  return el.getAttribute(property);
+};
+return Array.from(document.querySelectorAll(selector)).map((root) => {
+  const item = {};
+  for (const [name, [subSelector, property, many]] of Object.entries(fields)) {
+    const targets = subSelector
+      ? Array.from(root.querySelectorAll(subSelector))
+      : [root];
+    const values = targets.map((el) => read(el, property));
+    item[name] = many ? values : values.length ? values[0] : null;
+  }
+  return item;
+});
+"""
+
 cookies_txt = Path.cwd() / "a_cookies.txt"
+download_dir = Path.cwd() / "downloaded"
+
+_browser: Union[webdriver.Chrome, None] = None
+cookies_set = False
+current_block_profile: Union[str, None] = None
+# per selector / page type, used to derive the next deadline
+wait_latencies: Dict[str, Deque[float]] = collections.defaultdict(
+    lambda: collections.deque(maxlen=200)
+)
+wait_timeouts: Dict[str, int] = collections.Counter()
 
-with cookies_txt.open("r") as f:
-    cookies_str = f.read()
-    cookie_dicts = [
+
+def read_cookie_dicts() -> List[Dict[str, str]]:
+    with cookies_txt.open("r") as f:
+        cookies_str = f.read()
+    return [
         {
             "name": cookie.split("=")[0],
             "value": cookie.split("=")[1],
@@ -44,71 +131,193 @@ with cookies_txt.open("r") as f:
 
 def program_exit():
     log.warning("Program exit.")
-    if browser:
-        browser.quit()
+    close_browser()
     exit()
 
 
-def init_browser():
-    options = uc.ChromeOptions()
-    options.add_argument("--disable-web-security")
-    new_browser = uc.Chrome(
-        user_data_dir=BROWSER_DATA_DIR,
-        headless=HEADLESS,
-        options=options,
-        patcher_force_close=True,
-        enable_cdp_events=True,
-        version_main=121,
-    )
+def init_browser() -> webdriver.Chrome:
+    if DEBUGGER_ADDRESS:
+        # warm reuse: attach to a chrome started with --remote-debugging-port
+        log.info(f"attaching to running browser at {DEBUGGER_ADDRESS}")
+        options = webdriver.ChromeOptions()
+        options.debugger_address = DEBUGGER_ADDRESS
+        new_browser = webdriver.Chrome(options=options)
+    else:
+        log.info("starting browser")
+        options = uc.ChromeOptions()
+        options.add_argument("--disable-web-security")
+        new_browser = uc.Chrome(
+            user_data_dir=BROWSER_DATA_DIR,
+            headless=HEADLESS,
+            options=options,
+            patcher_force_close=True,
+            enable_cdp_events=True,
+            version_main=121,
+        )
     new_browser.set_script_timeout(TIMEOUT)
     new_browser.set_page_load_timeout(TIMEOUT)
+    if SET_DOWNLOAD_DIR:
+        download_dir.mkdir(exist_ok=True)
+        new_browser.execute_cdp_cmd(
+            "Browser.setDownloadBehavior",
+            {"behavior": "allow", "downloadPath": str(download_dir.resolve())},
+        )
     return new_browser
 
 
-browser = init_browser()
+def get_browser() -> webdriver.Chrome:
+    global _browser
+    if not _browser:
+        _browser = init_browser()
+    return _browser
+
+
+def close_browser():
+    global _browser
+    global cookies_set
+    global current_block_profile
+    if _browser:
+        # quitting an attached session only ends the chromedriver session, chrome keeps running
+        _browser.quit()
+        _browser = None
+        cookies_set = False
+        current_block_profile = None
+
+
+def block_resources(profile: str):
+    """blocks requests matching BLOCK_PROFILES[profile] in the current tab, via CDP"""
+    global current_block_profile
+    if not BLOCK_RESOURCES or profile == current_block_profile:
+        return
+    browser = get_browser()
+    browser.execute_cdp_cmd("Network.enable", {})
+    browser.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCK_PROFILES[profile]})
+    log.debug(f"blocking resources for {profile} pages")
+    current_block_profile = profile
 
 
-def get_url(url):
+@contextmanager
+def browser_session() -> Iterator[webdriver.Chrome]:
+    try:
+        yield get_browser()
+    finally:
+        log_wait_stats()
+        close_browser()
+
+
+class LazyBrowser:
+    """stands in for the browser so importing this module doesn't start chrome"""
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_browser(), name)
+
+
+browser = LazyBrowser()
+atexit.register(close_browser)
+
+
+def get_url(url, block_profile: Union[str, None] = None):
+    browser = get_browser()
+    if not cookies_set:
+        set_cookies(browser)
+    if block_profile:
+        block_resources(block_profile)
     log.debug(f"fetching url: {url}")
+    key = get_page_type(url)
     tried = 0
-    timeout = TIMEOUT
+    timeout = get_adaptive_timeout(key)
+    started = perf_counter()
     while True:
         try:
+            # only page loads adapt, scripts keep the TIMEOUT set in get_browser
+            browser.set_page_load_timeout(timeout)
             browser.get(url)
+            record_wait(key, perf_counter() - started)
+            observe("page_load", perf_counter() - started, get_host(url))
             break
         except TimeoutException as err:
             log.info("Error: timed out waiting for page to load.")
+            wait_timeouts[key] += 1
             if tried > 3:
                 log.info(err.msg)
                 log.info(f"Connection timeout: {url}")
                 program_exit()
             tried += 1
-            timeout *= 1.5
-            browser.set_script_timeout(timeout)
-            browser.set_page_load_timeout(timeout)
+            timeout = max(timeout * 1.5, TIMEOUT)
             sleep(0.1)
 
 
+def get_page_type(url: str) -> str:
+    path = urlparse(url).path.strip("/")
+    return f"page:{urlparse(url).scheme}:{path.split('/')[0] if path else ''}"
+
+
+def get_adaptive_timeout(
+    key: str, minimum: float = MIN_TIMEOUT, maximum: float = TIMEOUT
+) -> float:
+    """p95 of what this wait took so far, with some headroom"""
+    latencies = sorted(wait_latencies[key])
+    if len(latencies) < MIN_WAIT_SAMPLES:
+        return maximum
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return min(max(p95 * 2, minimum), maximum)
+
+
+def record_wait(key: str, elapsed: float):
+    wait_latencies[key].append(elapsed)
+    log.debug(f"waited {elapsed:.2f}s for {key}")
+
+
+def log_wait_stats():
+    if not wait_latencies:
+        return
+    log.info("wait timings (count, timeouts, p50, p95, max):")
+    for key, latencies in sorted(wait_latencies.items()):
+        if not latencies:
+            continue
+        ordered = sorted(latencies)
+        p50 = ordered[len(ordered) // 2]
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        log.info(
+            f"{key}: {len(ordered)}, {wait_timeouts[key]}, {p50:.2f}s, {p95:.2f}s, {ordered[-1]:.2f}s"
+        )
+
+
 def wait_for_condition(
     condition: Callable[[expected_conditions.AnyDriver], Any], selector=""
 ) -> Any:
+    key = selector or "unnamed"
+    timeout = get_adaptive_timeout(key)
+    started = perf_counter()
     elm_found = None
     while not elm_found:
         try:
-            elm_found = WebDriverWait(browser, TIMEOUT).until(condition)
+            elm_found = WebDriverWait(
+                get_browser(), timeout, poll_frequency=POLL_FREQUENCY
+            ).until(condition)
         except TimeoutException as err:
             log.warning(f"timeout while wait_for_condition: {selector}")
             log.debug(err)
+            wait_timeouts[key] += 1
+            timeout = min(timeout * 2, TIMEOUT)
+    record_wait(key, perf_counter() - started)
     return elm_found
 
 
 def wait_for_condition_once(
     condition: Callable[[expected_conditions.AnyDriver], Any], selector=""
 ) -> Union[Any, None]:
+    key = selector or "unnamed"
+    started = perf_counter()
     try:
-        return WebDriverWait(browser, TIMEOUT).until(condition)
+        elm_found = WebDriverWait(
+            get_browser(), TIMEOUT, poll_frequency=POLL_FREQUENCY
+        ).until(condition)
+        record_wait(key, perf_counter() - started)
+        return elm_found
     except TimeoutException:
         log.warning(f"timeout while wait_for_condition_once: {selector}")
+        wait_timeouts[key] += 1
         return
 
 
@@ -117,28 +326,64 @@ def do_while_wait_for_condition(
     condition: Callable[[expected_conditions.AnyDriver], Any],
     selector="",
 ) -> Any:
+    key = selector or "unnamed"
+    # how long one attempt takes to have an effect. the condition is polled all along,
+    # so this only decides when fn runs again and never goes below RETRIGGER_TIMEOUT
+    timeout = get_adaptive_timeout(key, minimum=RETRIGGER_TIMEOUT)
+    started = perf_counter()
     elm_found = None
     while not elm_found:
         try:
+            attempt_started = perf_counter()
             fn()
-            elm_found = WebDriverWait(browser, 1).until(condition)
+            elm_found = WebDriverWait(
+                get_browser(), timeout, poll_frequency=POLL_FREQUENCY
+            ).until(condition)
+            record_wait(key, perf_counter() - attempt_started)
         except TimeoutException as err:
             log.warning(f"timeout while do_while_wait_for_condition: {selector}")
             log.debug(err)
+            wait_timeouts[key] += 1
+            timeout = min(timeout * 2, max(TIMEOUT, RETRIGGER_TIMEOUT))
+    log.debug(f"{key} took {perf_counter() - started:.2f}s including retries")
     return elm_found
 
 
-def set_cookies(browser: uc.Chrome):
-    get_url(BASE_URL)
+def set_cookies(browser: webdriver.Chrome):
+    """cookies can only be added for the current domain, so this happens on first navigation"""
+    global cookies_set
+    cookies_set = True
+    get_url(BASE_URL, "listing")
     wait_for_condition(
         expected_conditions.presence_of_element_located((By.CSS_SELECTOR, "#main")),
         "#main",
     )
-    for cookie_dict in cookie_dicts:
+    for cookie_dict in read_cookie_dicts():
         browser.add_cookie(cookie_dict)
 
 
-set_cookies(browser)
+def extract_elements(
+    selector: str, fields: Dict[str, Tuple[str, str, bool]]
+) -> List[Dict[str, Any]]:
+    return get_browser().execute_script(EXTRACT_ELEMENTS_SCRIPT, selector, fields)
+
+
+def elements_extracted(
+    selector: str,
+    fields: Dict[str, Tuple[str, str, bool]],
+    required: Union[str, None] = None,
+):
+    """An expectation for extract_elements returning at least one element,
+    all of them with a non-empty `required` field.
+    """
+
+    def _predicate(driver):
+        items = driver.execute_script(EXTRACT_ELEMENTS_SCRIPT, selector, fields)
+        if not items or (required and not all(item[required] for item in items)):
+            return False
+        return items
+
+    return _predicate
 
 
 def text_not_empty_in_element(locator: Tuple[str, str]):
@@ -0,0 +1,256 @@
+import os
+import struct
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+from archive_registry import (
+    CHUNK_SIZE,
+    IMAGE_SUFFIXES,
+    get_member_parts,
+    locked,
+    new_hasher,
+    register_page,
+)
+from json_store import read_json, write_json
+
+# "folder": entries are extracted into data/<artist>/<entry>/,
+# "cbz": entries stay data/<artist>/<entry>.cbz, stored uncompressed
+STORAGE_MODE = os.getenv("STORAGE_MODE", "folder")
+# renamed and replaced members are appended, an archive only gets rewritten as a
+# whole once more than this fraction of it would be left unused by their old copies
+MAX_UNUSED_FRACTION = float(os.getenv("CBZ_MAX_UNUSED_FRACTION", 0.25))
+NORMALIZED_COMMENT = b"normalized"
+METADATA_MEMBER = "metadata.json"
+# signature, 22 bytes we don't need, file name length, extra field length
+LOCAL_HEADER = struct.Struct("<4s22xHH")
+# fixed size of a member's local header plus its central directory record, and of
+# the end of central directory record
+MEMBER_OVERHEAD = 30 + 46
+END_RECORD_SIZE = 22
+
+data_dir = Path.cwd() / "data"
+cbz_index_json = Path.cwd() / "cbz_index.json"
+
+# archive path relative to data_dir -> {"mtime": mtime_ns, "size": file size,
+# "normalized": bool, "members": {name: [data offset, size, zip timestamp]}}.
+# the central directory of an archive is only read again when it changed
+cbz_index_data: Dict[str, Dict[str, Any]] = read_json(cbz_index_json, {})
+cbz_index_dirty = False
+
+
+def is_entry_archive(path: Path) -> bool:
+    return path.suffix == ".cbz" and path.is_file()
+
+
+def get_entry_archive(entry_path: Path) -> Union[Path, None]:
+    """data/<artist>/<entry>.cbz of data/<artist>/<entry>, if the entry is stored as one"""
+    archive = entry_path.with_name(f"{entry_path.name}.cbz")
+    return archive if archive.is_file() else None
+
+
+def split_archive_path(path: Path) -> Union[Tuple[Path, str], None]:
+    """(archive, member name) of a page path pointing into an entry archive"""
+    for parent in path.parents:
+        if is_entry_archive(parent):
+            return parent, path.relative_to(parent).as_posix()
+    return None
+
+
+@locked
+def get_archive_index(archive: Path) -> Dict[str, Any]:
+    global cbz_index_dirty
+    key = archive.relative_to(data_dir).as_posix()
+    stat = archive.stat()
+    indexed = cbz_index_data.get(key)
+    if (
+        indexed
+        and indexed["mtime"] == stat.st_mtime_ns
+        and indexed["size"] == stat.st_size
+    ):
+        return indexed
+
+    members: Dict[str, List[Any]] = {}
+    with archive.open("rb") as f, zipfile.ZipFile(f) as zip:
+        normalized = zip.comment == NORMALIZED_COMMENT
+        for info in zip.infolist():
+            if info.is_dir():
+                continue
+            f.seek(info.header_offset)
+            _signature, name_length, extra_length = LOCAL_HEADER.unpack(
+                f.read(LOCAL_HEADER.size)
+            )
+            members[info.filename] = [
+                info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                info.file_size,
+                datetime(*info.date_time).isoformat(),
+            ]
+    indexed = {
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "normalized": normalized,
+        "members": members,
+    }
+    cbz_index_data[key] = indexed
+    cbz_index_dirty = True
+    return indexed
+
+
+def is_normalized(archive: Path) -> bool:
+    return get_archive_index(archive)["normalized"]
+
+
+def get_archive_pages(archive: Path) -> List[str]:
+    return sorted(
+        name
+        for name in get_archive_index(archive)["members"].keys()
+        if Path(name).suffix in IMAGE_SUFFIXES
+    )
+
+
+def has_member(archive: Path, name: str) -> bool:
+    return name in get_archive_index(archive)["members"]
+
+
+def get_member_region(archive: Path, name: str) -> Tuple[int, int]:
+    """offset and size of a member's bytes, only works for normalized archives"""
+    indexed = get_archive_index(archive)
+    if not indexed["normalized"]:
+        raise Exception(f"{archive} isn't normalized, its members may be compressed")
+    offset, size, _date_time = indexed["members"][name]
+    return offset, size
+
+
+def read_member(archive: Path, name: str) -> bytes:
+    """reads a member straight from its offset"""
+    offset, size = get_member_region(archive, name)
+    with archive.open("rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def get_member_date(archive: Path, name: str) -> datetime:
+    return datetime.fromisoformat(get_archive_index(archive)["members"][name][2])
+
+
+def new_member_info(name: str, date_time: Tuple[int, ...]) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=date_time[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    return info
+
+
+def get_unused_bytes(archive: Path) -> int:
+    """bytes of a normalized archive no member points at, left by update_archive"""
+    indexed = get_archive_index(archive)
+    used = sum(
+        MEMBER_OVERHEAD + 2 * len(name.encode()) + size
+        for name, (_offset, size, _date_time) in indexed["members"].items()
+    )
+    return indexed["size"] - used - END_RECORD_SIZE - len(NORMALIZED_COMMENT)
+
+
+def write_archive(
+    source: Path,
+    dest: Path,
+    renames: Union[Dict[str, str], None] = None,
+    replace: Union[Dict[str, bytes], None] = None,
+) -> Dict[str, str]:
+    """writes source as a normalized archive: stored members with safe names, in
+    order, pages renamed and members replaced on the way. since nothing gets
+    compressed this is a plain copy of the page bytes, hashed on the way. returns
+    page name -> content hash"""
+    renames = renames or {}
+    replace = replace or {}
+    page_hashes: Dict[str, str] = {}
+    tmp_path = dest.with_name(f"{dest.name}.tmp")
+    with zipfile.ZipFile(source, "r") as src, zipfile.ZipFile(tmp_path, "w") as dst:
+        members: Dict[str, zipfile.ZipInfo] = {}
+        for info in src.infolist():
+            name = "/".join(get_member_parts(info.filename))
+            if info.is_dir() or not name or name in replace:
+                continue
+            members[renames.get(name, name)] = info
+        for name in sorted(members.keys()):
+            info = members[name]
+            hasher = new_hasher()
+            with src.open(info) as s, dst.open(
+                new_member_info(name, info.date_time), "w"
+            ) as d:
+                while chunk := s.read(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    d.write(chunk)
+            if Path(name).suffix.lower() in IMAGE_SUFFIXES:
+                page_hashes[name] = hasher.hexdigest()
+        for name, data in replace.items():
+            dst.writestr(new_member_info(name, datetime.now().timetuple()), data)
+        dst.comment = NORMALIZED_COMMENT
+    os.replace(tmp_path, dest)
+    get_archive_index(dest)
+    return page_hashes
+
+
+@locked
+def update_archive(
+    archive: Path,
+    renames: Union[Dict[str, str], None] = None,
+    replace: Union[Dict[str, bytes], None] = None,
+):
+    """renames and replaces members without copying the rest: the changed members
+    are appended and their old records dropped from the central directory, leaving
+    their old bytes unused. falls back to write_archive for archives that aren't
+    normalized or would end up more than MAX_UNUSED_FRACTION unused"""
+    indexed = get_archive_index(archive)
+    members = indexed["members"]
+    renames = {name: new for name, new in (renames or {}).items() if name in members}
+    replace = replace or {}
+    dropped = [name for name in [*renames.keys(), *replace.keys()] if name in members]
+    appended = sum(members[name][1] for name in renames) + sum(
+        len(data) for data in replace.values()
+    )
+    unused = get_unused_bytes(archive) + sum(members[name][1] for name in dropped)
+    if not indexed["normalized"] or unused > MAX_UNUSED_FRACTION * (
+        indexed["size"] + appended
+    ):
+        write_archive(archive, archive, renames=renames, replace=replace)
+        return
+    moved = {
+        new: (read_member(archive, name), get_member_date(archive, name).timetuple())
+        for name, new in renames.items()
+    }
+    with zipfile.ZipFile(archive, "a") as zip:
+        for name in dropped:
+            zip.filelist.remove(zip.NameToInfo.pop(name))
+        for name, (data, date_time) in moved.items():
+            zip.writestr(new_member_info(name, date_time), data)
+        for name, data in replace.items():
+            zip.writestr(new_member_info(name, datetime.now().timetuple()), data)
+    get_archive_index(archive)
+
+
+def normalize_archive(source: Path, dest: Path):
+    """writes source as a normalized archive at dest and registers its pages"""
+    for name, page_hash in write_archive(source, dest).items():
+        register_page(dest / name, page_hash)
+    if source != dest:
+        source.unlink()
+
+
+def rename_members(archive: Path, renames: Dict[str, str]):
+    update_archive(archive, renames=renames)
+
+
+def write_member(archive: Path, name: str, data: bytes):
+    update_archive(archive, replace={name: data})
+
+
+@locked
+def save_cbz_index():
+    global cbz_index_dirty
+    if not cbz_index_dirty:
+        return
+    for key in list(cbz_index_data.keys()):
+        if not (data_dir / key).exists():
+            del cbz_index_data[key]
+    write_json(cbz_index_json, cbz_index_data, sort_keys=True)
+    cbz_index_dirty = False
@@ -1,8 +1,6 @@
-import json
 import re
 from pathlib import Path
-from time import sleep
-from typing import Dict
+from time import perf_counter, sleep
 
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webelement import WebElement
@@ -11,54 +9,52 @@ from selenium.webdriver.support import expected_conditions as ec
 from browser_setup import (
     CAPTCHA,
     browser,
+    browser_session,
     do_while_wait_for_condition,
+    download_dir,
+    elements_extracted,
     get_url,
-    text_not_empty_in_element,
     wait_for_condition,
 )
-from log_setup import log
+from json_store import JsonStore
+from log_setup import count, log, timed
+from state import load_favorited
 
-download_dir = Path.cwd() / "downloaded"
 favorited_json = Path.cwd() / "favorited.json"
 downloaded_json = Path.cwd() / "downloaded.json"
 
-with favorited_json.open("r", encoding="utf-8") as f:
-    favorited_data: Dict[str, str] = json.load(f)
+downloaded_store = JsonStore(downloaded_json, sort_by_value=True)
 
 
 def clean_download_index():
     downloaded_archives = set(archive.stem for archive in download_dir.iterdir())
-    with downloaded_json.open("r+", encoding="utf-8") as f:
-        downloaded_data: Dict[str, str] = json.load(f)
-        downloaded_archives_index = set(downloaded_data.values())
-        extra_archives_str = "\n".join(downloaded_archives_index - downloaded_archives)
-        if extra_archives_str:
-            log.warning(
-                f"difference between actually downloaded and indexed downloaded: \n{extra_archives_str}"
-            )
-        downloaded_data = {
-            url: archive_filename
-            for url, archive_filename in downloaded_data.items()
-            if archive_filename in downloaded_archives
-        }
-        downloaded_data = dict(
-            sorted(downloaded_data.items(), key=lambda item: item[1])
+    downloaded_archives_index = set(downloaded_store.data.values())
+    extra_archives_str = "\n".join(downloaded_archives_index - downloaded_archives)
+    if extra_archives_str:
+        log.warning(
+            f"difference between actually downloaded and indexed downloaded: \n{extra_archives_str}"
         )
-        f.seek(0)
-        json.dump(obj=downloaded_data, fp=f, indent=2, ensure_ascii=False)
-        f.write("\n")
-        f.truncate()
+    downloaded_store.data = {
+        url: archive_filename
+        for url, archive_filename in downloaded_store.data.items()
+        if archive_filename in downloaded_archives
+    }
+    downloaded_store.changed()
+    downloaded_store.flush()
 
 
+@timed("download_all_favorites")
 def download_all_favorites():
-    for url, path in favorited_data.items():
-        with downloaded_json.open("r", encoding="utf-8") as f:
-            downloaded_data: Dict[str, str] = json.load(f)
-        if not url in downloaded_data.keys():
+    for url, path in load_favorited().items():
+        if not url in downloaded_store.data.keys():
             log.warning(f"downloading favorite: '{url} : {path}'")
+            started = perf_counter()
             download_archive(url)
+            count("download_all_favorites_archives")
+            log.info(f"downloaded {url} in {perf_counter() - started:.1f}s")
 
 
+@timed("download_archive")
 def download_archive(url):
     ARCHIVE_NAME_SELECTOR = "#gallery #metadata > header > span.s"
     DOWNLOAD_BTN_SELECTOR = "#gallery #actions > button[title='Download']"
@@ -69,11 +65,13 @@ def download_archive(url):
     CAPTCHA_SUBMIT_SELECTOR = "#h-captcha + button"
     DOWNLOADER_EMPTY_SELECTOR = "#downloader main:not(:has(article))"
 
-    get_url(url)
+    get_url(url, "gallery")
     archive_name: str = wait_for_condition(
-        text_not_empty_in_element((By.CSS_SELECTOR, ARCHIVE_NAME_SELECTOR)),
+        elements_extracted(
+            ARCHIVE_NAME_SELECTOR, {"name": ("", "text", False)}, required="name"
+        ),
         "ARCHIVE_NAME_SELECTOR",
-    )
+    )[0]["name"]
     download_btn: WebElement = wait_for_condition(
         ec.presence_of_element_located((By.CSS_SELECTOR, DOWNLOAD_BTN_SELECTOR)),
         "DOWNLOAD_BTN_SELECTOR",
@@ -82,6 +80,7 @@ def download_archive(url):
 
     original_btn: WebElement = wait_for_condition(
         ec.visibility_of_element_located((By.CSS_SELECTOR, ORIGINAL_BTN_SELECTOR)),
+        "ORIGINAL_BTN_VISIBLE",
     )
     do_while_wait_for_condition(
         lambda: original_btn.click(),
@@ -97,13 +96,15 @@ def download_archive(url):
                 ec.presence_of_element_located(
                     (By.CSS_SELECTOR, DOWNLOADER_EMPTY_SELECTOR)
                 ),
-            )
+            ),
+            "CAPTCHA_OR_DOWNLOADER_EMPTY",
         )
         if is_captcha.aria_role == "Iframe":
             captcha_submit_btn: WebElement = wait_for_condition(
                 ec.presence_of_element_located(
                     (By.CSS_SELECTOR, CAPTCHA_SUBMIT_SELECTOR)
-                )
+                ),
+                "CAPTCHA_SUBMIT_SELECTOR",
             )
             captcha_submit_btn.click()
     wait_for_condition(
@@ -126,7 +127,8 @@ def get_downloaded_filename(url: str, archive_name: str):
     browser.switch_to.new_window("tab")
     get_url("chrome://downloads")
     wait_for_condition(
-        ec.presence_of_element_located((By.CSS_SELECTOR, "downloads-manager"))
+        ec.presence_of_element_located((By.CSS_SELECTOR, "downloads-manager")),
+        "downloads-manager",
     )
     filename: str = browser.execute_script(
         "return document.querySelector('downloads-manager').shadowRoot.querySelector('#downloadsList downloads-item').shadowRoot.querySelector('div#content  #file-link').text"
@@ -155,18 +157,12 @@ def get_downloaded_filename(url: str, archive_name: str):
 
 
 def write_to_downloaded_json(url: str, filename: str):
-    with downloaded_json.open("r+", encoding="utf-8") as f:
-        downloaded_data: Dict[str, str] = json.load(f)
-        if url not in downloaded_data.keys():
-            downloaded_data[url] = filename
-            downloaded_data = dict(
-                sorted(downloaded_data.items(), key=lambda item: item[1])
-            )
-            f.seek(0)
-            json.dump(obj=downloaded_data, fp=f, indent=2, ensure_ascii=False)
-            f.write("\n")
-            f.truncate()
+    if url not in downloaded_store.data.keys():
+        downloaded_store.data[url] = filename
+        downloaded_store.changed()
 
 
-clean_download_index()
-download_all_favorites()
+if __name__ == "__main__":
+    clean_download_index()
+    with browser_session():
+        download_all_favorites()
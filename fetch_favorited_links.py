@@ -1,10 +1,10 @@
-import json
-import logging
 import os
 import re
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple, Union
+from urllib.parse import urljoin
 
+from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webelement import WebElement
@@ -12,59 +12,171 @@ from selenium.webdriver.support import expected_conditions
 
 os.environ["CAPTCHA"] = "false"
 
-from browser_setup import BASE_URL, get_url, wait_for_condition
-from log_setup import log
+from browser_setup import (
+    BASE_URL,
+    browser,
+    browser_session,
+    elements_extracted,
+    get_url,
+    wait_for_condition,
+)
+from json_store import read_json, write_json
+from log_setup import count, log, timed
 
 load_dotenv()
 
 IGNORE_ALREADY_PROCESSED = (
     os.getenv("IGNORE_ALREADY_PROCESSED", "true").lower() == "true"
 )
+CONCURRENT_PAGES = int(os.getenv("CONCURRENT_PAGES", 4))
+FAVORITE_ARTICLE_SELECTOR = "#main > .feed > main > article"
+ARTIST_SELECTOR = 'div a[data-namespace="1"]'
+FAVORITE_FIELDS = {
+    "href": ("a", "href", False),
+    "title": ("a", "name", False),
+    "artists": (ARTIST_SELECTOR, "name", True),
+}
+# fetches all urls at once from inside the page, so the browser's cookies come along
+FETCH_PAGES_SCRIPT = """
+const urls = arguments[0];
+const done = arguments[arguments.length - 1];
+Promise.all(
+  urls.map((url) =>
+    fetch(url, { credentials: "include" })
+      .then((response) => response.text())
+      .catch(() => "")
+  )
+).then(done);
+"""
 
 favorited_json = Path.cwd() / "favorited.json"
 
+# set once the name rules disagree with chrome, the artist directory comes from it
+use_chrome_names = False
+
+
+def get_favorite_name(title: str, artists: List[str]) -> str:
+    return (
+        f"!<not yet downloaded> {artists[0]}/{title}"
+        if artists
+        else f"!<not yet downloaded> unknown/{title}"
+    )
+
+
+def get_accessible_name(tag) -> str:
+    """same rule as accessibleName in EXTRACT_ELEMENTS_SCRIPT: aria-label, text, the
+    first img's alt, title, whitespace collapsed. check_names() checks it against chrome
+    """
+    img = tag.find("img")
+    return " ".join(
+        (
+            tag.get("aria-label")
+            or tag.get_text(" ", strip=True)
+            or (img.get("alt") if img else None)
+            or tag.get("title")
+            or ""
+        ).split()
+    )
+
+
+def fetch_favorite_pages(pages: List[int]) -> List[str]:
+    return browser.execute_async_script(
+        FETCH_PAGES_SCRIPT, [f"{BASE_URL}/favorites?page={page}" for page in pages]
+    )
+
+
+@timed("parse")
+def parse_favorites_html(html: str) -> Union[List[Tuple[str, str]], None]:
+    """None when the html doesn't contain the feed, i.e. it's only rendered client-side"""
+    soup = BeautifulSoup(html, "html.parser")
+    articles = soup.select(FAVORITE_ARTICLE_SELECTOR)
+    if not articles:
+        return None
+    favorites: List[Tuple[str, str]] = []
+    for article in articles:
+        a = article.find("a")
+        if not a or not a.get("href"):
+            continue
+        link = urljoin(BASE_URL, str(a["href"]))
+        artists = [
+            get_accessible_name(artist) for artist in article.select(ARTIST_SELECTOR)
+        ]
+        favorites.append((link, get_favorite_name(get_accessible_name(a), artists)))
+    return favorites
 
-def parse_favorite_page(page: int) -> bool:
-    FAVORITE_ARTICLE_SELECTOR = "#main > .feed > main > article"
-    get_url(f"{BASE_URL}/favorites?page={page}")
+
+def read_extracted_favorites() -> List[Tuple[str, str]]:
+    articles: List[Dict[str, Any]] = wait_for_condition(
+        elements_extracted(FAVORITE_ARTICLE_SELECTOR, FAVORITE_FIELDS),
+        "FAVORITE_ARTICLE_SELECTOR",
+    )
+    return [
+        (article["href"], get_favorite_name(article["title"], article["artists"]))
+        for article in articles
+        if article["href"]
+    ]
+
+
+def read_chrome_favorites() -> List[Tuple[str, str]]:
+    """chrome's own accessible names, but 4+ chromedriver calls per article"""
     articles: List[WebElement] = wait_for_condition(
         expected_conditions.presence_of_all_elements_located(
             (By.CSS_SELECTOR, FAVORITE_ARTICLE_SELECTOR)
         ),
         "FAVORITE_ARTICLE_SELECTOR",
     )
-    with favorited_json.open("r+", encoding="utf-8") as f:
-        favorited_data: Dict[str, str] = json.load(f)
-        reached_already_processed = False
-        for article in articles:
-            a = article.find_element(By.TAG_NAME, "a")
-            link = a.get_attribute("href")
-            artists = article.find_elements(
-                By.CSS_SELECTOR, 'div a[data-namespace="1"]'
+    favorites: List[Tuple[str, str]] = []
+    for article in articles:
+        a = article.find_element(By.TAG_NAME, "a")
+        link = a.get_attribute("href")
+        artists = article.find_elements(By.CSS_SELECTOR, ARTIST_SELECTOR)
+        if link:
+            favorites.append(
+                (
+                    link,
+                    get_favorite_name(
+                        a.accessible_name,
+                        [artist.accessible_name for artist in artists],
+                    ),
+                )
+            )
+    return favorites
+
+
+def check_names() -> bool:
+    """compares both name rules with chrome's accessible names on the loaded page"""
+    expected = read_chrome_favorites()
+    for rule, favorites in (
+        ("script", read_extracted_favorites()),
+        ("html", parse_favorites_html(browser.page_source) or []),
+    ):
+        names = dict(favorites)
+        mismatches = [
+            (name, names.get(link))
+            for link, name in expected
+            if names.get(link) != name
+        ]
+        if mismatches:
+            log.warning(
+                f"{rule} names disagree with chrome on {len(mismatches)} favorites,"
+                f" e.g. {mismatches[0][1]!r} instead of {mismatches[0][0]!r},"
+                " using chrome's"
             )
-            if link:
-                if link not in favorited_data.keys():
-                    favorited_data[link] = (
-                        f"!<not yet downloaded> {artists[0].accessible_name}/{a.accessible_name}"
-                        if artists
-                        else f"!<not yet downloaded> unknown/{a.accessible_name}"
-                    )
-                else:
-                    reached_already_processed = True
-                    break
-
-        favorited_data = dict(sorted(favorited_data.items(), key=lambda item: item[1]))
-        f.seek(0)
-        json.dump(obj=favorited_data, fp=f, indent=2, ensure_ascii=False)
-        f.write("\n")
-        f.truncate()
-        return reached_already_processed
+            return False
+    return True
 
 
+def parse_favorite_page(page: int) -> List[Tuple[str, str]]:
+    get_url(f"{BASE_URL}/favorites?page={page}", "listing")
+    return read_chrome_favorites() if use_chrome_names else read_extracted_favorites()
+
+
+@timed("get_favorites")
 def get_favorites():
+    global use_chrome_names
     PAGE_PATTERN = re.compile(r".*\/favorites\?page=(\d+)")
     LAST_PAGE_SELECTOR = "#main > .feed > footer > nav > a[title*='last page']"
-    get_url(f"{BASE_URL}/favorites")
+    get_url(f"{BASE_URL}/favorites", "listing")
     last_page_btn: WebElement = wait_for_condition(
         expected_conditions.presence_of_element_located(
             (By.CSS_SELECTOR, LAST_PAGE_SELECTOR)
@@ -78,14 +190,42 @@ def get_favorites():
         or not m.group(1)
     ):
         raise Exception("can't find last page button")
-    n_pages: str = m.group(1)
+    n_pages = int(m.group(1))
+    use_chrome_names = not check_names()
+
+    favorited_data: Dict[str, str] = read_json(favorited_json)
+    new_favorites: Dict[str, str] = {}
+    reached_already_processed = False
+    page = 1
+    while page <= n_pages and not reached_already_processed:
+        batch = list(range(page, min(page + CONCURRENT_PAGES, n_pages + 1)))
+        log.info(f"fetching pages: {batch[0]}-{batch[-1]}")
+        count("get_favorites_pages", len(batch))
+        for batch_page, html in zip(batch, fetch_favorite_pages(batch)):
+            favorites = None if use_chrome_names else parse_favorites_html(html)
+            if favorites is None:
+                log.debug(f"page {batch_page} isn't server-rendered, loading it")
+                favorites = parse_favorite_page(batch_page)
+            new_page_favorites = {
+                link: name
+                for link, name in favorites
+                if link not in favorited_data and link not in new_favorites
+            }
+            log.info(f"page {batch_page}: {len(new_page_favorites)} new favorites")
+            new_favorites.update(new_page_favorites)
+            if IGNORE_ALREADY_PROCESSED and favorites and not new_page_favorites:
+                log.info("reached already processed, stopping")
+                reached_already_processed = True
+                break
+        page += len(batch)
 
-    for page in range(1, int(n_pages) + 1):
-        log.info(f"parsing page: {page}")
-        reached_already_processed = parse_favorite_page(page)
-        if reached_already_processed:
-            log.info("reached already processed, stopping")
-            break
+    if new_favorites:
+        write_json(
+            favorited_json, {**favorited_data, **new_favorites}, sort_by_value=True
+        )
+    log.info(f"added {len(new_favorites)} favorites")
 
 
-get_favorites()
+if __name__ == "__main__":
+    with browser_session():
+        get_favorites()
@@ -1,12 +1,17 @@
 # pyright: reportOptionalMemberAccess=false
 # pyright: reportOptionalSubscript=false
+import hashlib
 import json
 import os
 import re
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from io import BytesIO
 from pathlib import Path
-from typing import Any, Dict, Union
+from time import sleep
+from typing import Any, Dict, List, Tuple, Union
 from urllib.parse import urljoin, urlparse
 
 from monkey_patches import patch_tinydb
@@ -16,10 +21,36 @@ patch_tinydb()
 import pytz
 import requests
 from bs4 import BeautifulSoup
-from slugify import slugify
-from tinydb import TinyDB
-
-from log_setup import log
+from tinydb import Query, TinyDB
+
+from archive_registry import get_skipped
+from cbz_store import (
+    METADATA_MEMBER,
+    get_archive_pages,
+    get_entry_archive,
+    get_member_date,
+    has_member,
+    read_member,
+    save_cbz_index,
+    write_member,
+)
+from json_store import JsonStore, dumps_json, read_json, write_json
+from log_setup import count, get_host, log, pop_flag, timed
+from naming import clean_directory_name, do_slugify
+from phash_index import (
+    DECODE_ERRORS,
+    MATCH_DISTANCE,
+    dhash,
+    get_entry_hash,
+    hamming,
+    open_reduced,
+)
+from state import (
+    load_downloaded,
+    load_fallback_metadata,
+    load_index,
+    original_sources_json,
+)
 
 F_BASE_URL = os.getenv("F_BASE_URL", "")
 I_BASE_URL = os.getenv("I_BASE_URL", "")
@@ -34,26 +65,40 @@ F_MULTI_KEYS_MAPPING = {
 ANCHIRA_SEQ_PATTERN = re.compile(r".*\/g\/(\d+)\/.*")
 PAGES_PATTERN = re.compile(r".*?(\d+) pages?.*")
 THUMBNAIL_PAGE_PATTERN = re.compile(r".*\/thumbs\/(\d+)\.thumb.*")
-IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png"]
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".webp"]
+VERIFY_THUMBNAILS = os.getenv("VERIFY_THUMBNAILS", "true").lower() == "true"
+# retries of dropped connections and overloaded responses, FETCH_BACKOFF doubles each time
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", 3))
+FETCH_BACKOFF = float(os.getenv("FETCH_BACKOFF", 2))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 30))
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# match entries against one listing of their artist's works per site before searching
+# each of them on its own
+FETCH_BY_ARTIST = os.getenv("FETCH_BY_ARTIST", "true").lower() == "true"
+# artists whose listings are kept
+FETCH_CATALOG_CACHE = int(os.getenv("FETCH_CATALOG_CACHE", 32))
+# revisits the sources of entries that already have metadata instead of fetching
+# missing metadata, also switched on by --refresh
+FETCH_REFRESH = (
+    os.getenv("FETCH_REFRESH", "false").lower() == "true"
+    or pop_flag("--refresh") is not None
+)
+# days before the source of an entry is checked for changes again
+REFRESH_MIN_AGE_DAYS = float(os.getenv("REFRESH_MIN_AGE_DAYS", 30))
+# requests refreshing may send per day, shared by all runs of that day
+REFRESH_DAILY_BUDGET = int(os.getenv("REFRESH_DAILY_BUDGET", 500))
+# fields that come from the entry's own files, not from its source
+LOCAL_FIELDS = ["date_archived"]
 
 
 data_dir = Path.cwd() / "data"
 
-downloaded_json = Path.cwd() / "downloaded.json"
-with downloaded_json.open(mode="r", encoding="utf-8") as f:
-    downloaded_data: Dict[str, str] = json.load(f)
-
-index_json = Path.cwd() / "index.json"
-with index_json.open(mode="r", encoding="utf-8") as f:
-    index_data: Dict[str, Dict[str, str]] = json.load(f)
-
-original_sources_json = Path.cwd() / "original_sources.json"
-with original_sources_json.open(mode="r", encoding="utf-8") as f:
-    original_sources_data: Dict[str, str] = json.load(f)
-
-fallback_metadata_json = Path.cwd() / "fallback_metadata.json"
-with fallback_metadata_json.open(mode="r", encoding="utf-8") as f:
-    fallback_metadata_data: Dict[str, Dict[str, Any]] = json.load(f)
+original_sources_store = JsonStore(original_sources_json, sort_by_value=True)
+# validators and last check of every source, and the requests spent today
+refresh_state_json = Path.cwd() / "refresh_state.json"
+refresh_store = JsonStore(
+    refresh_state_json, default={"budget": {}, "sources": {}}, sort_keys=True
+)
 
 cookies_txt = Path.cwd() / "f_cookies.txt"
 with cookies_txt.open("r") as f:
@@ -67,103 +112,107 @@ headers_dict = {
     "X-Requested-With": "XMLHttpRequest",
 }
 db = TinyDB("db.json", indent=2, ensure_ascii=False, sort_keys=True, encoding="utf-8")
+# the db, the archives and original_sources.json are written by one thread at a time
+write_lock = threading.Lock()
+Entry = Query()
+sent_requests = 0
 # db = TinyDB("db.json", ensure_ascii=False, encoding="utf-8")
 
 
-def do_slugify(s: str) -> str:
-    s = re.sub("’", "'", s)
-    s = re.sub("？", "", s)
-    s = re.sub("–", "-", s)
-    s = re.sub("&amp;", "-", s)
-    return slugify(
-        s,
-        replacements=[
-            ["'", ""],
-            ["❤", ""],
-            ["☆", ""],
-            ["&", ""],
-            ["♀", ""],
-            ["_", ""],
-            [".", ""],
-            [":", "-"],
-            ["꞉", "-"],
-            ["*", ""],
-            ["犬", ""],
-        ],
-    )
-
-
-def clean_directory_name(name: str):
-    ARTIST_NAME_PATTERN = r"^\[[^\]]*\]"
-    TAGS_PATTERN = r"\{[^\}]*\}$"
-    KOUSHOKU_PATTERN = r"\(koushoku\.org\)|\(ksk\.moe\)"
-    EXTRA_INFO_PATTERN = r"(?:\([^\)]*\)|\[[^\]]*\])(?:\s(?:\[.*\])*)*$"
-    new_name = re.sub(ARTIST_NAME_PATTERN, "", name)
-    new_name = re.sub(TAGS_PATTERN, "", new_name)
-    new_name = re.sub(KOUSHOKU_PATTERN, "", new_name)
-    new_name = re.sub("’", "'", new_name)
-    new_name = re.sub("？", "", new_name)
-    new_name = re.sub("–", "-", new_name)
-    new_name = re.sub(EXTRA_INFO_PATTERN, "", new_name)
-    return new_name.strip()
+def get_url(
+    url: str, extra_headers: Union[Dict[str, str], None] = None
+) -> requests.Response:
+    global sent_requests
+    host = get_host(url)
+    for attempt in range(FETCH_RETRIES + 1):
+        delay = FETCH_BACKOFF * 2**attempt
+        sent_requests += 1
+        try:
+            with timed("http", host):
+                response = requests.get(
+                    url,
+                    cookies=cookies_dict,
+                    headers={**headers_dict, **(extra_headers or {})},
+                    timeout=FETCH_TIMEOUT,
+                )
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt == FETCH_RETRIES:
+                raise
+            log.warning(f"{type(err).__name__} for {url}, retrying in {delay:g}s")
+        else:
+            count("http_bytes", len(response.content), host)
+            if response.status_code not in RETRY_STATUSES or attempt == FETCH_RETRIES:
+                return response
+            retry_after = response.headers.get("retry-after", "")
+            if retry_after.isdigit():
+                delay = int(retry_after)
+            log.warning(f"{response.status_code} for {url}, retrying in {delay:g}s")
+        count("retried_requests", host=host)
+        sleep(delay)
+    raise Exception(f"could not get {url}")
 
 
-def get_url(url: str) -> requests.Response:
-    return requests.get(url, cookies=cookies_dict, headers=headers_dict)
+@timed("parse")
+def get_soup(page: requests.Response) -> BeautifulSoup:
+    return BeautifulSoup(page.text, "html.parser")
 
 
 def get_thumbnail_page(url: str) -> int:
     return int(THUMBNAIL_PAGE_PATTERN.match(url).group(1))
 
 
-# this method isn't good enough, gotta try SSIM: https://stackoverflow.com/questions/71567315/how-to-get-the-ssim-comparison-score-between-two-images
-# def check_thumbnail(thumbnail_url: str, entry_path: Path) -> bool:
-#     thumbnail_img = Image.open(BytesIO(get_url(thumbnail_url).content))
-#     thumbnail_page = get_thumbnail_page(thumbnail_url)
-#     actual_img_path = next(islice(entry_path.iterdir(), thumbnail_page - 1, None))
-#     actual_img = Image.open(actual_img_path).convert("RGB")
-#     actual_img.thumbnail(thumbnail_img.size)
-
-#     try:
-
-#         diff = ImageChops.difference(thumbnail_img, actual_img)
-
-#         # calculate rms
-#         histo = diff.histogram()
-#         rms = math.sqrt(
-#             reduce(operator.add, map(lambda h, i: h * (i**2), histo, range(len(histo))))
-#             / (float(thumbnail_img.size[0]) * actual_img.size[1])
-#         )
-#         diff.save("diff.bmp")
-#         return rms < 600
-#     except ValueError as e:
-#         return False
-
-
-def suggest_f(artist: str, title: str) -> Union[str, None]:
+def check_thumbnail(thumbnail_url: str, entry_path: Path) -> bool:
+    """whether the thumbnail matches the entry, a thumbnail that can't be fetched or
+    decoded counts as not verified instead of ending the whole run. an entry page
+    that can't be decoded leaves it unverifiable, like a missing page"""
+    m = THUMBNAIL_PAGE_PATTERN.match(thumbnail_url)
+    entry_hash = get_entry_hash(entry_path, int(m.group(1)) if m else 1)
+    if entry_hash is None:
+        return True
+    try:
+        response = get_url(thumbnail_url)
+        if not response.ok:
+            raise OSError(f"{response.status_code} for {thumbnail_url}")
+        thumbnail_img = open_reduced(BytesIO(response.content))
+    except (requests.RequestException, *DECODE_ERRORS) as e:
+        log.warning(f"could not check thumbnail {thumbnail_url}: {e}")
+        count("thumbnail_check_failed")
+        return False
+    return hamming(dhash(thumbnail_img), entry_hash) <= MATCH_DISTANCE
+
+
+def suggest_f(
+    artist: str, title: str, entry_path: Union[Path, None] = None
+) -> Union[str, None]:
     response = get_url(f"{F_BASE_URL}/suggest/{artist} {title}")
     suggestions = [
         s for s in response.json()["results"] if s["link"].startswith("/hentai/")
     ]
 
-    matching_title = next(
-        (
-            suggestion
-            for suggestion in suggestions
-            if do_slugify(title) == do_slugify(suggestion["title"])
-            or title == do_slugify(suggestion["title"])
-        ),
-        None,
+    matching_titles = (
+        suggestion
+        for suggestion in suggestions
+        if do_slugify(title) == do_slugify(suggestion["title"])
+        or title == do_slugify(suggestion["title"])
     )
-    if matching_title:
-        # matching_thumbnail = check_thumbnail(matching_title["image"], entry_path)
+    for matching_title in matching_titles:
+        if (
+            VERIFY_THUMBNAILS
+            and entry_path
+            and matching_title.get("image")
+            and not check_thumbnail(
+                urljoin(F_BASE_URL, matching_title["image"]), entry_path
+            )
+        ):
+            log.info(f"thumbnail mismatch for {matching_title['link']}, skipping")
+            continue
         return f"{F_BASE_URL}{matching_title['link']}"
     return None
 
 
 def search_f(artist: str, title: str) -> Union[str, None]:
     page = get_url(f"{F_BASE_URL}/search/{artist} {title}")
-    soup = BeautifulSoup(page.text, "html.parser")
+    soup = get_soup(page)
     for entry in soup.select("div[id^='content-']"):
         entry_title = entry.select("a.text-md")[0]
         if do_slugify(entry_title.text.strip()) == do_slugify(title):
@@ -176,7 +225,9 @@ def search_f(artist: str, title: str) -> Union[str, None]:
     return None
 
 
-def suggest_i(artist: str, title: str) -> Union[str, None]:
+def suggest_i(
+    artist: str, title: str, entry_path: Union[Path, None] = None
+) -> Union[str, None]:
     response_title = get_url(
         f"{I_BASE_URL}/index.php?route=extension/module/me_ajax_search/search&search={title}"
     )
@@ -187,23 +238,28 @@ def suggest_i(artist: str, title: str) -> Union[str, None]:
         *response_title.json()["products"],
         *response_artist.json()["products"],
     ]
-    matching_title = next(
-        (
-            suggestion
-            for suggestion in suggestions
-            if do_slugify(title) == do_slugify(suggestion["name"])
-        ),
-        None,
+    matching_titles = (
+        suggestion
+        for suggestion in suggestions
+        if do_slugify(title) == do_slugify(suggestion["name"])
     )
-    if matching_title:
+    for matching_title in matching_titles:
         url = matching_title["href"]
+        if (
+            VERIFY_THUMBNAILS
+            and entry_path
+            and matching_title.get("image")
+            and not check_thumbnail(urljoin(url, matching_title["image"]), entry_path)
+        ):
+            log.info(f"thumbnail mismatch for {url}, skipping")
+            continue
         return urljoin(url, urlparse(url).path)
     return None
 
 
 def search_i(artist: str, title: str) -> Union[str, None]:
     page = get_url(f"{I_BASE_URL}/index.php?route=product/search&search={title}")
-    soup = BeautifulSoup(page.text, "html.parser")
+    soup = get_soup(page)
 
     for entry in soup.select("#product-search .main-products .product-thumb"):
         entry_title = entry.select(".name a")[0]
@@ -218,10 +274,146 @@ def search_i(artist: str, title: str) -> Union[str, None]:
     return None
 
 
+def get_listing(url: str) -> requests.Response:
+    """a listing response that is complete, so no partial listing gets cached"""
+    response = get_url(url)
+    if not response.ok:
+        raise Exception(f"{response.status_code} for {url}")
+    return response
+
+
+@lru_cache(maxsize=FETCH_CATALOG_CACHE)
+def list_catalog_f(artist: str) -> Tuple[Dict[str, str], ...]:
+    """title, url and thumbnail of the works f suggests and finds for the artist,
+    raising when any page of the listing can't be read"""
+    catalog: Dict[str, Dict[str, str]] = {}
+    response = get_listing(f"{F_BASE_URL}/suggest/{artist}")
+    for suggestion in response.json()["results"]:
+        if suggestion["link"].startswith("/hentai/"):
+            url = f"{F_BASE_URL}{suggestion['link']}"
+            catalog[url] = {
+                "title": suggestion["title"],
+                "url": url,
+                "image": (
+                    urljoin(F_BASE_URL, suggestion["image"])
+                    if suggestion.get("image")
+                    else ""
+                ),
+            }
+    # search results are paginated, follow them until a page adds nothing new
+    found = set()
+    page = 1
+    while True:
+        soup = get_soup(get_listing(f"{F_BASE_URL}/search/{artist}?page={page}"))
+        new_results = 0
+        for entry in soup.select("div[id^='content-']"):
+            entry_title = entry.select("a.text-md")[0]
+            url = entry_title["href"]
+            if isinstance(url, list):
+                url = url[0]
+            if url in found:
+                continue
+            found.add(url)
+            new_results += 1
+            if not any(
+                do_slugify(entry_artist.text.strip()) == do_slugify(artist)
+                for entry_artist in entry.select("a.text-sm")
+            ):
+                continue
+            catalog.setdefault(
+                f"{F_BASE_URL}{url}",
+                {
+                    "title": entry_title.text.strip(),
+                    "url": f"{F_BASE_URL}{url}",
+                    "image": "",
+                },
+            )
+        if not new_results:
+            break
+        page += 1
+    return tuple(catalog.values())
+
+
+def get_catalog_f(artist: str) -> List[Dict[str, str]]:
+    try:
+        return list(list_catalog_f(artist))
+    except Exception as e:
+        log.warning(f"could not list the works of {artist} on f: {e}")
+        return []
+
+
+@lru_cache(maxsize=FETCH_CATALOG_CACHE)
+def list_catalog_i(artist: str) -> Tuple[Dict[str, str], ...]:
+    """title, url and thumbnail of the works i suggests for the artist"""
+    response = get_listing(
+        f"{I_BASE_URL}/index.php?route=extension/module/me_ajax_search/search&search={artist}"
+    )
+    return tuple(
+        {
+            "title": product["name"],
+            "url": urljoin(product["href"], urlparse(product["href"]).path),
+            "image": (
+                urljoin(product["href"], product["image"])
+                if product.get("image")
+                else ""
+            ),
+        }
+        for product in response.json()["products"]
+    )
+
+
+def get_catalog_i(artist: str) -> List[Dict[str, str]]:
+    try:
+        return list(list_catalog_i(artist))
+    except Exception as e:
+        log.warning(f"could not list the works of {artist} on i: {e}")
+        return []
+
+
+def match_catalog(
+    catalog: List[Dict[str, str]], titles: List[str], entry_path: Path
+) -> Union[str, None]:
+    for title in titles:
+        for item in catalog:
+            if do_slugify(title) != do_slugify(item["title"]) and title != do_slugify(
+                item["title"]
+            ):
+                continue
+            if (
+                VERIFY_THUMBNAILS
+                and item["image"]
+                and not check_thumbnail(item["image"], entry_path)
+            ):
+                log.info(f"thumbnail mismatch for {item['url']}, skipping")
+                continue
+            return item["url"]
+    return None
+
+
 def search_entry(
-    artist: str, download_title: str, index_title: str
+    artist: str, download_title: str, index_title: str, entry_path: Path
 ) -> Union[str, None]:
-    search_fns = [suggest_f, search_f, suggest_i, search_i]
+    if FETCH_BY_ARTIST:
+        titles = list(
+            dict.fromkeys(
+                [
+                    download_title,
+                    index_title,
+                    do_slugify(download_title),
+                    do_slugify(index_title),
+                ]
+            )
+        )
+        for get_catalog in [get_catalog_f, get_catalog_i]:
+            if url := match_catalog(get_catalog(artist), titles, entry_path):
+                count("catalog_matches")
+                return url
+    search_fns = [
+        partial(suggest_f, entry_path=entry_path),
+        search_f,
+        partial(suggest_i, entry_path=entry_path),
+        search_i,
+    ]
     for search_fn in search_fns:
         if url := search_fn(artist, download_title):
             return url
@@ -236,7 +428,9 @@ def search_entry(
     return None
 
 
-def fetch_metadata_f(url: str, entry_path: Path) -> Dict[str, str]:
+def fetch_metadata_f(
+    url: str, entry_path: Path, page: Union[requests.Response, None] = None
+) -> Dict[str, str]:
     metadata = {
         "title": None,
         "artists": [],
@@ -257,8 +451,9 @@ def fetch_metadata_f(url: str, entry_path: Path) -> Dict[str, str]:
         "collections": None,
         "related": None,
     }
-    page = get_url(url)
-    soup = BeautifulSoup(page.text, "html.parser")
+    if page is None:
+        page = get_url(url)
+    soup = get_soup(page)
 
     right_container = soup.select(
         "div[class^='block md:table-cell relative w-full align-top']"
@@ -316,25 +511,13 @@ def fetch_metadata_f(url: str, entry_path: Path) -> Dict[str, str]:
     metadata["date_published"] = parsedate_to_datetime(
         thumbnail_img.headers["last-modified"]
     ).isoformat()
-    metadata["date_archived"] = (
-        datetime.fromtimestamp(
-            int(
-                os.path.getmtime(
-                    next(
-                        file
-                        for suffix in IMAGE_SUFFIXES
-                        for file in entry_path.glob(f"**/*{suffix}")
-                    )
-                )
-            )
-        )
-        .astimezone(pytz.utc)
-        .isoformat()
-    )
+    metadata["date_archived"] = get_date_archived(entry_path)
     return metadata
 
 
-def fetch_metadata_i(url: str, entry_path: Path) -> Dict[str, str]:
+def fetch_metadata_i(
+    url: str, entry_path: Path, page: Union[requests.Response, None] = None
+) -> Dict[str, str]:
     metadata = {
         "title": None,
         "artists": [],
@@ -356,8 +539,9 @@ def fetch_metadata_i(url: str, entry_path: Path) -> Dict[str, str]:
         "related": None,
     }
 
-    page = get_url(url)
-    soup = BeautifulSoup(page.text, "html.parser")
+    if page is None:
+        page = get_url(url)
+    soup = get_soup(page)
 
     metadata["title"] = soup.select("h1.page-title")[0].text.strip()
 
@@ -386,21 +570,7 @@ def fetch_metadata_i(url: str, entry_path: Path) -> Dict[str, str]:
     metadata["date_published"] = parsedate_to_datetime(
         thumbnail_img.headers["last-modified"]
     ).isoformat()
-    metadata["date_archived"] = (
-        datetime.fromtimestamp(
-            int(
-                os.path.getmtime(
-                    next(
-                        file
-                        for suffix in IMAGE_SUFFIXES
-                        for file in entry_path.glob(f"**/*{suffix}")
-                    )
-                )
-            )
-        )
-        .astimezone(pytz.utc)
-        .isoformat()
-    )
+    metadata["date_archived"] = get_date_archived(entry_path)
     return metadata
 
 
@@ -426,13 +596,21 @@ def fetch_metadata_l(url: str, entry_path: Path) -> Union[Dict[str, str], None]:
         "related": None,
     }
 
-    fallback_metadata = fallback_metadata_data.get(url, None)
+    fallback_metadata = load_fallback_metadata().get(url, None)
     if not fallback_metadata:
         return None
     metadata = {**metadata, **fallback_metadata}
 
-    metadata["date_archived"] = (
-        datetime.fromtimestamp(
+    metadata["date_archived"] = get_date_archived(entry_path)
+    return metadata
+
+
+def get_date_archived(entry_path: Path) -> str:
+    """mtime of a page, or its zip timestamp for entries stored as archives"""
+    if archive := get_entry_archive(entry_path):
+        date = get_member_date(archive, get_archive_pages(archive)[0])
+    else:
+        date = datetime.fromtimestamp(
             int(
                 os.path.getmtime(
                     next(
@@ -443,22 +621,21 @@ def fetch_metadata_l(url: str, entry_path: Path) -> Union[Dict[str, str], None]:
                 )
             )
         )
-        .astimezone(pytz.utc)
-        .isoformat()
-    )
-    return metadata
+    return date.astimezone(pytz.utc).isoformat()
+
+
+def has_metadata(entry_path: Path) -> bool:
+    if archive := get_entry_archive(entry_path):
+        return has_member(archive, METADATA_MEMBER)
+    return (entry_path / "metadata.json").exists()
 
 
 def write_metadata(metadata_json, metadata):
-    with metadata_json.open(mode="w", encoding="utf-8") as f:
-        json.dump(
-            obj=metadata,
-            fp=f,
-            indent=2,
-            ensure_ascii=False,
-            sort_keys=True,
-        )
-        f.write("\n")
+    if archive := get_entry_archive(metadata_json.parent):
+        write_member(archive, METADATA_MEMBER, dumps_json(metadata, sort_keys=True))
+        save_cbz_index()
+    else:
+        write_json(metadata_json, metadata, sort_keys=True)
     db.insert(
         {
             **metadata,
@@ -467,61 +644,199 @@ def write_metadata(metadata_json, metadata):
     )
 
 
+def fetch_entry(artist: str, entry: str, url: str, download_name: str) -> bool:
+    """finds the source of one entry and writes its metadata, False when it already
+    had some or none could be found. safe to call from several threads"""
+    entry_path = data_dir / artist / entry
+    if has_metadata(entry_path):
+        return False
+    log.info(f"no metadata.json for {artist}/{entry}")
+    with write_lock:
+        source_url = original_sources_store.data.get(url, None)
+    if not source_url:
+        log.info(f"searching source for {artist}/{entry}")
+        source_url = search_entry(
+            artist,
+            clean_directory_name(download_name),
+            clean_directory_name(entry),
+            entry_path,
+        )
+        if not source_url:
+            log.error(f"could not find source for {artist}/{entry}")
+            return False
+        log.info(f"found source for {artist}/{entry}  --->  {source_url}")
+        with write_lock:
+            original_sources_store.data[url] = source_url
+            original_sources_store.changed()
+
+    if source_url.startswith(F_BASE_URL):
+        log.info(f"fetching f metadata for {source_url}")
+        metadata = fetch_metadata_f(source_url, entry_path)
+    elif source_url.startswith(I_BASE_URL):
+        log.info(f"fetching i metadata for {source_url}")
+        metadata = fetch_metadata_i(source_url, entry_path)
+    else:
+        log.info(f"fetching l metadata for {source_url}")
+        metadata = fetch_metadata_l(source_url, entry_path)
+    if not metadata:
+        log.error(f"could not find metadata for source: {source_url}")
+        return False
+    log.info(f"successfully fetched metadata for {artist}/{entry} at {source_url}")
+    with write_lock:
+        write_metadata(entry_path / "metadata.json", metadata)
+    count("fetch_all_entries")
+    return True
+
+
+@timed("fetch_all")
 def fetch_all():
-    global downloaded_data
-    global index_data
-    global original_sources_data
-    for artist, entries in index_data.items():
+    downloaded_data = load_downloaded()
+    for artist, entries in load_index().items():
         for entry, url in entries.items():
-            entry_path = data_dir / artist / entry
-            metadata_json = entry_path / "metadata.json"
-            if not metadata_json.exists():
-                log.info(f"no metadata.json for {artist}/{entry}")
-                source_url = original_sources_data.get(url, None)
-                if not source_url:
-                    log.info(f"searching source for {artist}/{entry}")
-                    source_url = search_entry(
-                        artist,
-                        clean_directory_name(downloaded_data[url]),
-                        clean_directory_name(entry),
-                    )
-                    if not source_url:
-                        log.error(f"could not find source for {artist}/{entry}")
-                        continue
-                    log.info(f"found source for {artist}/{entry}  --->  {source_url}")
-                    original_sources_data[url] = source_url
-                    with original_sources_json.open("r+", encoding="utf-8") as f:
-                        original_sources_data = dict(
-                            sorted(
-                                original_sources_data.items(), key=lambda item: item[1]
-                            )
-                        )
-                        f.seek(0)
-                        json.dump(
-                            obj=original_sources_data,
-                            fp=f,
-                            indent=2,
-                            ensure_ascii=False,
-                        )
-                        f.write("\n")
-                        f.truncate()
-
-                if source_url.startswith(F_BASE_URL):
-                    log.info(f"fetching f metadata for {source_url}")
-                    metadata = fetch_metadata_f(source_url, entry_path)
-                elif source_url.startswith(I_BASE_URL):
-                    log.info(f"fetching i metadata for {source_url}")
-                    metadata = fetch_metadata_i(source_url, entry_path)
-                else:
-                    log.info(f"fetching l metadata for {source_url}")
-                    metadata = fetch_metadata_l(source_url, entry_path)
-                if not metadata:
-                    log.error(f"could not find metadata for source: {source_url}")
-                    continue
-                log.info(
-                    f"successfully fetched metadata for {artist}/{entry} at {source_url}"
-                )
-                write_metadata(entry_path / "metadata.json", metadata)
+            # exact duplicates of another entry were never added to data/
+            if get_skipped(url):
+                continue
+            fetch_entry(artist, entry, url, downloaded_data[url])
+
+
+def read_metadata(entry_path: Path) -> Dict[str, Any]:
+    if archive := get_entry_archive(entry_path):
+        return json.loads(read_member(archive, METADATA_MEMBER))
+    return read_json(entry_path / "metadata.json")
+
+
+def update_metadata(
+    entry_path: Path, metadata: Dict[str, Any], changes: Dict[str, Any]
+):
+    """writes the changed fields into metadata.json and into its db document"""
+    metadata_json = entry_path / "metadata.json"
+    if archive := get_entry_archive(entry_path):
+        write_member(
+            archive,
+            METADATA_MEMBER,
+            dumps_json({**metadata, **changes}, sort_keys=True),
+        )
+        save_cbz_index()
+    else:
+        write_json(metadata_json, {**metadata, **changes}, sort_keys=True)
+    db.update(
+        changes, Entry.json_path == metadata_json.relative_to(data_dir).as_posix()
+    )
 
 
-fetch_all()
+def get_validators(page: requests.Response) -> Dict[str, str]:
+    """what the next check sends back, and a hash for sources that send neither"""
+    return {
+        "etag": page.headers.get("etag", ""),
+        "last_modified": page.headers.get("last-modified", ""),
+        "sha1": hashlib.sha1(page.content).hexdigest(),
+    }
+
+
+def refresh_entry(entry_path: Path, source_url: str) -> str:
+    """revalidates the source of one entry and writes back what changed since.
+    one of unchanged, changed or failed"""
+    state = refresh_store.data["sources"].get(source_url, {})
+    conditional_headers = {}
+    if state.get("etag"):
+        conditional_headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        conditional_headers["If-Modified-Since"] = state["last_modified"]
+    page = get_url(source_url, conditional_headers)
+    checked = datetime.now(pytz.utc).isoformat(timespec="seconds")
+    if page.status_code == 304:
+        result = "unchanged"
+    elif page.status_code != 200:
+        log.warning(f"{page.status_code} for {source_url}, checking it again next run")
+        return "failed"
+    elif get_validators(page)["sha1"] == state.get("sha1"):
+        state = {**state, **get_validators(page)}
+        result = "unchanged"
+    else:
+        if source_url.startswith(F_BASE_URL):
+            fetched = fetch_metadata_f(source_url, entry_path, page)
+        else:
+            fetched = fetch_metadata_i(source_url, entry_path, page)
+        metadata = read_metadata(entry_path)
+        changes = {
+            key: value
+            for key, value in fetched.items()
+            if key not in LOCAL_FIELDS and metadata.get(key) != value
+        }
+        if changes:
+            log.info(
+                f"{source_url} changed {', '.join(sorted(changes))} of "
+                f"{entry_path.relative_to(data_dir).as_posix()}"
+            )
+            with write_lock:
+                update_metadata(entry_path, metadata, changes)
+        state = {**state, **get_validators(page)}
+        result = "changed" if changes else "unchanged"
+    refresh_store.data["sources"][source_url] = {**state, "checked": checked}
+    refresh_store.changed()
+    return result
+
+
+def get_refresh_candidates() -> List[Tuple[Path, str]]:
+    """entries with metadata from f or i whose source wasn't checked for
+    REFRESH_MIN_AGE_DAYS, never and longest unchecked first"""
+    oldest = datetime.now(pytz.utc) - timedelta(days=REFRESH_MIN_AGE_DAYS)
+    sources = refresh_store.data["sources"]
+    skipped_entries = set(
+        data_dir / artist / entry
+        for artist, entries in load_index().items()
+        for entry, url in entries.items()
+        if get_skipped(url)
+    )
+    candidates = []
+    for document in db.all():
+        source_url = document.get("official_source") or ""
+        if not (
+            (F_BASE_URL and source_url.startswith(F_BASE_URL))
+            or (I_BASE_URL and source_url.startswith(I_BASE_URL))
+        ):
+            continue
+        checked = sources.get(source_url, {}).get("checked", "")
+        if checked and datetime.fromisoformat(checked) > oldest:
+            continue
+        entry_path = (data_dir / document["json_path"]).parent
+        if entry_path not in skipped_entries and has_metadata(entry_path):
+            candidates.append((checked, entry_path, source_url))
+    return [
+        (entry_path, source_url)
+        for _checked, entry_path, source_url in sorted(candidates, key=lambda c: c[0])
+    ]
+
+
+@timed("refresh_all")
+def refresh_all():
+    today = datetime.now(pytz.utc).date().isoformat()
+    budget = refresh_store.data["budget"]
+    if budget.get("date") != today:
+        budget.update({"date": today, "requests": 0})
+    candidates = get_refresh_candidates()
+    log.info(
+        f"{len(candidates)} sources due for a refresh, "
+        f"{max(0, REFRESH_DAILY_BUDGET - budget['requests'])} requests left for today"
+    )
+    for entry_path, source_url in candidates:
+        if budget["requests"] >= REFRESH_DAILY_BUDGET:
+            log.info("daily refresh budget spent, continuing tomorrow")
+            break
+        sent_before = sent_requests
+        try:
+            result = refresh_entry(entry_path, source_url)
+        except Exception:
+            log.exception(f"could not refresh {source_url}")
+            result = "failed"
+        budget["requests"] += sent_requests - sent_before
+        refresh_store.changed()
+        count(f"refresh_all_{result}")
+    refresh_store.flush()
+
+
+if __name__ == "__main__":
+    if FETCH_REFRESH:
+        refresh_all()
+    else:
+        fetch_all()
@@ -0,0 +1,198 @@
+import collections
+import itertools
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from cbz_store import get_entry_archive
+from json_store import write_json
+from log_setup import log
+from naming import clean_directory_name, do_slugify
+from phash_index import HASH_SIZE, build_page_hashes, get_entry_pages, hamming
+
+BANDS = 4
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+PAGE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_PAGE_DISTANCE", BANDS - 1))
+MIN_SHARED_PAGES = int(os.getenv("NEAR_DUPLICATE_MIN_SHARED_PAGES", 3))
+MIN_SIMILARITY = float(os.getenv("NEAR_DUPLICATE_MIN_SIMILARITY", 0.8))
+# buckets shared by this many entries are blank/credit pages, not evidence of anything
+MAX_BUCKET_SIZE = int(os.getenv("NEAR_DUPLICATE_MAX_BUCKET_SIZE", 50))
+
+data_dir = Path.cwd() / "data"
+index_json = Path.cwd() / "index.json"
+near_duplicates_json = Path.cwd() / "near_duplicates.json"
+# pairs with the same title but pages that don't match, to look at by hand
+near_duplicate_titles_json = Path.cwd() / "near_duplicate_titles.json"
+
+
+def normalize_title(entry: str) -> str:
+    return do_slugify(clean_directory_name(entry))
+
+
+def get_page_similarity(hashes_a: List[int], hashes_b: List[int]) -> float:
+    """share of the smaller entry's pages that have a near-identical page in the other one"""
+    smaller, larger = sorted([hashes_a, hashes_b], key=len)
+    if not smaller:
+        return 0.0
+    matched = sum(
+        1
+        for page_hash in smaller
+        if any(hamming(page_hash, other) <= PAGE_DISTANCE for other in larger)
+    )
+    return matched / len(smaller)
+
+
+def get_lsh_candidates(page_hashes: Dict[str, List[int]]) -> Set[Tuple[str, str]]:
+    """entries sharing an exact band of at least MIN_SHARED_PAGES of their pages. with
+    PAGE_DISTANCE < BANDS any two near-identical pages share at least one band, unless
+    every band they share is in a bucket dropped for being larger than MAX_BUCKET_SIZE
+    """
+    band_mask = (1 << BAND_BITS) - 1
+    buckets: Dict[Tuple[int, int], Dict[str, Set[int]]] = collections.defaultdict(
+        lambda: collections.defaultdict(set)
+    )
+    for entry, hashes in page_hashes.items():
+        for page, page_hash in enumerate(hashes):
+            for band in range(BANDS):
+                key = (band, (page_hash >> (band * BAND_BITS)) & band_mask)
+                buckets[key][entry].add(page)
+
+    # entry pair -> pages of either entry that share a band with a page of the other
+    shared_pages: Dict[Tuple[str, str], Tuple[Set[int], Set[int]]] = {}
+    dropped = 0
+    for bucket in buckets.values():
+        if len(bucket) > MAX_BUCKET_SIZE:
+            dropped += 1
+            continue
+        for entry_a, entry_b in itertools.combinations(sorted(bucket), 2):
+            pages_a, pages_b = shared_pages.setdefault(
+                (entry_a, entry_b), (set(), set())
+            )
+            pages_a.update(bucket[entry_a])
+            pages_b.update(bucket[entry_b])
+    if dropped:
+        log.warning(
+            f"ignored {dropped} hash buckets shared by more than {MAX_BUCKET_SIZE} "
+            "entries, pages only matching through them aren't compared"
+        )
+    return set(
+        pair
+        for pair, (pages_a, pages_b) in shared_pages.items()
+        if min(len(pages_a), len(pages_b)) >= MIN_SHARED_PAGES
+    )
+
+
+def get_title_candidates(entries: List[str]) -> Set[Tuple[str, str]]:
+    by_title: Dict[str, List[str]] = collections.defaultdict(list)
+    for entry in entries:
+        by_title[normalize_title(entry.split("/", 1)[1])].append(entry)
+    return set(
+        pair
+        for title, title_entries in by_title.items()
+        if title
+        for pair in itertools.combinations(sorted(title_entries), 2)
+    )
+
+
+def get_entry_size(entry: str) -> int:
+    if archive := get_entry_archive(data_dir / entry):
+        return archive.stat().st_size
+    return sum(page.stat().st_size for page in get_entry_pages(data_dir / entry))
+
+
+def find_near_duplicates():
+    log.info("========== finding near-duplicate entries ==========")
+    with index_json.open(mode="r", encoding="utf-8") as f:
+        index_data: Dict[str, Dict[str, str]] = json.load(f)
+    urls = {
+        f"{artist}/{entry}": url
+        for artist, entries in index_data.items()
+        for entry, url in entries.items()
+    }
+
+    page_hashes = {
+        entry: hashes for entry, hashes in build_page_hashes().items() if entry in urls
+    }
+    lsh_candidates = get_lsh_candidates(page_hashes)
+    title_candidates = get_title_candidates(list(urls.keys()))
+    log.info(
+        f"{len(lsh_candidates)} page candidates, {len(title_candidates)} title candidates"
+    )
+
+    # only pairs whose pages match get grouped and count as reclaimable
+    pairs: List[Dict] = []
+    title_only_pairs: List[Dict] = []
+    for entry_a, entry_b in sorted(lsh_candidates | title_candidates):
+        similarity = get_page_similarity(
+            page_hashes.get(entry_a, []), page_hashes.get(entry_b, [])
+        )
+        reasons = []
+        if similarity >= MIN_SIMILARITY:
+            reasons.append("pages")
+        if (entry_a, entry_b) in title_candidates:
+            reasons.append("title")
+        pair = {
+            "a": entry_a,
+            "b": entry_b,
+            "similarity": round(similarity, 3),
+            "reasons": reasons,
+        }
+        if "pages" in reasons:
+            pairs.append(pair)
+        elif reasons:
+            title_only_pairs.append(pair)
+
+    parents: Dict[str, str] = {}
+
+    def find(entry: str) -> str:
+        while parents.get(entry, entry) != entry:
+            entry = parents[entry]
+        return entry
+
+    for pair in pairs:
+        parents[find(pair["a"])] = find(pair["b"])
+
+    groups: Dict[str, List[str]] = collections.defaultdict(list)
+    for entry in set(itertools.chain.from_iterable((p["a"], p["b"]) for p in pairs)):
+        groups[find(entry)].append(entry)
+
+    report = []
+    for group_entries in groups.values():
+        sizes = {entry: get_entry_size(entry) for entry in group_entries}
+        report.append(
+            {
+                "entries": [
+                    {
+                        "entry": entry,
+                        "url": urls[entry],
+                        "pages": len(page_hashes.get(entry, [])),
+                        "bytes": sizes[entry],
+                    }
+                    for entry in sorted(group_entries)
+                ],
+                "pairs": [
+                    pair
+                    for pair in pairs
+                    if pair["a"] in group_entries or pair["b"] in group_entries
+                ],
+                "reclaimable_bytes": sum(sizes.values()) - max(sizes.values()),
+            }
+        )
+    report.sort(key=lambda group: group["reclaimable_bytes"], reverse=True)
+
+    write_json(near_duplicates_json, report)
+    write_json(near_duplicate_titles_json, title_only_pairs)
+    reclaimable = sum(group["reclaimable_bytes"] for group in report)
+    log.info(
+        f"found {len(report)} candidate groups, {reclaimable / 1024 / 1024:.1f} MiB reclaimable"
+    )
+    if title_only_pairs:
+        log.info(
+            f"{len(title_only_pairs)} pairs only share a title, "
+            f"listed in {near_duplicate_titles_json.name}"
+        )
+
+
+if __name__ == "__main__":
+    find_near_duplicates()
@@ -0,0 +1,246 @@
+import html
+import io
+import os
+import random
+import re
+import zipfile
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from log_setup import log
+
+FIXTURE_HOST = os.getenv("FIXTURE_HOST", "127.0.0.1")
+FIXTURE_PORT = int(os.getenv("FIXTURE_PORT", 8091))
+FIXTURE_FAVORITES = int(os.getenv("FIXTURE_FAVORITES", 60))
+FIXTURE_PER_PAGE = int(os.getenv("FIXTURE_PER_PAGE", 24))
+FIXTURE_PAGES = int(os.getenv("FIXTURE_PAGES", 20))
+# every response is held back this long
+FIXTURE_LATENCY_MS = float(os.getenv("FIXTURE_LATENCY_MS", 30))
+# how long the download modal "prepares" an archive before the download starts
+FIXTURE_PREPARE_MS = int(os.getenv("FIXTURE_PREPARE_MS", 300))
+# favorites pages only render their feed client-side, like the live site sometimes does
+FIXTURE_CLIENT_RENDERED = (
+    os.getenv("FIXTURE_CLIENT_RENDERED", "false").lower() == "true"
+)
+FIXTURE_SEED = int(os.getenv("FIXTURE_SEED", 0))
+GALLERY_PATTERN = re.compile(r"^/g/(\d+)/(\w+)$")
+DOWNLOAD_PATTERN = re.compile(r"^/download/(\d+)\.cbz$")
+
+PAGE_TEMPLATE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>
+.hidden {{ display: none; }}
+#modal {{ position: fixed; top: 20%; left: 20%; background: #fff; }}
+</style></head>
+<body><div id="main">{body}</div>
+<section id="downloader"><main></main></section>
+{script}</body></html>"""
+
+# the download modal of a gallery: "Original" closes it, the downloader shows an
+# article while the archive is prepared, then the download starts and it's empty again
+GALLERY_SCRIPT = """<script>
+const modal = document.getElementById("modal");
+document.querySelector("#actions > button[title='Download']").onclick = () => {
+  modal.classList.remove("hidden");
+};
+document.querySelector("#downloads > button[title='Original']").onclick = () => {
+  modal.classList.add("hidden");
+  const downloader = document.querySelector("#downloader main");
+  const article = document.createElement("article");
+  article.textContent = "preparing";
+  downloader.appendChild(article);
+  setTimeout(() => {
+    const link = document.createElement("a");
+    link.href = "%(download)s";
+    link.download = "";
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
+    article.remove();
+  }, %(prepare)d);
+};
+</script>"""
+
+# moves the feed out of a template after load, so the html fetched by
+# fetch_favorite_pages() doesn't contain it where the selector looks
+CLIENT_RENDER_SCRIPT = """<script>
+window.addEventListener("load", () => {
+  document.querySelector("#main > .feed > main").innerHTML =
+    document.getElementById("feed").innerHTML;
+});
+</script>"""
+
+
+@lru_cache(maxsize=None)
+def get_favorites() -> List[Dict[str, Any]]:
+    rng = random.Random(FIXTURE_SEED)
+    favorites = []
+    for n in range(FIXTURE_FAVORITES):
+        artist = f"Fixture Artist {n % 10:02}"
+        title = f"Fixture Title {n:04}"
+        favorites.append(
+            {
+                "id": n + 1,
+                "key": f"{rng.getrandbits(40):010x}",
+                "artist": artist,
+                "title": title,
+                "archive_name": f"[{artist}] {title} {{fixture}}",
+            }
+        )
+    return favorites
+
+
+@lru_cache(maxsize=None)
+def get_page_bytes() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 90), (200, 200, 200)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=256)
+def get_archive(favorite_id: int) -> bytes:
+    """a stored cbz, trailing bytes keep its pages unique"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip:
+        for page in range(1, FIXTURE_PAGES + 1):
+            zip.writestr(
+                f"{page:03}.jpg", get_page_bytes() + f"{favorite_id}/{page}".encode()
+            )
+    return buffer.getvalue()
+
+
+def get_last_page() -> int:
+    return max(1, -(-len(get_favorites()) // FIXTURE_PER_PAGE))
+
+
+def render_favorite(favorite: Dict[str, Any]) -> str:
+    title = html.escape(favorite["title"])
+    artist = html.escape(favorite["artist"])
+    return (
+        f'<article><a href="/g/{favorite["id"]}/{favorite["key"]}" aria-label="{title}">'
+        f'<img alt="{title}"></a>'
+        f'<div><a href="/?artist={artist}" data-namespace="1">{artist}</a></div></article>'
+    )
+
+
+def render_favorites(page: int) -> str:
+    favorites = get_favorites()[(page - 1) * FIXTURE_PER_PAGE : page * FIXTURE_PER_PAGE]
+    articles = "".join(render_favorite(favorite) for favorite in favorites)
+    last_page = get_last_page()
+    footer = (
+        f'<footer><nav><a href="/favorites?page={last_page}" title="Go to last page">'
+        f"{last_page}</a></nav></footer>"
+    )
+    if FIXTURE_CLIENT_RENDERED:
+        feed = f"<main></main>{footer}"
+        script = f'<template id="feed">{articles}</template>{CLIENT_RENDER_SCRIPT}'
+    else:
+        feed = f"<main>{articles}</main>{footer}"
+        script = ""
+    return PAGE_TEMPLATE.format(
+        title=f"favorites {page}", body=f'<div class="feed">{feed}</div>', script=script
+    )
+
+
+def render_gallery(favorite: Dict[str, Any]) -> str:
+    body = f"""<div id="gallery">
+<div id="metadata"><header><h2>{html.escape(favorite['title'])}</h2>
+<span class="s">{html.escape(favorite['archive_name'])}</span></header></div>
+<div id="actions"><button title="Download">Download</button></div>
+</div>
+<div id="modal" class="hidden"><div id="downloads">
+<button title="Original">Original</button><button title="Resampled">Resampled</button>
+</div></div>"""
+    script = GALLERY_SCRIPT % {
+        "download": f"/download/{favorite['id']}.cbz",
+        "prepare": FIXTURE_PREPARE_MS,
+    }
+    return PAGE_TEMPLATE.format(
+        title=html.escape(favorite["title"]), body=body, script=script
+    )
+
+
+def get_response(
+    path: str, query: Dict[str, List[str]]
+) -> Tuple[int, Dict[str, str], bytes]:
+    html_type = {"Content-Type": "text/html; charset=utf-8"}
+    if path == "/":
+        return (
+            200,
+            html_type,
+            PAGE_TEMPLATE.format(title="home", body="", script="").encode(),
+        )
+    if path == "/favorites":
+        page = int(query.get("page", ["1"])[0])
+        if 1 <= page <= get_last_page():
+            return 200, html_type, render_favorites(page).encode()
+    if m := GALLERY_PATTERN.match(path):
+        favorite_id, key = int(m.group(1)), m.group(2)
+        favorites = get_favorites()
+        if (
+            0 < favorite_id <= len(favorites)
+            and favorites[favorite_id - 1]["key"] == key
+        ):
+            return 200, html_type, render_gallery(favorites[favorite_id - 1]).encode()
+    if m := DOWNLOAD_PATTERN.match(path):
+        favorite_id = int(m.group(1))
+        if 0 < favorite_id <= len(get_favorites()):
+            return (
+                200,
+                {
+                    "Content-Type": "application/vnd.comicbook+zip",
+                    "Content-Disposition": f'attachment; filename="{favorite_id}.cbz"',
+                },
+                get_archive(favorite_id),
+            )
+    return 404, html_type, b"<html><body>not found</body></html>"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any):
+        log.debug(format % args)
+
+    def do_GET(self):
+        split = urlsplit(self.path)
+        sleep(FIXTURE_LATENCY_MS / 1000)
+        status, headers, body = get_response(split.path, parse_qs(split.query))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(
+    host: str = FIXTURE_HOST, port: int = FIXTURE_PORT
+) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve():
+    server = make_server()
+    host, port = server.server_address[:2]
+    log.info(
+        f"serving {len(get_favorites())} favorites on {get_last_page()} pages, "
+        f"BASE_URL=http://{host}:{port}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,137 @@
+import atexit
+import json
+import os
+import sys
+from pathlib import Path
+from time import monotonic
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FLUSH_EVERY = int(os.getenv("JSON_FLUSH_EVERY", 50))
+FLUSH_INTERVAL = float(os.getenv("JSON_FLUSH_INTERVAL", 5))
+
+
+def dumps_json(obj: Any, sort_keys: bool = False) -> bytes:
+    """same bytes as json.dump(indent=2, ensure_ascii=False) plus a trailing newline"""
+    if orjson:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option)
+    return (
+        json.dumps(obj, indent=2, ensure_ascii=False, sort_keys=sort_keys) + "\n"
+    ).encode("utf-8")
+
+
+def intern_strings(obj: Any) -> Any:
+    """the same urls, artists and entry names show up in every state file,
+    interning them makes all the loaded copies share one string object"""
+    if isinstance(obj, str):
+        return sys.intern(obj)
+    if isinstance(obj, dict):
+        return {sys.intern(key): intern_strings(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [intern_strings(value) for value in obj]
+    return obj
+
+
+def read_json(path: Path, default: Any = None, intern: bool = False) -> Any:
+    if default is not None and not path.exists():
+        return default
+    with path.open("rb") as f:
+        obj = orjson.loads(f.read()) if orjson else json.load(f)
+    return intern_strings(obj) if intern else obj
+
+
+def write_json(
+    path: Path, obj: Any, sort_keys: bool = False, sort_by_value: bool = False
+):
+    """writes to a temp file first so a crash never leaves a half-written file behind"""
+    if sort_by_value:
+        obj = dict(sorted(obj.items(), key=lambda item: item[1]))
+    data = dumps_json(obj, sort_keys=sort_keys)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonStore:
+    """a json file kept in memory, written back after several changes or some time,
+    and once more at exit. the file is only read on first access to `data`"""
+
+    def __init__(
+        self,
+        path: Path,
+        default: Any = None,
+        sort_keys: bool = False,
+        sort_by_value: bool = False,
+        flush_every: int = FLUSH_EVERY,
+        flush_interval: float = FLUSH_INTERVAL,
+        intern: bool = True,
+    ):
+        self.path = path
+        self.default = default
+        self.intern = intern
+        self._data: Any = None
+        self.sort_keys = sort_keys
+        self.sort_by_value = sort_by_value
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending_changes = 0
+        self.last_flush = monotonic()
+        # mtime of the file as last read or written here, to notice other writers
+        self.mtime: Union[int, None] = None
+        atexit.register(self.flush)
+
+    def get_mtime(self) -> Union[int, None]:
+        return self.path.stat().st_mtime_ns if self.path.exists() else None
+
+    @property
+    def data(self) -> Any:
+        if self._data is None:
+            self.mtime = self.get_mtime()
+            self._data = read_json(self.path, self.default, intern=self.intern)
+        return self._data
+
+    @data.setter
+    def data(self, data: Any):
+        self._data = data
+
+    def changed(self):
+        self.pending_changes += 1
+        if (
+            self.pending_changes >= self.flush_every
+            or monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.pending_changes:
+            write_json(
+                self.path,
+                self.data,
+                sort_keys=self.sort_keys,
+                sort_by_value=self.sort_by_value,
+            )
+            self.mtime = self.get_mtime()
+            self.pending_changes = 0
+        self.last_flush = monotonic()
+
+    def reload(self):
+        """reads the file again when another process wrote it since, into the same
+        dict so every reference to `data` sees it. skipped with unflushed changes"""
+        if self._data is None or self.pending_changes:
+            return
+        mtime = self.get_mtime()
+        if mtime == self.mtime:
+            return
+        self._data.clear()
+        self._data.update(read_json(self.path, self.default or {}, intern=self.intern))
+        self.mtime = mtime
@@ -7,6 +7,9 @@ from typing import Dict, List
 import requests
 from bs4 import BeautifulSoup
 
+# run from the repo root: python -m legacy.process_favorites
+from json_store import JsonStore
+
 URL_PATTERN = re.compile(r"https:\/\/ksk\.moe\/view\/(.*)")
 N_RESULTS_PATTERN = re.compile(r"Found (.*) result")
 FAVORITE_STATUS_INDICATOR = "unfavorite"
@@ -29,30 +32,24 @@ entries = (
 
 
 def add_missing_favorites():
+    favorited_store = JsonStore(favorited_json, sort_by_value=True)
+    favorited_data: Dict[str, str] = favorited_store.data
     for artist, entry, url in entries:
-        with favorited_json.open("r+", encoding="utf-8") as f:
-            favorited_data: Dict[str, str] = json.load(f)
-            if url in favorited_data.keys():
-                # print(f"not adding {artist}/{entry} already in favorites")
-                pass
-            else:
-                print(f"adding {artist}/{entry} to favorites")
-                partial_url = URL_PATTERN.match(url).group(1)
-                response = requests.post(
-                    f"https://ksk.moe/favorite/{partial_url}",
-                    headers={"cookie": cookies},
-                )
-                if response.status_code != 200:
-                    raise Exception("what!?")
-                favorited_data[url] = f"{artist}/{entry}"
-                # sorting by value
-                favorited_data = dict(
-                    sorted(favorited_data.items(), key=lambda item: item[1])
-                )
-                f.seek(0)
-                json.dump(obj=favorited_data, fp=f, indent=2, ensure_ascii=False)
-                f.write("\n")
-                f.truncate()
+        if url in favorited_data.keys():
+            # print(f"not adding {artist}/{entry} already in favorites")
+            pass
+        else:
+            print(f"adding {artist}/{entry} to favorites")
+            partial_url = URL_PATTERN.match(url).group(1)
+            response = requests.post(
+                f"https://ksk.moe/favorite/{partial_url}",
+                headers={"cookie": cookies},
+            )
+            if response.status_code != 200:
+                raise Exception("what!?")
+            favorited_data[url] = f"{artist}/{entry}"
+            favorited_store.changed()
+    favorited_store.flush()
 
 
 def find_weirdness():
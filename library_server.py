@@ -0,0 +1,510 @@
+import asyncio
+import html
+import json
+import mimetypes
+import os
+import re
+import threading
+from collections import defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple, Union
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from cbz_store import (
+    METADATA_MEMBER,
+    get_archive_pages,
+    get_entry_archive,
+    get_member_region,
+    has_member,
+    is_normalized,
+    read_member,
+    split_archive_path,
+)
+from json_store import dumps_json, read_json
+from log_setup import log
+from phash_index import IMAGE_SUFFIXES, get_entry_pages
+from state import load_index
+from thumbnail_cache import evict, get_thumbnail, save_thumbnails
+
+LIBRARY_HOST = os.getenv("LIBRARY_HOST", "0.0.0.0")
+LIBRARY_PORT = int(os.getenv("LIBRARY_PORT", 8080))
+# pages after the requested one that get read ahead into the page cache
+PREFETCH_PAGES = int(os.getenv("PREFETCH_PAGES", 4))
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", 100))
+# seconds after a thumbnail cache miss before thumbnails.json is saved and the cache
+# evicted, so a page of new thumbnails costs one save
+THUMBNAIL_SAVE_DELAY = float(os.getenv("THUMBNAIL_SAVE_DELAY", 30))
+MAX_HEADER_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+WORD_PATTERN = re.compile(r"\w+")
+
+data_dir = Path.cwd() / "data"
+library_dir = data_dir.resolve()
+db_json = Path.cwd() / "db.json"
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+
+class MetadataIndex:
+    """the metadata db held in memory with inverted indexes for the search endpoint,
+    rebuilt whenever db.json changes"""
+
+    FIELDS = ["artists", "tags", "parodies", "circles", "category"]
+
+    def __init__(self):
+        self.mtime_ns = None
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.fields: Dict[str, Dict[str, Set[str]]] = {}
+        self.words: Dict[str, Set[str]] = {}
+        # entries with pages to take a thumbnail from, so results need no glob
+        self.with_pages: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """runs in an executor, the indexes are built aside and swapped in at once so
+        searches on the event loop never see them half built"""
+        with self.lock:
+            mtime_ns = db_json.stat().st_mtime_ns if db_json.exists() else None
+            if mtime_ns == self.mtime_ns:
+                return
+            documents: Dict[str, Dict[str, Any]] = {}
+            fields: Dict[str, Dict[str, Set[str]]] = {
+                field: defaultdict(set) for field in self.FIELDS
+            }
+            words: Dict[str, Set[str]] = defaultdict(set)
+            for document in read_json(db_json, {}).get("_default", {}).values():
+                entry = "/".join(Path(document["json_path"]).parts[:-1])
+                documents[entry] = document
+                for field in self.FIELDS:
+                    values = document.get(field) or []
+                    for value in [values] if isinstance(values, str) else values:
+                        fields[field][value.lower()].add(entry)
+                for word in WORD_PATTERN.findall((document.get("title") or "").lower()):
+                    words[word].add(entry)
+            with_pages = set(
+                entry for entry in documents.keys() if has_pages(library_dir / entry)
+            )
+            self.documents, self.fields, self.words = documents, fields, words
+            self.with_pages = with_pages
+            self.mtime_ns = mtime_ns
+            log.info(f"indexed metadata of {len(self.documents)} entries")
+
+    def search(self, query: Dict[str, List[str]]) -> List[str]:
+        matches: Union[Set[str], None] = None
+        for word in WORD_PATTERN.findall(" ".join(query.get("q", [])).lower()):
+            found = self.words.get(word, set())
+            matches = found if matches is None else matches & found
+        for field in self.FIELDS:
+            for value in query.get(field.rstrip("s"), []) + query.get(field, []):
+                found = self.fields[field].get(value.lower(), set())
+                matches = found if matches is None else matches & found
+        if matches is None:
+            matches = set(self.documents.keys())
+        return sorted(matches)
+
+    def summary(self, entry: str) -> Dict[str, Any]:
+        document = self.documents[entry]
+        return {
+            "entry": entry,
+            "title": document.get("title"),
+            "artists": document.get("artists"),
+            "tags": document.get("tags"),
+            "pages": document.get("pages"),
+            "thumbnail": (
+                f"/thumbnail/{quote(entry)}" if entry in self.with_pages else None
+            ),
+        }
+
+
+metadata_index = MetadataIndex()
+# entry path -> (mtime of the entry directory or archive, its pages relative to
+# data_dir). pages of entry archives are paths below the archive
+page_paths_cache: Dict[Path, Tuple[int, List[str]]] = {}
+
+
+def get_page_paths(entry_path: Path) -> List[str]:
+    archive = None if entry_path.is_dir() else get_entry_archive(entry_path)
+    if not archive and not entry_path.is_dir():
+        return []
+    mtime_ns = (archive or entry_path).stat().st_mtime_ns
+    cached = page_paths_cache.get(entry_path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+    if archive:
+        archive_path = archive.relative_to(library_dir).as_posix()
+        page_paths = [f"{archive_path}/{name}" for name in get_archive_pages(archive)]
+    else:
+        page_paths = [
+            page.relative_to(library_dir).as_posix()
+            for page in get_entry_pages(entry_path)
+        ]
+    page_paths_cache[entry_path] = (mtime_ns, page_paths)
+    return page_paths
+
+
+def has_pages(entry_path: Path) -> bool:
+    """stops at the first page instead of listing all of them"""
+    if entry_path.is_dir():
+        return any(page.suffix in IMAGE_SUFFIXES for page in entry_path.glob("**/*"))
+    archive = get_entry_archive(entry_path)
+    return bool(archive and get_archive_pages(archive))
+
+
+def read_entry_metadata(entry_path: Path) -> Union[Dict[str, Any], None]:
+    metadata_json = entry_path / "metadata.json"
+    if metadata_json.exists():
+        return read_json(metadata_json)
+    archive = get_entry_archive(entry_path)
+    if archive and has_member(archive, METADATA_MEMBER):
+        return json.loads(read_member(archive, METADATA_MEMBER))
+    return None
+
+
+def resolve_data_path(path: str) -> Union[Path, None]:
+    """a path below data_dir, never one outside of it. the path is already unquoted"""
+    resolved = (library_dir / path).resolve()
+    if resolved != library_dir and library_dir not in resolved.parents:
+        return None
+    return resolved
+
+
+def get_etag(stat: os.stat_result, offset: int = 0) -> str:
+    """archive members add their offset to the etag of the archive"""
+    member = f"-{offset:x}" if offset else ""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}{member}"'
+
+
+def prefetch(paths: List[Path]):
+    """asks the os to read the next pages ahead, or reads them when it can't be asked"""
+    for path in paths:
+        try:
+            with path.open("rb") as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while f.read(CHUNK_SIZE):
+                        pass
+        except OSError as err:
+            log.debug(f"could not prefetch {path}: {err}")
+
+
+thumbnail_save: Union[asyncio.TimerHandle, None] = None
+
+
+def save_thumbnail_cache():
+    save_thumbnails(prune=False)
+    evict()
+
+
+def run_thumbnail_save():
+    global thumbnail_save
+    thumbnail_save = None
+    asyncio.get_running_loop().run_in_executor(None, save_thumbnail_cache)
+
+
+def schedule_thumbnail_save():
+    global thumbnail_save
+    if thumbnail_save is None:
+        thumbnail_save = asyncio.get_running_loop().call_later(
+            THUMBNAIL_SAVE_DELAY, run_thumbnail_save
+        )
+
+
+def prefetch_following(page: Path):
+    """runs in an executor, listing the entry's pages is a glob"""
+    if library_dir not in page.parents:
+        return
+    parts = page.relative_to(library_dir).parts
+    if len(parts) < 3:
+        return
+    page_paths = get_page_paths(library_dir / parts[0] / parts[1])
+    page_path = "/".join(parts)
+    if page_path not in page_paths:
+        return
+    i = page_paths.index(page_path)
+    prefetch([library_dir / p for p in page_paths[i + 1 : i + 1 + PREFETCH_PAGES]])
+
+
+class Request:
+    def __init__(self, method: str, target: str, headers: Dict[str, str]):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.headers = headers
+
+
+async def read_request(reader: asyncio.StreamReader) -> Union[Request, None]:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return Request(parts[0], parts[1], headers)
+
+
+async def send_head(
+    writer: asyncio.StreamWriter, status: int, headers: Dict[str, Union[str, int]]
+):
+    lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+
+async def send_body(
+    writer: asyncio.StreamWriter,
+    request: Request,
+    status: int,
+    body: bytes,
+    content_type: str,
+):
+    await send_head(
+        writer, status, {"Content-Type": content_type, "Content-Length": len(body)}
+    )
+    if request.method != "HEAD":
+        writer.write(body)
+        await writer.drain()
+
+
+async def send_json(writer: asyncio.StreamWriter, request: Request, obj: Any):
+    await send_body(writer, request, 200, dumps_json(obj), "application/json")
+
+
+async def send_error(writer: asyncio.StreamWriter, request: Request, status: int):
+    await send_body(
+        writer, request, status, REASONS[status].encode(), "text/plain; charset=utf-8"
+    )
+
+
+async def send_file(
+    writer: asyncio.StreamWriter,
+    request: Request,
+    path: Path,
+    member: Union[str, None] = None,
+):
+    """a file, or a member of a normalized archive, which is stored as is and can be
+    sent straight from its offset in the archive"""
+    stat = path.stat()
+    offset, size = get_member_region(path, member) if member else (0, stat.st_size)
+    etag = get_etag(stat, offset)
+    headers: Dict[str, Union[str, int]] = {
+        "Content-Type": mimetypes.guess_type(member or path.name)[0]
+        or "application/octet-stream",
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": "max-age=3600",
+    }
+
+    if if_none_match := request.headers.get("if-none-match"):
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or (
+            if_none_match == "*"
+        ):
+            await send_head(writer, 304, headers)
+            return
+    elif if_modified_since := request.headers.get("if-modified-since"):
+        try:
+            if (
+                int(stat.st_mtime)
+                <= parsedate_to_datetime(if_modified_since).timestamp()
+            ):
+                await send_head(writer, 304, headers)
+                return
+        except (TypeError, ValueError):
+            pass
+
+    status, start, end = 200, 0, size - 1
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        m = RANGE_PATTERN.match(range_header)
+        if not m or not (m.group(1) or m.group(2)):
+            headers["Content-Range"] = f"bytes */{size}"
+            await send_head(writer, 416, {**headers, "Content-Length": 0})
+            return
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), end) if m.group(2) else end
+        else:
+            start = max(size - int(m.group(2)), 0)
+        if start > end:
+            headers["Content-Range"] = f"bytes */{size}"
+            await send_head(writer, 416, {**headers, "Content-Length": 0})
+            return
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = end - start + 1
+    await send_head(writer, status, headers)
+    # sendfile refuses a count of 0, and an empty file has no body anyway
+    if request.method == "HEAD" or end < start:
+        return
+    with path.open("rb") as f:
+        await asyncio.get_running_loop().sendfile(
+            writer.transport, f, offset + start, end - start + 1
+        )
+    asyncio.get_running_loop().run_in_executor(None, prefetch_following, path)
+
+
+def render_reader(entry: str, page_paths: List[str]) -> bytes:
+    images = "\n".join(
+        f'<img src="/data/{quote(page)}" loading="lazy" alt="{html.escape(page)}">'
+        for page in page_paths
+    )
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(entry)}</title>
+<style>body {{ margin: 0; background: #111; }} img {{ display: block; max-width: 100%; margin: 0 auto; }}</style>
+</head>
+<body>
+{images}
+</body>
+</html>
+""".encode("utf-8")
+
+
+async def handle_request(writer: asyncio.StreamWriter, request: Request):
+    if request.method not in ["GET", "HEAD"]:
+        await send_error(writer, request, 405)
+        return
+    route, _, rest = request.path.lstrip("/").partition("/")
+
+    if route == "data":
+        path = resolve_data_path(unquote(rest))
+        if path and path.is_file():
+            await send_file(writer, request, path)
+            return
+        archive_member = split_archive_path(path) if path else None
+        if not archive_member or not has_member(*archive_member):
+            await send_error(writer, request, 404)
+            return
+        archive, name = archive_member
+        # STORAGE_MODE=cbz only keeps normalized archives, their members are stored
+        if not is_normalized(archive):
+            log.warning(f"{archive} isn't normalized, not serving its pages")
+            await send_error(writer, request, 404)
+            return
+        await send_file(writer, request, archive, name)
+
+    elif route == "thumbnail":
+        entry_path = resolve_data_path(unquote(rest))
+        if not entry_path or not (entry_path.is_dir() or get_entry_archive(entry_path)):
+            await send_error(writer, request, 404)
+            return
+        thumbnail = await asyncio.get_running_loop().run_in_executor(
+            None, get_thumbnail, data_dir / entry_path.relative_to(library_dir)
+        )
+        if not thumbnail:
+            await send_error(writer, request, 404)
+            return
+        schedule_thumbnail_save()
+        await send_file(writer, request, thumbnail)
+
+    elif route == "api" and rest == "artists":
+        await send_json(
+            writer,
+            request,
+            {artist: len(entries) for artist, entries in sorted(load_index().items())},
+        )
+
+    elif route == "api" and rest.startswith("entries/"):
+        artist = unquote(rest[len("entries/") :])
+        await send_json(writer, request, sorted(load_index().get(artist, {}).keys()))
+
+    elif route in ["api", "read"] and (route == "read" or rest.startswith("entry/")):
+        entry = unquote(rest if route == "read" else rest[len("entry/") :])
+        entry_path = resolve_data_path(entry)
+        if not entry_path or not (entry_path.is_dir() or get_entry_archive(entry_path)):
+            await send_error(writer, request, 404)
+            return
+        page_paths = await asyncio.get_running_loop().run_in_executor(
+            None, get_page_paths, entry_path
+        )
+        if route == "read":
+            body = render_reader(entry, page_paths)
+            await send_body(writer, request, 200, body, "text/html; charset=utf-8")
+            return
+        await send_json(
+            writer,
+            request,
+            {
+                "entry": entry,
+                "metadata": read_entry_metadata(entry_path),
+                "pages": [f"/data/{quote(page)}" for page in page_paths],
+            },
+        )
+
+    elif route == "api" and rest == "search":
+        await asyncio.get_running_loop().run_in_executor(None, metadata_index.refresh)
+        matches = metadata_index.search(request.query)
+        limit = int(request.query.get("limit", [SEARCH_LIMIT])[0])
+        offset = int(request.query.get("offset", [0])[0])
+        await send_json(
+            writer,
+            request,
+            {
+                "total": len(matches),
+                "results": [
+                    metadata_index.summary(entry)
+                    for entry in matches[offset : offset + limit]
+                ],
+            },
+        )
+
+    else:
+        await send_error(writer, request, 404)
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while request := await read_request(reader):
+            try:
+                await handle_request(writer, request)
+            except (ValueError, OSError) as err:
+                if isinstance(err, ConnectionError):
+                    raise
+                log.warning(f"{request.method} {request.path}: {err}")
+                await send_error(writer, request, 400)
+            if request.headers.get("connection", "").lower() == "close":
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve():
+    metadata_index.refresh()
+    server = await asyncio.start_server(
+        handle_connection, LIBRARY_HOST, LIBRARY_PORT, limit=MAX_HEADER_SIZE
+    )
+    log.info(f"serving {data_dir} on http://{LIBRARY_HOST}:{LIBRARY_PORT}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        save_thumbnails(prune=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
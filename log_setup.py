@@ -1,17 +1,62 @@
+import atexit
+import cProfile
+import io
+import json
 import logging
 import os
+import pstats
+import queue
 import sys
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from time import sleep
-from typing import Any, Callable, Tuple, Union
+from time import monotonic, perf_counter
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlparse
 
-import undetected_chromedriver as uc
-from dotenv import load_dotenv
-from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.remote.webelement import WebElement
-from selenium.webdriver.support import expected_conditions
-from selenium.webdriver.support.wait import WebDriverWait
+# hands records to a background thread, so writing them never blocks the caller
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() == "true"
+# optional log file next to stdout, rotated once it reaches LOG_FILE_MAX_MB
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_MB", 10)) * 1024 * 1024
+LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", 5))
+# how often a running summary of per-file events gets logged
+LOG_EVENT_INTERVAL = float(os.getenv("LOG_EVENT_INTERVAL", 5))
+
+# prints a table of stage timings and counters at exit
+METRICS_SUMMARY = os.getenv("METRICS_SUMMARY", "true").lower() == "true"
+# optional files the same numbers get written to, for comparing runs
+METRICS_JSON = os.getenv("METRICS_JSON", "")
+METRICS_PROM = os.getenv("METRICS_PROM", "")
+
+
+def pop_flag(flag: str) -> Union[str, None]:
+    """removes --flag or --flag=value from the command line, "" or value if it was there"""
+    for arg in sys.argv[1:]:
+        if arg == flag or arg.startswith(f"{flag}="):
+            sys.argv.remove(arg)
+            return arg.partition("=")[2]
+    return None
+
+
+# "cprofile": deterministic profile of the main thread, "sample": stacks of the main
+# thread every PROFILE_INTERVAL seconds, as folded stacks for flamegraph tools.
+# also switched on by --profile[=sample]
+profile_flag = pop_flag("--profile")
+PROFILE = os.getenv("PROFILE", "")
+if profile_flag is not None:
+    PROFILE = profile_flag or "cprofile"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+# tracemalloc snapshots and per-stage peaks, also switched on by --profile-memory
+PROFILE_MEMORY = (
+    os.getenv("PROFILE_MEMORY", "false").lower() == "true"
+    or pop_flag("--profile-memory") is not None
+)
+PROFILE_MEMORY_FRAMES = int(os.getenv("PROFILE_MEMORY_FRAMES", 10))
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -22,4 +67,285 @@ formatter = logging.Formatter(
     "%Y-%m-%d %H:%M:%S",
 )
 handler.setFormatter(formatter)
-log.addHandler(handler)
+handlers: List[logging.Handler] = [handler]
+if LOG_FILE:
+    file_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=LOG_FILE_MAX_BYTES,
+        backupCount=LOG_FILE_BACKUPS,
+        encoding="utf-8",
+    )
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+if LOG_QUEUE:
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    log.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+else:
+    for h in handlers:
+        log.addHandler(h)
+
+# summary template -> {"groups": Counter of events per group, "logged": last time it was logged}
+events: Dict[str, Dict] = {}
+# events and the metrics below are added to from worker threads
+events_lock = threading.Lock()
+
+
+def log_event(summary: str, group: str, message: str):
+    """a per-file event: only logged on its own at debug level, otherwise counted into
+    summary, e.g. "renamed {count} pages in {groups} entries", which gets logged every
+    LOG_EVENT_INTERVAL seconds and by flush_events()"""
+    log.debug(message)
+    with events_lock:
+        event = events.setdefault(summary, {"groups": Counter(), "logged": monotonic()})
+        event["groups"][group] += 1
+        if monotonic() - event["logged"] >= LOG_EVENT_INTERVAL:
+            log_summary(summary, "so far")
+            event["logged"] = monotonic()
+
+
+def log_summary(summary: str, suffix: str = ""):
+    """only called with events_lock held"""
+    groups = events[summary]["groups"]
+    message = summary.format(count=sum(groups.values()), groups=len(groups))
+    log.info(f"{message} {suffix}".strip())
+
+
+def flush_events():
+    with events_lock:
+        for summary in list(events.keys()):
+            log_summary(summary)
+            del events[summary]
+
+
+# (metric name, host or "") -> samples, durations in seconds for timed().
+# a counter named "<stage>_<unit>" also gets a rate over the time spent in timed("<stage>")
+histograms: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+counters: Dict[Tuple[str, str], float] = Counter()
+metrics_lock = threading.Lock()
+started = perf_counter()
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+@contextmanager
+def timed(name: str, host: str = ""):
+    """times a block, or a whole function when used as a decorator. while tracing
+    memory, top-level blocks also get their peak allocation recorded"""
+    depth = getattr(stage_state, "depth", 0)
+    top_level = tracemalloc.is_tracing() and depth == 0
+    if top_level:
+        tracemalloc.reset_peak()
+    stage_state.depth = depth + 1
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, host)
+        stage_state.depth = depth
+        if top_level and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            stage_memory_peaks[name] = max(stage_memory_peaks.get(name, 0), peak)
+
+
+def count(name: str, value: float = 1, host: str = ""):
+    with metrics_lock:
+        counters[(name, host)] += value
+
+
+def observe(name: str, value: float, host: str = ""):
+    with metrics_lock:
+        histograms[(name, host)].append(value)
+
+
+def get_snapshot() -> Tuple[Dict, Dict]:
+    """sorted copies of histograms and counters, taken while no thread adds to them"""
+    with metrics_lock:
+        return (
+            {key: sorted(samples) for key, samples in sorted(histograms.items())},
+            dict(sorted(counters.items())),
+        )
+
+
+def get_quantile(samples: List[float], q: float) -> float:
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+def get_metrics() -> Dict[str, Dict[str, Dict[str, float]]]:
+    metrics: Dict[str, Dict[str, Dict[str, float]]] = {
+        "histograms": {},
+        "counters": {},
+    }
+    histogram_samples, counter_values = get_snapshot()
+    for (name, host), samples in histogram_samples.items():
+        metrics["histograms"][f"{name}{{{host}}}" if host else name] = {
+            "count": len(samples),
+            "sum": sum(samples),
+            "p50": get_quantile(samples, 0.5),
+            "p95": get_quantile(samples, 0.95),
+            "p99": get_quantile(samples, 0.99),
+            "max": samples[-1],
+        }
+    for (name, host), value in counter_values.items():
+        counter = {"value": value}
+        if timed_samples := histogram_samples.get((name.rsplit("_", 1)[0], host)):
+            counter["per_second"] = value / (sum(timed_samples) or 1)
+        metrics["counters"][f"{name}{{{host}}}" if host else name] = counter
+    return metrics
+
+
+def get_prometheus_text() -> str:
+    script = Path(sys.argv[0]).stem
+
+    def labels(host: str, extra: str = "") -> str:
+        pairs = [f'script="{script}"', f'host="{host}"' if host else "", extra]
+        return f"{{{','.join(pair for pair in pairs if pair)}}}"
+
+    lines = []
+    histogram_samples, counter_values = get_snapshot()
+    for (name, host), samples in histogram_samples.items():
+        metric = f"library_{name}"
+        lines.append(f"# TYPE {metric} summary")
+        for q in [0.5, 0.95, 0.99]:
+            quantile = f'quantile="{q}"'
+            lines.append(f"{metric}{labels(host, quantile)} {get_quantile(samples, q)}")
+        lines.append(f"{metric}_sum{labels(host)} {sum(samples)}")
+        lines.append(f"{metric}_count{labels(host)} {len(samples)}")
+    for (name, host), value in counter_values.items():
+        metric = f"library_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{labels(host)} {value}")
+    lines.append(f"library_run_seconds{labels('')} {perf_counter() - started}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    if not histograms and not counters:
+        return
+    metrics = get_metrics()
+    if METRICS_SUMMARY:
+        log.info(f"========== run summary ({perf_counter() - started:.1f}s) ==========")
+        for name, h in metrics["histograms"].items():
+            log.info(
+                f"{name}: {h['count']}x, {h['sum']:.3f}s total, "
+                f"p50 {h['p50']:.3f}, p95 {h['p95']:.3f}, p99 {h['p99']:.3f}, "
+                f"max {h['max']:.3f}"
+            )
+        for name, c in metrics["counters"].items():
+            rate = f" ({c['per_second']:.1f}/s)" if "per_second" in c else ""
+            log.info(f"{name}: {c['value']:g}{rate}")
+    if METRICS_JSON:
+        with open(METRICS_JSON, "w", encoding="utf-8") as f:
+            json.dump({"run_seconds": perf_counter() - started, **metrics}, f, indent=2)
+            f.write("\n")
+    if METRICS_PROM:
+        # written next to the target first, node_exporter may read it any time
+        tmp_path = f"{METRICS_PROM}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(get_prometheus_text())
+        os.replace(tmp_path, METRICS_PROM)
+
+
+# profiles are written next to the log file, or to profiles/
+profile_dir = Path(
+    os.getenv("PROFILE_DIR", "")
+    or (Path(LOG_FILE).parent if LOG_FILE else Path.cwd() / "profiles")
+)
+profile_name = f"{Path(sys.argv[0]).stem}-{datetime.now():%Y%m%d-%H%M%S}"
+profiler: Union[cProfile.Profile, None] = None
+# folded stack -> times it was sampled
+stack_samples: Dict[str, int] = Counter()
+sampling_stopped = threading.Event()
+sampler: Union[threading.Thread, None] = None
+# top-level stage -> bytes allocated at its peak, only while tracing memory
+stage_memory_peaks: Dict[str, int] = {}
+# nesting depth of timed() blocks, per thread since executors time their own stages
+stage_state = threading.local()
+
+
+def get_frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_id: int):
+    while not sampling_stopped.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame:
+            stack.append(get_frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            stack_samples[";".join(reversed(stack))] += 1
+
+
+def start_profiling():
+    global profiler, sampler
+    if PROFILE == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif PROFILE == "sample":
+        sampler = threading.Thread(
+            target=sample_stacks,
+            args=(threading.main_thread().ident,),
+            name="stack-sampler",
+            daemon=True,
+        )
+        sampler.start()
+    elif PROFILE:
+        log.warning(f"unknown PROFILE {PROFILE}, use cprofile or sample")
+    if PROFILE_MEMORY:
+        tracemalloc.start(PROFILE_MEMORY_FRAMES)
+
+
+def stop_profiling():
+    if sampler:
+        # the sampler may be in the middle of adding a stack
+        sampling_stopped.set()
+        sampler.join()
+    if not (profiler or stack_samples or tracemalloc.is_tracing()):
+        return
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    profile_path = profile_dir / profile_name
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(f"{profile_path}.prof")
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(40)
+        Path(f"{profile_path}.txt").write_text(stream.getvalue(), encoding="utf-8")
+        log.info(f"wrote {profile_path}.prof, top functions in {profile_path}.txt")
+    if stack_samples:
+        with open(f"{profile_path}.folded", "w", encoding="utf-8") as f:
+            for stack, samples in sorted(stack_samples.items()):
+                f.write(f"{stack} {samples}\n")
+        log.info(
+            f"wrote {sum(stack_samples.values())} samples to {profile_path}.folded"
+        )
+    if tracemalloc.is_tracing():
+        _current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(f"{profile_path}.tracemalloc")
+        log.info(f"peak traced memory: {peak / 1024 / 1024:.1f} MiB")
+        for stage, stage_peak in stage_memory_peaks.items():
+            log.info(f"{stage}: peak {stage_peak / 1024 / 1024:.1f} MiB")
+        log.info("largest allocations still alive at exit:")
+        for stat in snapshot.statistics("lineno")[:10]:
+            log.info(f"  {stat}")
+        log.info(f"wrote {profile_path}.tracemalloc")
+
+
+def stop_logging():
+    stop_profiling()
+    flush_events()
+    write_metrics()
+    if LOG_QUEUE:
+        listener.stop()
+
+
+atexit.register(stop_logging)
+start_profiling()
@@ -0,0 +1,41 @@
+import re
+
+from slugify import slugify
+
+
+def do_slugify(s: str) -> str:
+    s = re.sub("’", "'", s)
+    s = re.sub("？", "", s)
+    s = re.sub("–", "-", s)
+    s = re.sub("&amp;", "-", s)
+    return slugify(
+        s,
+        replacements=[
+            ["'", ""],
+            ["❤", ""],
+            ["☆", ""],
+            ["&", ""],
+            ["♀", ""],
+            ["_", ""],
+            [".", ""],
+            [":", "-"],
+            ["꞉", "-"],
+            ["*", ""],
+            ["犬", ""],
+        ],
+    )
+
+
+def clean_directory_name(name: str):
+    ARTIST_NAME_PATTERN = r"^\[[^\]]*\]"
+    TAGS_PATTERN = r"\{[^\}]*\}$"
+    KOUSHOKU_PATTERN = r"\(koushoku\.org\)|\(ksk\.moe\)"
+    EXTRA_INFO_PATTERN = r"(?:\([^\)]*\)|\[[^\]]*\])(?:\s(?:\[.*\])*)*$"
+    new_name = re.sub(ARTIST_NAME_PATTERN, "", name)
+    new_name = re.sub(TAGS_PATTERN, "", new_name)
+    new_name = re.sub(KOUSHOKU_PATTERN, "", new_name)
+    new_name = re.sub("’", "'", new_name)
+    new_name = re.sub("？", "", new_name)
+    new_name = re.sub("–", "-", new_name)
+    new_name = re.sub(EXTRA_INFO_PATTERN, "", new_name)
+    return new_name.strip()
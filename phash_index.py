@@ -0,0 +1,303 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import IO, Any, Dict, List, Tuple, Union
+
+from PIL import Image
+
+from cbz_store import (
+    METADATA_MEMBER,
+    get_archive_pages,
+    get_entry_archive,
+    has_member,
+    is_normalized,
+    read_member,
+    split_archive_path,
+)
+from json_store import read_json, write_json
+from log_setup import log
+
+HASH_SIZE = 8
+MATCH_DISTANCE = int(os.getenv("PHASH_MATCH_DISTANCE", 10))
+WORKERS = int(os.getenv("PHASH_WORKERS", os.cpu_count() or 1))
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".webp"]
+# what a truncated, corrupt or unsupported page raises while decoding
+DECODE_ERRORS = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
+
+data_dir = Path.cwd() / "data"
+index_json = Path.cwd() / "index.json"
+phash_index_json = Path.cwd() / "phash_index.json"
+page_hashes_json = Path.cwd() / "page_hashes.json"
+
+# "artist/entry" -> {"page": thumbnail page number, "hash": dhash as hex, "mtime": page mtime}
+phash_index_data: Dict[str, Dict[str, Union[int, str]]] = read_json(
+    phash_index_json, {}
+)
+
+
+@lru_cache(maxsize=None)
+def load_page_hashes() -> Dict[str, Dict[str, Any]]:
+    """page hashes of every entry, "artist/entry" -> {"mtime": newest page mtime,
+    "pages": page count, "hashes": dhash as hex of every page that decodes}. only
+    read by the scripts comparing whole entries, not by everything importing this"""
+    return read_json(page_hashes_json, {})
+
+
+def open_reduced(source: Union[Path, IO[bytes]], size: int = 64) -> Image.Image:
+    """decodes an image at roughly `size` px, using DCT scaling for jpegs"""
+    img = Image.open(source)
+    img.draft("L", (size, size))
+    # reduce() doesn't take palette or 1-bit images, converting first also covers them
+    img = img.convert("L")
+    factor = min(img.width, img.height) // size
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
+
+
+def dhash(img: Image.Image) -> int:
+    img = img.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+    pixels = img.tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hash_image(source: Union[Path, IO[bytes]], name: str) -> Union[int, None]:
+    """dhash of an image, None when it can't be decoded"""
+    try:
+        return dhash(open_reduced(source))
+    except DECODE_ERRORS as e:
+        log.warning(f"could not hash {name}: {e}")
+        return None
+
+
+def hash_page(page: Union[Path, str]) -> Union[int, None]:
+    """page may also be a path below an entry archive"""
+    if archive_member := split_archive_path(Path(page)):
+        return hash_image(BytesIO(read_member(*archive_member)), str(page))
+    return hash_image(Path(page), str(page))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def get_entry_pages(entry_path: Path) -> List[Path]:
+    """pages in reading order, sub-entries of multi-entries included"""
+    return sorted(
+        (page for page in entry_path.glob("**/*") if page.suffix in IMAGE_SUFFIXES),
+        key=lambda page: page.relative_to(entry_path).as_posix(),
+    )
+
+
+def get_stored_pages(entry_path: Path) -> List[Path]:
+    """pages of a folder entry, or paths below the archive of an entry stored as cbz"""
+    if entry_path.is_dir():
+        return get_entry_pages(entry_path)
+    if archive := get_entry_archive(entry_path):
+        if not is_normalized(archive):
+            log.warning(f"{archive} isn't normalized, skipping its pages")
+            return []
+        return [archive / name for name in get_archive_pages(archive)]
+    return []
+
+
+def get_page_mtime(page: Path) -> int:
+    archive_member = split_archive_path(page)
+    return int((archive_member[0] if archive_member else page).stat().st_mtime)
+
+
+def get_thumbnail_page_number(entry_path: Path) -> int:
+    metadata_json = entry_path / "metadata.json"
+    if metadata_json.exists():
+        with metadata_json.open(mode="r", encoding="utf-8") as f:
+            return json.load(f).get("thumbnail_page", 1)
+    archive = get_entry_archive(entry_path)
+    if archive and has_member(archive, METADATA_MEMBER):
+        return json.loads(read_member(archive, METADATA_MEMBER)).get(
+            "thumbnail_page", 1
+        )
+    return 1
+
+
+def get_entry_page(entry_path: Path, page_number: int) -> Union[Path, None]:
+    pages = get_entry_pages(entry_path)
+    if 0 < page_number <= len(pages):
+        return pages[page_number - 1]
+    return None
+
+
+def get_stored_page(entry_path: Path, page_number: int) -> Union[Path, None]:
+    pages = get_stored_pages(entry_path)
+    if 0 < page_number <= len(pages):
+        return pages[page_number - 1]
+    return None
+
+
+def get_entry_hash(entry_path: Path, page_number: int) -> Union[int, None]:
+    indexed = phash_index_data.get(entry_path.relative_to(data_dir).as_posix())
+    if indexed and indexed["page"] == page_number:
+        return int(indexed["hash"], 16)
+    if page := get_stored_page(entry_path, page_number):
+        return hash_page(page)
+    return None
+
+
+class BKTree:
+    """burkhard-keller tree over hamming distance, for "which entries look like this" lookups"""
+
+    def __init__(self):
+        self.root: Union[Tuple[int, List[str], Dict[int, tuple]], None] = None
+
+    def add(self, value: int, key: str):
+        if self.root is None:
+            self.root = (value, [key], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(key)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (value, [key], {})
+                return
+            node = node[2][distance]
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        found: List[Tuple[int, str]] = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node_value, keys, children = nodes.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.extend((distance, key) for key in keys)
+            nodes.extend(
+                child
+                for child_distance, child in children.items()
+                if distance - max_distance <= child_distance <= distance + max_distance
+            )
+        return sorted(found)
+
+
+def load_tree() -> BKTree:
+    tree = BKTree()
+    for entry, indexed in phash_index_data.items():
+        tree.add(int(indexed["hash"], 16), entry)
+    return tree
+
+
+def find_matching_entries(
+    img: Image.Image, max_distance: int = MATCH_DISTANCE
+) -> List[Tuple[int, str]]:
+    return load_tree().search(dhash(img), max_distance)
+
+
+def build_index():
+    log.info("========== building perceptual hash index ==========")
+    with index_json.open(mode="r", encoding="utf-8") as f:
+        index_data: Dict[str, Dict[str, str]] = json.load(f)
+
+    pending: Dict[str, Tuple[int, Path]] = {}
+    for artist, entries in index_data.items():
+        for entry in entries.keys():
+            entry_path = data_dir / artist / entry
+            page_number = get_thumbnail_page_number(entry_path)
+            page = get_stored_page(entry_path, page_number)
+            if not page:
+                continue
+            indexed = phash_index_data.get(f"{artist}/{entry}")
+            if (
+                indexed
+                and indexed["page"] == page_number
+                and indexed["mtime"] == get_page_mtime(page)
+            ):
+                continue
+            pending[f"{artist}/{entry}"] = (page_number, page)
+
+    log.info(f"hashing {len(pending)} entries")
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        hashes = executor.map(
+            hash_page,
+            (str(page) for _page_number, page in pending.values()),
+            chunksize=16,
+        )
+        for (entry, (page_number, page)), page_hash in zip(pending.items(), hashes):
+            if page_hash is None:
+                log.warning(f"could not hash {page}, leaving {entry} unindexed")
+                continue
+            phash_index_data[entry] = {
+                "page": page_number,
+                "hash": f"{page_hash:016x}",
+                "mtime": get_page_mtime(page),
+            }
+
+    write_json(phash_index_json, phash_index_data, sort_keys=True)
+    log.info(f"indexed {len(phash_index_data)} entries")
+
+
+def build_page_hashes() -> Dict[str, List[int]]:
+    """hashes every page of every entry, only re-hashing entries whose pages changed"""
+    log.info("========== hashing all pages ==========")
+    page_hashes_data = load_page_hashes()
+    with index_json.open(mode="r", encoding="utf-8") as f:
+        index_data: Dict[str, Dict[str, str]] = json.load(f)
+
+    pending: Dict[str, Tuple[int, List[Path]]] = {}
+    for artist, entries in index_data.items():
+        for entry in entries.keys():
+            entry_path = data_dir / artist / entry
+            if not entry_path.exists() and not get_entry_archive(entry_path):
+                continue
+            pages = get_stored_pages(entry_path)
+            mtime = max((get_page_mtime(page) for page in pages), default=0)
+            indexed = page_hashes_data.get(f"{artist}/{entry}")
+            if (
+                indexed
+                and indexed["mtime"] == mtime
+                and indexed.get("pages", len(indexed["hashes"])) == len(pages)
+            ):
+                continue
+            pending[f"{artist}/{entry}"] = (mtime, pages)
+
+    log.info(f"hashing pages of {len(pending)} entries")
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        hashes = executor.map(
+            hash_page,
+            (str(page) for _mtime, pages in pending.values() for page in pages),
+            chunksize=16,
+        )
+        for entry, (mtime, pages) in pending.items():
+            # pages that can't be decoded are left out, "pages" still counts them
+            entry_hashes = [next(hashes) for _page in pages]
+            if None in entry_hashes:
+                log.warning(
+                    f"could not hash {entry_hashes.count(None)} pages of {entry}"
+                )
+            page_hashes_data[entry] = {
+                "mtime": mtime,
+                "pages": len(pages),
+                "hashes": [
+                    f"{page_hash:016x}"
+                    for page_hash in entry_hashes
+                    if page_hash is not None
+                ],
+            }
+
+    write_json(page_hashes_json, page_hashes_data, sort_keys=True)
+    return {
+        entry: [int(page_hash, 16) for page_hash in indexed["hashes"]]
+        for entry, indexed in page_hashes_data.items()
+    }
+
+
+if __name__ == "__main__":
+    build_index()
@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+from typing import Any, Callable, List, Tuple, Union
+
+from archive_registry import get_skipped, save_registry
+
+# browser_setup reads CAPTCHA before fetch_favorited_links turns it off for itself
+from browser_setup import browser_session
+from clean_favorited import clean_favorited, favorited_json
+from download_all_favorites import (
+    clean_download_index,
+    download_archive,
+    downloaded_store,
+)
+from fetch_favorited_links import get_favorites
+from fetch_metadata import fetch_entry
+from json_store import read_json
+from log_setup import count, log, timed
+from process_downloaded import (
+    check_missing_entries,
+    check_multi_entries,
+    downloaded_dir,
+    get_artist,
+    get_entry_name,
+    index_data,
+    index_store,
+    process_download,
+)
+
+# items a stage may fall behind before the one feeding it waits
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+# metadata lookups are network bound and independent, the other stages are one worker:
+# the browser is a single session and extracting shares the registry and index
+PIPELINE_NETWORK_WORKERS = int(os.getenv("PIPELINE_NETWORK_WORKERS", 4))
+# look for new favorites first, otherwise only the known ones not downloaded yet
+PIPELINE_FETCH_FAVORITES = (
+    os.getenv("PIPELINE_FETCH_FAVORITES", "true").lower() == "true"
+)
+STOP = object()
+
+
+class Stage:
+    """worker threads taking items from a bounded queue and handing what fn returns
+    to the next stage. put() blocks while the queue is full, which holds back the
+    stage feeding it"""
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Any],
+        workers: int,
+        next_stage: Union["Stage", None] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.next_stage = next_stage
+        self.inbox: "queue.Queue[Any]" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.threads: List[threading.Thread] = [
+            threading.Thread(target=self.work, name=f"{name}-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item: Any):
+        self.inbox.put(item)
+
+    def work(self):
+        while (item := self.inbox.get()) is not STOP:
+            try:
+                with timed(f"pipeline_{self.name}"):
+                    result = self.fn(item)
+            except Exception:
+                log.exception(f"{self.name} failed for {item}")
+                count(f"pipeline_{self.name}_failed")
+                continue
+            count(f"pipeline_{self.name}_items")
+            if result is not None and self.next_stage:
+                self.next_stage.put(result)
+
+    def close(self):
+        """lets the workers finish everything queued so far, then stops them"""
+        for _thread in self.threads:
+            self.inbox.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+
+def extract_download(
+    item: Tuple[str, str, str],
+) -> Union[Tuple[str, str, str, str], None]:
+    url, download_name, favorite_name = item
+    artist = get_artist(url, favorite_name)
+    if not artist:
+        log.warning(f"no artist known for {download_name}, leaving it in downloaded/")
+        return None
+    # the registry, cbz index and index changes it shares with the metadata workers
+    # take state_lock on their own, copying and extracting run alongside them
+    entry_path = process_download(url, download_name, artist)
+    if not entry_path:
+        return None
+    return artist, get_entry_name(entry_path), url, download_name
+
+
+def fetch_download_metadata(item: Tuple[str, str, str, str]):
+    fetch_entry(*item)
+
+
+@timed("pipeline")
+def run_pipeline():
+    log.info("========== running pipeline ==========")
+    clean_download_index()
+    metadata_stage = Stage(
+        "metadata", fetch_download_metadata, PIPELINE_NETWORK_WORKERS
+    )
+    extract_stage = Stage("extract", extract_download, 1, metadata_stage)
+    try:
+        favorited_data = read_json(favorited_json)
+        indexed_urls = set(
+            url for entries in index_data.values() for url in entries.values()
+        )
+        # downloads an earlier run didn't get to, exact duplicates are never indexed
+        for url, download_name in list(downloaded_store.data.items()):
+            if (
+                url not in indexed_urls
+                and not get_skipped(url)
+                and (downloaded_dir / f"{download_name}.cbz").exists()
+            ):
+                extract_stage.put((url, download_name, favorited_data.get(url, "")))
+
+        with browser_session():
+            if PIPELINE_FETCH_FAVORITES:
+                get_favorites()
+                favorited_data = read_json(favorited_json)
+            for url, favorite_name in favorited_data.items():
+                if url in downloaded_store.data:
+                    continue
+                log.info(f"downloading favorite: '{url} : {favorite_name}'")
+                download_archive(url)
+                count("pipeline_download_items")
+                if download_name := downloaded_store.data.get(url):
+                    extract_stage.put((url, download_name, favorite_name))
+    finally:
+        downloaded_store.flush()
+        extract_stage.close()
+        metadata_stage.close()
+        index_store.flush()
+        save_registry()
+
+    check_multi_entries()
+    check_missing_entries()
+    clean_favorited()
+
+
+if __name__ == "__main__":
+    run_pipeline()
@@ -1,20 +1,76 @@
 import json
 import re
 import shutil
-import zipfile
-from pathlib import Path
+from collections import defaultdict
+from pathlib import Path, PurePosixPath
 from typing import Dict, List, Set, Tuple, Union
 
-from log_setup import log
+from archive_registry import (
+    SKIP_DUPLICATE_ARCHIVES,
+    extract_archive,
+    find_duplicate_archive,
+    get_skipped,
+    hash_file,
+    locked,
+    register_archive,
+    register_skipped,
+    rename_registered_path,
+    save_registry,
+)
+from cbz_store import (
+    STORAGE_MODE,
+    get_archive_pages,
+    is_entry_archive,
+    is_normalized,
+    normalize_archive,
+    rename_members,
+    save_cbz_index,
+    split_archive_path,
+)
+from json_store import JsonStore
+from log_setup import count, flush_events, log, log_event, timed
+from state import load_downloaded
 
 data_dir = Path.cwd() / "data"
 downloaded_dir = Path.cwd() / "downloaded"
 downloaded_json = Path.cwd() / "downloaded.json"
 index_json = Path.cwd() / "index.json"
-with index_json.open(mode="r", encoding="utf-8") as f:
-    index_data: Dict[str, Dict[str, str]] = json.load(f)
-with downloaded_json.open(mode="r", encoding="utf-8") as f:
-    downloaded_data: Dict[str, str] = json.load(f)
+index_store = JsonStore(index_json, sort_keys=True)
+index_data: Dict[str, Dict[str, str]] = index_store.data
+downloaded_data = load_downloaded()
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".webp"]
+NOT_DOWNLOADED_PREFIX = "!<not yet downloaded> "
+
+
+def get_entry_name(entry: Path) -> str:
+    return entry.stem if is_entry_archive(entry) else entry.name
+
+
+def with_entry_name(entry: Path, name: str) -> Path:
+    return entry.with_name(f"{name}.cbz" if is_entry_archive(entry) else name)
+
+
+def get_page_groups(entry: Path) -> List[List[Path]]:
+    """pages of an entry, or of each of its sub-entries for multi-entries.
+    pages of an entry archive are paths below the archive, like data/a/e.cbz/01.jpg"""
+    if is_entry_archive(entry):
+        groups: Dict[str, List[Path]] = defaultdict(list)
+        for name in get_archive_pages(entry):
+            groups[str(PurePosixPath(name).parent)].append(entry / name)
+        if len(groups) > 1:
+            groups.pop(".", None)
+        return list(groups.values())
+    sub_entries = [sub_entry for sub_entry in entry.iterdir() if sub_entry.is_dir()]
+    return [
+        [page for page in sub_entry.iterdir() if page.suffix in IMAGE_SUFFIXES]
+        for sub_entry in sub_entries or [entry]
+    ]
+
+
+def is_multi_entry(entry: Path) -> bool:
+    if is_entry_archive(entry):
+        return any("/" in name for name in get_archive_pages(entry))
+    return any(sub_entry.is_dir() for sub_entry in entry.iterdir())
 
 
 def add_rename_path(
@@ -42,9 +98,26 @@ def do_move(
             error_msg = f"duplicate destination paths!\n{conflicts_str}"
             raise Exception(error_msg)
         log.info(f"moving {type}:")
+        count(f"{type}_moved", len(paths_to_move_source))
+        archive_renames: Dict[Path, Dict[str, str]] = defaultdict(dict)
         for new_path, page in paths_to_move_source.items():
-            log.info(f"{page.name} =============> {new_path.name}")
-            page.rename(new_path)
+            log_event(
+                f"moved {{count}} {type} in {{groups}} directories",
+                str(page.parent),
+                f"{page.name} =============> {new_path.name}",
+            )
+            if archive_member := split_archive_path(page):
+                archive, name = archive_member
+                new_name = new_path.relative_to(archive).as_posix()
+                archive_renames[archive][name] = new_name
+            else:
+                page.rename(new_path)
+            rename_registered_path(page, new_path)
+        for archive, renames in archive_renames.items():
+            rename_members(archive, renames)
+        flush_events()
+        save_registry()
+        save_cbz_index()
     else:
         log.info(f"no {type} to move")
 
@@ -68,7 +141,9 @@ def copy_indexed_archives_to_data_dir():
         artist_path.mkdir(exist_ok=True)
         for entry, url in entries.items():
             entry_path = artist_path / entry
-            if not entry_path.exists():
+            if get_skipped(url):
+                continue
+            if not entry_path.exists() and not (artist_path / f"{entry}.cbz").exists():
                 cbz_filename = f"{downloaded_data[url]}.cbz"
                 source_cbz_path = downloaded_dir / cbz_filename
                 dest_cbz_path = artist_path / cbz_filename
@@ -80,19 +155,104 @@ def copy_indexed_archives_to_data_dir():
                     shutil.copy(source_cbz_path, dest_cbz_path)
 
 
+def get_download_url(download_name: str) -> Union[str, None]:
+    return next(
+        (
+            url
+            for url, filename in downloaded_data.items()
+            if filename.strip() == download_name.strip()
+        ),
+        None,
+    )
+
+
+def unzip_archive(archive: Path, url: Union[str, None] = None) -> Union[Path, None]:
+    """extracts or normalizes one archive in an artist's directory, the entry it
+    became or None when it was a skipped duplicate. skips are recorded for url,
+    or for the url downloaded.json has for the archive"""
+    artist_path = archive.parent
+    archive_path = archive.with_suffix("")
+    archive_path = archive_path.with_name(archive_path.name.strip())
+    archive_hash = hash_file(archive)
+    count("unzip_all_archives")
+    count("unzip_all_bytes", archive.stat().st_size)
+    if duplicate := find_duplicate_archive(archive_hash):
+        log.warning(f"{archive.name} is an exact duplicate of {duplicate}")
+        if SKIP_DUPLICATE_ARCHIVES:
+            log.warning(f"skipping extraction and deleting {archive.name}")
+            if url := url or get_download_url(archive.stem):
+                register_skipped(url, duplicate)
+            archive.unlink()
+            return None
+    if STORAGE_MODE == "cbz":
+        log_event(
+            "normalized {count} archives of {groups} artists",
+            artist_path.name,
+            f"normalizing {archive.name}",
+        )
+        archive_path = archive_path.with_name(f"{archive_path.name}.cbz")
+        normalize_archive(archive, archive_path)
+        register_archive(archive_hash, archive_path)
+        return archive_path
+    log_event(
+        "extracted {count} archives of {groups} artists",
+        artist_path.name,
+        f"extracting and deleting {archive.name}",
+    )
+    extract_archive(archive, archive_path)
+    register_archive(archive_hash, archive_path)
+    archive.unlink()
+    return archive_path
+
+
+@timed("unzip_all")
 def unzip_all():
     for artist_path in data_dir.iterdir():
         for archive in (
             archive for archive in artist_path.iterdir() if archive.suffix in [".cbz"]
         ):
-            archive_path = archive.with_suffix("")
-            archive_path = archive_path.with_name(archive_path.name.strip())
-            log.info(f"extracting and deleting {archive.name}")
-            with zipfile.ZipFile(archive, "r") as zip:
-                zip.extractall(archive_path)
-            archive.unlink()
+            if STORAGE_MODE == "cbz" and is_normalized(archive):
+                continue
+            unzip_archive(archive)
+    flush_events()
+    save_registry()
+    save_cbz_index()
+
+
+@locked
+def rename_and_add_entry(source_entry_path: Path, entry_url: str) -> Path:
+    """renames a downloaded entry to its index name, adding it to the index first
+    when it's new"""
+    artist_path = source_entry_path.parent
+    if artist_path.name not in index_data.keys():
+        index_data[artist_path.name] = {}
+    dest_entry_name = next(
+        (
+            entry
+            for entry, url in index_data[artist_path.name].items()
+            if url == entry_url
+        ),
+        None,
+    )
+    if not dest_entry_name:
+        dest_entry_name = clean_directory_name(get_entry_name(source_entry_path))
+        log.info(
+            f"adding entry to index and favorited: {artist_path.name}/{dest_entry_name}"
+        )
+        index_data[artist_path.name][dest_entry_name] = entry_url
+        index_store.changed()
+    log_event(
+        "renamed {count} entries of {groups} artists",
+        artist_path.name,
+        f"renaming {artist_path.name}/{source_entry_path.name} to {artist_path.name}/{dest_entry_name}",
+    )
+    dest_entry_path = with_entry_name(source_entry_path, dest_entry_name)
+    source_entry_path.rename(dest_entry_path)
+    rename_registered_path(source_entry_path, dest_entry_path)
+    return dest_entry_path
 
 
+@timed("rename_and_add_entries")
 def rename_and_add_entries():
     for artist_path in data_dir.iterdir():
         for source_entry_path in artist_path.iterdir():
@@ -100,42 +260,18 @@ def rename_and_add_entries():
                 (
                     url
                     for url, filename in downloaded_data.items()
-                    if filename.strip() == source_entry_path.name
+                    if filename.strip() == get_entry_name(source_entry_path)
                 ),
                 None,
             )
             if entry_url:
-                if artist_path.name not in index_data.keys():
-                    index_data[artist_path.name] = {}
-                dest_entry_name = next(
-                    (
-                        entry
-                        for entry, url in index_data[artist_path.name].items()
-                        if url == entry_url
-                    ),
-                    None,
-                )
-                if not dest_entry_name:
-                    dest_entry_name = clean_directory_name(source_entry_path.name)
-                    log.info(
-                        f"adding entry to index and favorited: {artist_path.name}/{dest_entry_name}"
-                    )
-                    index_data[artist_path.name][dest_entry_name] = entry_url
-                    with index_json.open("w", encoding="utf-8") as f:
-                        json.dump(
-                            obj=index_data,
-                            fp=f,
-                            indent=2,
-                            ensure_ascii=False,
-                            sort_keys=True,
-                        )
-                        f.write("\n")
-                log.info(
-                    f"renaming {artist_path.name}/{source_entry_path.name} to {artist_path.name}/{dest_entry_name}"
-                )
-                source_entry_path.rename(source_entry_path.with_name(dest_entry_name))
+                rename_and_add_entry(source_entry_path, entry_url)
+    flush_events()
+    index_store.flush()
+    save_registry()
 
 
+@timed("clean_entries")
 def clean_entries():
     log.info("========== cleaning entries ==========")
 
@@ -144,11 +280,11 @@ def clean_entries():
 
     for artist in data_dir.iterdir():
         for entry in artist.iterdir():
-            cleaned_name = clean_directory_name(entry.name)
-            if entry.name != cleaned_name:
+            cleaned_name = clean_directory_name(get_entry_name(entry))
+            if get_entry_name(entry) != cleaned_name:
                 add_rename_path(
                     source=entry,
-                    new_name=cleaned_name,
+                    new_name=with_entry_name(entry, cleaned_name).name,
                     paths_to_move_source=entries_to_move_source,
                     conflicts=conflicts,
                 )
@@ -159,9 +295,10 @@ def clean_entries():
         log.info("no entries to move")
 
 
-def clean_filenames():
+@timed("clean_filenames")
+def clean_filenames(entries: Union[List[Path], None] = None):
+    """renames the pages of entries, or of every entry in data/"""
     log.info("========== cleaning_filenames ==========")
-    IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png"]
 
     PATTERNS = {
         "standard": re.compile(
@@ -264,7 +401,7 @@ def clean_filenames():
         "wtf_is_that": clean_simple,
     }
 
-    def process_entry(entry: Path):
+    def process_entry(pages: List[Path]):
         entry_matches: Set[Tuple[Path, re.Match]] = set()
         matched_pattern_name: Union[str, None] = None
 
@@ -280,7 +417,6 @@ def clean_filenames():
                     raise Exception(f"what even: {page.name}")
                 entry_matches.add((page, m[-1]))
 
-        pages = [page for page in entry.iterdir() if page.suffix in IMAGE_SUFFIXES]
         for page in pages:
             for pattern_name in PATTERNS.keys():
                 check_match(pattern_name, page)
@@ -289,16 +425,11 @@ def clean_filenames():
             raise Exception("no cleaner found")
         CLEANERS[matched_pattern_name](entry_matches)
 
-    for artist in data_dir.iterdir():
-        for entry in artist.iterdir():
-            sub_entries = [
-                sub_entry for sub_entry in entry.iterdir() if sub_entry.is_dir()
-            ]
-            if sub_entries:
-                for sub_entry in sub_entries:
-                    process_entry(sub_entry)
-            else:
-                process_entry(entry)
+    if entries is None:
+        entries = [entry for artist in data_dir.iterdir() for entry in artist.iterdir()]
+    for entry in entries:
+        for pages in get_page_groups(entry):
+            process_entry(pages)
 
     if intersection := set.intersection(
         *(set(page for (page, _m) in match_set) for match_set in matches.values())
@@ -311,16 +442,17 @@ def clean_filenames():
         log.info("no pages to move")
 
 
+@timed("check_multi_entries")
 def check_multi_entries():
     log.info("========== checking for new multi-entries ==========")
     multi_entries_json = Path.cwd() / "multi_entries.json"
     with multi_entries_json.open("r") as f:
         confirmed_multi_entries = set(json.load(f))
     existing_multi_entries = set(
-        str(entry.relative_to(data_dir))
+        str((artist / get_entry_name(entry)).relative_to(data_dir))
         for artist in data_dir.iterdir()
         for entry in artist.iterdir()
-        if any(sub_entry.is_dir() for sub_entry in entry.iterdir())
+        if is_multi_entry(entry)
     )
     new_multi_entries = existing_multi_entries - confirmed_multi_entries
     if new_multi_entries:
@@ -330,17 +462,20 @@ def check_multi_entries():
         log.info("no new multi-entries found")
 
 
+@timed("check_missing_entries")
 def check_missing_entries():
     log.info("========== checking for missing entries ==========")
     with index_json.open(mode="r", encoding="utf-8") as f:
         index_data: Dict[str, Dict[str, str]] = json.load(f)
+    # entries whose archive duplicated another one were never extracted
     index_entries = set(
         f"{artist}/{entry}"
         for artist, entries in index_data.items()
-        for entry, _url in entries.items()
+        for entry, url in entries.items()
+        if not get_skipped(url)
     )
     actual_entries = set(
-        f"{artist.name}/{entry.name}"
+        f"{artist.name}/{get_entry_name(entry)}"
         for artist in data_dir.iterdir()
         for entry in artist.iterdir()
     )
@@ -366,10 +501,42 @@ def check_missing_entries():
         log.info("no missing entries detected")
 
 
-copy_indexed_archives_to_data_dir()
-unzip_all()
-rename_and_add_entries()
-clean_entries()
-clean_filenames()
-check_multi_entries()
-check_missing_entries()
+def get_artist(url: str, favorite_name: str) -> Union[str, None]:
+    """the index's artist of known urls, otherwise the one fetch_favorited_links put
+    into the name of the favorite"""
+    for artist, entries in index_data.items():
+        if url in entries.values():
+            return artist
+    if favorite_name.startswith(NOT_DOWNLOADED_PREFIX):
+        return favorite_name[len(NOT_DOWNLOADED_PREFIX) :].split("/", 1)[0]
+    return None
+
+
+def process_download(url: str, download_name: str, artist: str) -> Union[Path, None]:
+    """one downloaded archive through the steps above: copied into its artist's
+    directory, extracted or normalized, renamed to its index name and its pages
+    cleaned. the entry it became, or None when it was a skipped duplicate"""
+    artist_path = data_dir / artist
+    artist_path.mkdir(exist_ok=True)
+    archive = artist_path / f"{download_name}.cbz"
+    log.info(f"copying {download_name}.cbz to {artist_path}")
+    shutil.copy(downloaded_dir / f"{download_name}.cbz", archive)
+    entry_path = unzip_archive(archive, url)
+    if not entry_path:
+        return None
+    entry_path = rename_and_add_entry(entry_path, url)
+    clean_filenames([entry_path])
+    flush_events()
+    save_registry()
+    save_cbz_index()
+    return entry_path
+
+
+if __name__ == "__main__":
+    copy_indexed_archives_to_data_dir()
+    unzip_all()
+    rename_and_add_entries()
+    clean_entries()
+    clean_filenames()
+    check_multi_entries()
+    check_missing_entries()
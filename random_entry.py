@@ -1,19 +1,256 @@
-import json
+import mmap
+import os
 import random
+import struct
 import webbrowser
+import zlib
+from collections import Counter
 from pathlib import Path
-from typing import Dict
+from typing import List, Set, Union
+
+from json_store import read_json
+from log_setup import log
+from state import IndexSnapshot, load_index_snapshot
+
+# comma separated, an entry has to match one of the artists and all of the tags
+RANDOM_ARTIST = [
+    artist for artist in os.getenv("RANDOM_ARTIST", "").split(",") if artist
+]
+RANDOM_TAG = [tag for tag in os.getenv("RANDOM_TAG", "").split(",") if tag]
+# "entry": every entry is as likely, "artist": every artist is as likely
+RANDOM_WEIGHT = os.getenv("RANDOM_WEIGHT", "entry")
+# only opens entries that weren't opened before, until all of them were
+RANDOM_NO_REPEAT = os.getenv("RANDOM_NO_REPEAT", "false").lower() == "true"
+# weighted draws that keep hitting opened entries fall back to a uniform one
+MAX_WEIGHTED_TRIES = 32
 
 vivaldi_vpn = webbrowser.get(
     "C:/Users/big_soup/AppData/Local/Vivaldi VPN/Application/vivaldi.exe %s --incognito"
 )
 
-index_json = Path.cwd() / "index.json"
+db_json = Path.cwd() / "db.json"
+random_pool_file = Path.cwd() / "random_pool.bin"
+random_history_txt = Path.cwd() / "random_history.txt"
 
-with index_json.open(mode="r", encoding="utf-8") as f:
-    index_data: Dict[str, Dict[str, str]] = json.load(f)
+# magic, mtime of the index.json the snapshot was built from, filter checksum,
+# number of candidates, number of them already opened
+POOL_HEADER = struct.Struct("<4sQIII")
+POOL_MAGIC = b"RNP1"
 
-all_urls = [
-    url for _artist, entries in index_data.items() for _entry, url in entries.items()
-]
-vivaldi_vpn.open_new_tab(random.choice(all_urls))
+
+def get_filter_key() -> int:
+    """checksum of everything the pool depends on besides index.json. db.json only
+    decides which entries are tagged, so its mtime only counts with RANDOM_TAG"""
+    db_mtime = db_json.stat().st_mtime_ns if RANDOM_TAG and db_json.exists() else 0
+    key = [
+        ",".join(RANDOM_ARTIST),
+        ",".join(RANDOM_TAG),
+        RANDOM_WEIGHT,
+        str(RANDOM_NO_REPEAT),
+        str(db_mtime),
+    ]
+    return zlib.crc32("|".join(key).encode("utf-8"))
+
+
+def load_tagged_entries() -> Set[str]:
+    """ "artist/entry" of every entry in the metadata db that has all of RANDOM_TAG"""
+    db_data = read_json(db_json, {})
+    return set(
+        "/".join(Path(document["json_path"]).parts[:2])
+        for document in db_data.get("_default", {}).values()
+        if set(RANDOM_TAG) <= set(document.get("tags") or [])
+    )
+
+
+def load_history() -> Set[str]:
+    if not random_history_txt.exists():
+        return set()
+    with random_history_txt.open(mode="r", encoding="utf-8") as f:
+        return set(line.rstrip("\n") for line in f)
+
+
+def get_candidates(snapshot: IndexSnapshot) -> List[int]:
+    tagged_entries = load_tagged_entries() if RANDOM_TAG else None
+    candidates: List[int] = []
+    for i in range(len(snapshot)):
+        _url, artist, entry = snapshot.record(i)
+        if RANDOM_ARTIST and artist not in RANDOM_ARTIST:
+            continue
+        if tagged_entries is not None and f"{artist}/{entry}" not in tagged_entries:
+            continue
+        candidates.append(i)
+    return candidates
+
+
+def get_alias_table(weights: List[float]):
+    """vose's alias method: a draw is one uniform slot plus one coin flip"""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [weight * n / total for weight in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, weight in enumerate(scaled) if weight < 1]
+    large = [i for i, weight in enumerate(scaled) if weight >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+    return prob, alias
+
+
+class RandomPool:
+    """random_pool.bin: the candidates of the current filters with their alias table,
+    and a shuffle bag of the ones not opened yet. every array is memory-mapped so a
+    draw only touches a few slots"""
+
+    def __init__(self, path: Path = random_pool_file):
+        self.file = path.open("r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        magic, self.source_mtime_ns, self.filter_key, self.count, self.drawn = (
+            POOL_HEADER.unpack_from(self.buffer)
+        )
+        if magic != POOL_MAGIC:
+            raise Exception(f"not a random pool: {path}")
+        view = memoryview(self.buffer)
+        offset = POOL_HEADER.size
+        # doubles first, so they stay 8-byte aligned
+        self.prob = view[offset : offset + 8 * self.count].cast("d")
+        offset += 8 * self.count
+        self.candidates, self.alias, self.bag, self.bag_position = (
+            view[offset + 4 * self.count * k : offset + 4 * self.count * (k + 1)].cast(
+                "I"
+            )
+            for k in range(4)
+        )
+
+    @staticmethod
+    def build(snapshot: IndexSnapshot, path: Path = random_pool_file):
+        candidates = get_candidates(snapshot)
+        if RANDOM_WEIGHT == "artist":
+            artists = [snapshot.record(i)[1] for i in candidates]
+            entries_per_artist = Counter(artists)
+            prob, alias = get_alias_table(
+                [1 / entries_per_artist[artist] for artist in artists]
+            )
+        else:
+            prob, alias = [1.0] * len(candidates), list(range(len(candidates)))
+
+        # already opened entries go to the front of the bag, as if drawn this round
+        history = load_history() if RANDOM_NO_REPEAT else set()
+        opened = [
+            position
+            for position, i in enumerate(candidates)
+            if snapshot.record(i)[0] in history
+        ]
+        if len(opened) == len(candidates):
+            opened = []
+        opened_set = set(opened)
+        bag = opened + [
+            position
+            for position in range(len(candidates))
+            if position not in opened_set
+        ]
+        bag_position = [0] * len(candidates)
+        for slot, position in enumerate(bag):
+            bag_position[position] = slot
+
+        n = len(candidates)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with tmp_path.open("wb") as f:
+            f.write(
+                POOL_HEADER.pack(
+                    POOL_MAGIC,
+                    snapshot.source_mtime_ns,
+                    get_filter_key(),
+                    n,
+                    len(opened),
+                )
+            )
+            f.write(struct.pack(f"<{n}d", *prob))
+            for array in (candidates, alias, bag, bag_position):
+                f.write(struct.pack(f"<{n}I", *array))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        for array in (
+            self.prob,
+            self.candidates,
+            self.alias,
+            self.bag,
+            self.bag_position,
+        ):
+            array.release()
+        self.buffer.close()
+        self.file.close()
+
+    def set_drawn(self, drawn: int):
+        self.drawn = drawn
+        struct.pack_into("<I", self.buffer, POOL_HEADER.size - 4, drawn)
+
+    def weighted_position(self) -> int:
+        slot = random.randrange(self.count)
+        return slot if random.random() < self.prob[slot] else self.alias[slot]
+
+    def take(self, position: int):
+        """swaps a candidate to the opened part of the bag"""
+        slot = self.bag_position[position]
+        other = self.bag[self.drawn]
+        self.bag[slot], self.bag[self.drawn] = other, position
+        self.bag_position[other], self.bag_position[position] = slot, self.drawn
+        self.set_drawn(self.drawn + 1)
+
+    def draw(self) -> int:
+        """snapshot index of a random candidate"""
+        if not RANDOM_NO_REPEAT:
+            return self.candidates[self.weighted_position()]
+        if self.drawn >= self.count:
+            log.info("opened every entry, starting over")
+            random_history_txt.unlink(missing_ok=True)
+            self.set_drawn(0)
+        for _ in range(MAX_WEIGHTED_TRIES):
+            position = self.weighted_position()
+            if self.bag_position[position] >= self.drawn:
+                break
+        else:
+            position = self.bag[random.randrange(self.drawn, self.count)]
+        self.take(position)
+        return self.candidates[position]
+
+
+def load_random_pool(snapshot: IndexSnapshot) -> Union[RandomPool, None]:
+    """(re)builds the pool when the index or the filters changed"""
+    if random_pool_file.exists():
+        pool = RandomPool()
+        if (
+            pool.source_mtime_ns == snapshot.source_mtime_ns
+            and pool.filter_key == get_filter_key()
+        ):
+            return pool
+        pool.close()
+    log.info("building random pool")
+    RandomPool.build(snapshot)
+    pool = RandomPool()
+    return pool if pool.count else None
+
+
+def open_random_entry():
+    snapshot = load_index_snapshot()
+    pool = load_random_pool(snapshot)
+    if not pool:
+        raise Exception("no entry matches RANDOM_ARTIST/RANDOM_TAG")
+    url, artist, entry = snapshot.record(pool.draw())
+    pool.close()
+    if RANDOM_NO_REPEAT:
+        with random_history_txt.open(mode="a", encoding="utf-8") as f:
+            f.write(f"{url}\n")
+    log.info(f"{artist}/{entry}")
+    vivaldi_vpn.open_new_tab(url)
+
+
+if __name__ == "__main__":
+    open_random_entry()
@@ -0,0 +1,393 @@
+import base64
+import hashlib
+import html
+import io
+import json
+import os
+import random
+import re
+import threading
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep
+from typing import Any, Dict, List, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import requests
+from PIL import Image
+
+from json_store import read_json, write_json
+from log_setup import log
+from naming import do_slugify
+
+REPLAY_HOST = os.getenv("REPLAY_HOST", "127.0.0.1")
+REPLAY_PORT = int(os.getenv("REPLAY_PORT", 8090))
+# every response is held back this long, plus an exponentially distributed jitter
+REPLAY_LATENCY_MS = float(os.getenv("REPLAY_LATENCY_MS", 50))
+REPLAY_JITTER_MS = float(os.getenv("REPLAY_JITTER_MS", 20))
+# share of requests answered with a 503, and of requests whose connection gets dropped
+REPLAY_ERROR_RATE = float(os.getenv("REPLAY_ERROR_RATE", 0))
+REPLAY_RESET_RATE = float(os.getenv("REPLAY_RESET_RATE", 0))
+REPLAY_SEED = int(os.getenv("REPLAY_SEED", 0))
+# share of the catalog only found on the i site, and found on neither
+REPLAY_I_SHARE = float(os.getenv("REPLAY_I_SHARE", 0.3))
+REPLAY_MISSING_SHARE = float(os.getenv("REPLAY_MISSING_SHARE", 0.05))
+# galleries get revised upstream: each revision adds a tag to this share of them
+REPLAY_REVISION = int(os.getenv("REPLAY_REVISION", 0))
+REPLAY_CHANGE_SHARE = float(os.getenv("REPLAY_CHANGE_SHARE", 0.1))
+# results per page of an f search, and at most returned by its suggest
+REPLAY_PAGE_SIZE = int(os.getenv("REPLAY_PAGE_SIZE", 20))
+REPLAY_SUGGEST_SIZE = int(os.getenv("REPLAY_SUGGEST_SIZE", 5))
+# fetch /_ext/<host>/<path> misses from https://<host>/<path> and save them
+REPLAY_RECORD = os.getenv("REPLAY_RECORD", "false").lower() == "true"
+# host that root-relative paths of recorded pages belong to
+REPLAY_DEFAULT_HOST = os.getenv("REPLAY_DEFAULT_HOST", "")
+# comma separated hosts of the f and i sites, the only ones f_cookies.txt is sent to.
+# recorded pages point every absolute url at /_ext/, cdns included
+REPLAY_COOKIE_HOSTS = [
+    host
+    for host in os.getenv("REPLAY_COOKIE_HOSTS", REPLAY_DEFAULT_HOST).split(",")
+    if host
+]
+BASE_PLACEHOLDER = "__REPLAY_BASE__"
+ABSOLUTE_URL_PATTERN = re.compile(r"https?://([\w.-]+(?::\d+)?)")
+F_THUMBNAIL_PATTERN = re.compile(r"/f/([^/]+)/thumbs/\d+\.thumb\.jpg$")
+I_THUMBNAIL_PATTERN = re.compile(r"/i/image/([^/]+)\.jpg$")
+
+replay_dir = Path.cwd() / "replay"
+index_json = Path.cwd() / "index.json"
+cookies_txt = Path.cwd() / "f_cookies.txt"
+
+# slug of "artist title" -> {"artist", "title", "slug", "site", "pages", "date"},
+# made up from an index.json so every entry of it can be searched and fetched
+catalog: Dict[str, Dict[str, Any]] = {}
+# slug of the entry alone -> catalog keys, for the i site which searches by title
+catalog_titles: Dict[str, List[str]] = {}
+# path with query -> times it was requested, for deterministic error injection
+hits: Counter = Counter()
+hits_lock = threading.Lock()
+
+
+def get_fraction(*parts: Any) -> float:
+    """a stable number in [0, 1) for the parts, the same on every run"""
+    key = ":".join(str(part) for part in [REPLAY_SEED, *parts])
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big") / 2**64
+
+
+def load_catalog(path: Path = index_json):
+    catalog.clear()
+    catalog_titles.clear()
+    for artist, entries in read_json(path, {}).items():
+        for title in entries.keys():
+            slug = do_slugify(f"{artist} {title}")
+            fraction = get_fraction("site", slug)
+            if fraction < REPLAY_MISSING_SHARE:
+                site = None
+            elif fraction < REPLAY_MISSING_SHARE + REPLAY_I_SHARE:
+                site = "i"
+            else:
+                site = "f"
+            catalog[slug] = {
+                "artist": artist,
+                "title": title,
+                "slug": slug,
+                "site": site,
+                "pages": 10 + int(get_fraction("pages", slug) * 190),
+                "date": formatdate(
+                    1.5e9 + get_fraction("date", slug) * 2e8, usegmt=True
+                ),
+            }
+            catalog_titles.setdefault(do_slugify(title), []).append(slug)
+    log.info(f"loaded {len(catalog)} catalog entries")
+
+
+def get_thumbnail_bytes() -> bytes:
+    # a flat image, so its dhash matches the flat pages of the benchmark library
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 90), (200, 200, 200)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+thumbnail_bytes = get_thumbnail_bytes()
+
+
+def find(site: str, query: str) -> List[Dict[str, Any]]:
+    slug = do_slugify(query)
+    keys = [slug] if slug in catalog else []
+    if site == "i":
+        keys += catalog_titles.get(slug, [])
+    # both sites list all works of an artist searched by name
+    keys += [key for key, item in catalog.items() if do_slugify(item["artist"]) == slug]
+    return [catalog[key] for key in dict.fromkeys(keys) if catalog[key]["site"] == site]
+
+
+def get_revision_tags(item: Dict[str, Any]) -> List[str]:
+    return [
+        f"Revision {revision}"
+        for revision in range(1, REPLAY_REVISION + 1)
+        if get_fraction("revision", item["slug"], revision) < REPLAY_CHANGE_SHARE
+    ]
+
+
+def render_f_gallery(base: str, item: Dict[str, Any]) -> str:
+    artist = html.escape(item["artist"])
+    tags = "".join(
+        f'<a class="inline-block" href="/tags/{tag}">{tag}</a>'
+        for tag in ["Doujin", "Color", "Benchmark", *get_revision_tags(item)]
+    )
+    return f"""<html><body>
+<div class="block sm:inline-block relative w-full align-top">
+<img src="{base}/f/{item['slug']}/thumbs/1.thumb.jpg"></div>
+<div class="block md:table-cell relative w-full align-top">
+<h1>{html.escape(item['title'])}</h1>
+<div><div>Artist</div><div><a href="/artists/{item['slug']}">{artist}</a></div></div>
+<div><div>Magazine</div><div><a href="/magazines/replay">Replay</a></div></div>
+<div><div>Pages</div><div>{item['pages']} pages</div></div>
+<div><div>Direction</div><div>Right to Left</div></div>
+<div><div>{tags}<a class="inline-block">+</a></div></div>
+<div><div>synthetic entry served by replay_server.py</div></div>
+</div>
+<div id="{item['slug']}/related"><div id="content-1"><a href="/hentai/other">other</a></div></div>
+</body></html>"""
+
+
+def render_f_search(items: List[Dict[str, Any]]) -> str:
+    results = "".join(
+        f'<div id="content-{n}"><a class="text-md" href="/hentai/{item["slug"]}">'
+        f'{html.escape(item["title"])}</a>'
+        f'<a class="text-sm">{html.escape(item["artist"])}</a></div>'
+        for n, item in enumerate(items)
+    )
+    return f"<html><body>{results}</body></html>"
+
+
+def render_i_gallery(base: str, item: Dict[str, Any]) -> str:
+    tags = "".join(
+        f"<a>{tag}</a>" for tag in ["Color", "Benchmark", *get_revision_tags(item)]
+    )
+    return f"""<html><body><div id="product-product"><div id="content">
+<h1 class="page-title">{html.escape(item['title'])}</h1>
+<div class="product-info">
+<div class="product-left"><div class="main-image">
+<img src="{base}/i/image/{item['slug']}.jpg"></div></div>
+<div class="product-right">
+<div class="product-manufacturer"><a>{html.escape(item['artist'])}</a></div>
+<div class="product-upc"><span>{item['pages']}</span></div>
+<div class="product_extra"><div class="block-content">synthetic entry</div></div>
+<div class="tags">{tags}</div>
+</div></div></div></div></body></html>"""
+
+
+def render_i_search(base: str, items: List[Dict[str, Any]]) -> str:
+    results = "".join(
+        f'<div class="product-thumb"><div class="name">'
+        f'<a href="{base}/i/{item["slug"]}?search=1">{html.escape(item["title"])}</a></div>'
+        f'<div class="stats"><a>{html.escape(item["artist"])}</a></div></div>'
+        for item in items
+    )
+    return f'<html><body><div id="product-search"><div class="main-products">{results}</div></div></body></html>'
+
+
+def get_templated(
+    base: str, path: str, query: Dict[str, List[str]]
+) -> Tuple[int, Dict[str, str], bytes]:
+    """(status, headers, body) made up for the f and i sites from the catalog"""
+    html_type = {"Content-Type": "text/html; charset=utf-8"}
+    json_type = {"Content-Type": "application/json"}
+    if path.startswith("/f/suggest/"):
+        items = find("f", path[len("/f/suggest/") :])[:REPLAY_SUGGEST_SIZE]
+        results = [
+            {
+                "link": f"/hentai/{item['slug']}",
+                "title": item["title"],
+                "image": f"/f/{item['slug']}/thumbs/1.thumb.jpg",
+            }
+            for item in items
+        ]
+        return 200, json_type, json.dumps({"results": results}).encode("utf-8")
+    if path.startswith("/f/search/"):
+        page = int(query.get("page", ["1"])[0])
+        items = find("f", path[len("/f/search/") :])[
+            (page - 1) * REPLAY_PAGE_SIZE : page * REPLAY_PAGE_SIZE
+        ]
+        return 200, html_type, render_f_search(items).encode("utf-8")
+    if path.startswith("/f/hentai/"):
+        item = catalog.get(path[len("/f/hentai/") :])
+        if item and item["site"] == "f":
+            return 200, html_type, render_f_gallery(base, item).encode("utf-8")
+    if path == "/i/index.php":
+        route = query.get("route", [""])[0]
+        search = query.get("search", [""])[0]
+        if route == "extension/module/me_ajax_search/search":
+            products = [
+                {
+                    "name": item["title"],
+                    "href": f"{base}/i/{item['slug']}?search={item['slug']}",
+                    "image": f"{base}/i/image/{item['slug']}.jpg",
+                }
+                for item in find("i", search)
+            ]
+            return 200, json_type, json.dumps({"products": products}).encode("utf-8")
+        if route == "product/search":
+            items = [
+                item
+                for item in find("i", search)
+                if do_slugify(item["title"]) == do_slugify(search)
+            ]
+            return 200, html_type, render_i_search(base, items).encode("utf-8")
+    if m := F_THUMBNAIL_PATTERN.match(path) or I_THUMBNAIL_PATTERN.match(path):
+        if item := catalog.get(m.group(1)):
+            return (
+                200,
+                {"Content-Type": "image/jpeg", "Last-Modified": item["date"]},
+                thumbnail_bytes,
+            )
+    if m := re.match(r"/i/([^/]+)$", path):
+        item = catalog.get(m.group(1))
+        if item and item["site"] == "i":
+            return 200, html_type, render_i_gallery(base, item).encode("utf-8")
+    return 404, html_type, b"<html><body>not found</body></html>"
+
+
+def get_recording_path(target: str) -> Path:
+    return replay_dir / f"{hashlib.sha1(target.encode('utf-8')).hexdigest()[:20]}.json"
+
+
+def record(target: str) -> Union[Dict[str, Any], None]:
+    """fetches /_ext/<host>/<path> from the real host, with absolute urls in the body
+    pointed back at the replay server"""
+    parts = target[len("/_ext/") :].split("/", 1)
+    url = f"https://{parts[0]}/{parts[1] if len(parts) > 1 else ''}"
+    cookies = {}
+    if parts[0] in REPLAY_COOKIE_HOSTS and cookies_txt.exists():
+        cookies = dict(
+            cookie.split("=", 1)
+            for cookie in cookies_txt.read_text().strip().split("; ")
+        )
+    response = requests.get(
+        url,
+        cookies=cookies,
+        headers={"User-Agent": "Mozilla/5.0", "X-Requested-With": "XMLHttpRequest"},
+        timeout=30,
+    )
+    body = response.content
+    content_type = response.headers.get("content-type", "")
+    if content_type.startswith(("text/", "application/json")):
+        body = ABSOLUTE_URL_PATTERN.sub(
+            lambda m: f"{BASE_PLACEHOLDER}/_ext/{m.group(1)}", response.text
+        ).encode("utf-8")
+    recording = {
+        "target": target,
+        "status": response.status_code,
+        "headers": {
+            key: response.headers[key]
+            for key in ["content-type", "last-modified"]
+            if key in response.headers
+        },
+        "body": base64.b64encode(body).decode("ascii"),
+    }
+    replay_dir.mkdir(exist_ok=True)
+    write_json(get_recording_path(target), recording)
+    log.info(f"recorded {response.status_code} for {url}")
+    return recording
+
+
+def get_recorded(
+    base: str, target: str
+) -> Union[Tuple[int, Dict[str, str], bytes], None]:
+    recording_path = get_recording_path(target)
+    if recording_path.exists():
+        recording = read_json(recording_path)
+    elif REPLAY_RECORD:
+        recording = record(target)
+    else:
+        return None
+    body = base64.b64decode(recording["body"])
+    if BASE_PLACEHOLDER.encode("utf-8") in body:
+        body = body.replace(BASE_PLACEHOLDER.encode("utf-8"), base.encode("utf-8"))
+    return recording["status"], recording["headers"], body
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any):
+        log.debug(format % args)
+
+    def do_GET(self):
+        split = urlsplit(self.path)
+        path = unquote(split.path)
+        target = f"{path}?{split.query}" if split.query else path
+        base = f"http://{self.headers.get('Host', f'{REPLAY_HOST}:{REPLAY_PORT}')}"
+        with hits_lock:
+            hits[target] += 1
+            attempt = hits[target]
+
+        rng = random.Random(get_fraction("latency", target, attempt))
+        delay = REPLAY_LATENCY_MS
+        if REPLAY_JITTER_MS:
+            delay += rng.expovariate(1 / REPLAY_JITTER_MS)
+        sleep(delay / 1000)
+
+        fraction = get_fraction("error", target, attempt)
+        if fraction < REPLAY_RESET_RATE:
+            # drops the connection without an answer, like an overloaded proxy would
+            self.close_connection = True
+            return
+        if fraction < REPLAY_RESET_RATE + REPLAY_ERROR_RATE:
+            self.respond(
+                503, {"Content-Type": "text/plain", "Retry-After": "0"}, b"busy"
+            )
+            return
+
+        if REPLAY_DEFAULT_HOST and not path.startswith(("/_ext/", "/f/", "/i/")):
+            target = f"/_ext/{REPLAY_DEFAULT_HOST}{target}"
+        response = None
+        if target.startswith("/_ext/"):
+            response = get_recorded(base, target)
+        if response is None:
+            response = get_templated(base, path, parse_qs(split.query))
+        status, headers, body = response
+        if status == 200:
+            etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            headers = {**headers, "ETag": etag}
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+        self.respond(status, headers, body)
+
+    def respond(self, status: int, headers: Dict[str, str], body: bytes):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(
+    host: str = REPLAY_HOST, port: int = REPLAY_PORT
+) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve():
+    load_catalog()
+    server = make_server()
+    host, port = server.server_address[:2]
+    log.info(
+        f"replaying on http://{host}:{port}, F_BASE_URL=http://{host}:{port}/f I_BASE_URL=http://{host}:{port}/i"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
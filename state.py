@@ -0,0 +1,126 @@
+import mmap
+import os
+import struct
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+from json_store import read_json
+
+downloaded_json = Path.cwd() / "downloaded.json"
+favorited_json = Path.cwd() / "favorited.json"
+index_json = Path.cwd() / "index.json"
+original_sources_json = Path.cwd() / "original_sources.json"
+fallback_metadata_json = Path.cwd() / "fallback_metadata.json"
+index_snapshot_file = Path.cwd() / "index.snapshot"
+
+# magic, number of entries, mtime of the index.json it was built from
+SNAPSHOT_HEADER = struct.Struct("<4sIQ")
+SNAPSHOT_MAGIC = b"HSI1"
+
+
+@lru_cache(maxsize=None)
+def load_downloaded() -> Dict[str, str]:
+    return read_json(downloaded_json, intern=True)
+
+
+@lru_cache(maxsize=None)
+def load_favorited() -> Dict[str, str]:
+    return read_json(favorited_json, intern=True)
+
+
+@lru_cache(maxsize=None)
+def load_index() -> Dict[str, Dict[str, str]]:
+    return read_json(index_json, intern=True)
+
+
+@lru_cache(maxsize=None)
+def load_original_sources() -> Dict[str, str]:
+    return read_json(original_sources_json, intern=True)
+
+
+@lru_cache(maxsize=None)
+def load_fallback_metadata() -> Dict[str, Dict[str, Any]]:
+    return read_json(fallback_metadata_json, intern=True)
+
+
+def build_index_snapshot():
+    """writes every index entry as a "url\\tartist\\tentry" record, sorted by url,
+    behind a table of record offsets"""
+    records = sorted(
+        f"{url}\t{artist}\t{entry}".encode("utf-8")
+        for artist, entries in read_json(index_json).items()
+        for entry, url in entries.items()
+    )
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    tmp_file = index_snapshot_file.with_name(f"{index_snapshot_file.name}.tmp")
+    with tmp_file.open("wb") as f:
+        f.write(
+            SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, len(records), os.stat(index_json).st_mtime_ns
+            )
+        )
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.writelines(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, index_snapshot_file)
+
+
+class IndexSnapshot:
+    """memory-mapped index.snapshot, records are only decoded when asked for"""
+
+    def __init__(self, path: Path = index_snapshot_file):
+        with path.open("rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.source_mtime_ns = SNAPSHOT_HEADER.unpack_from(
+            self.buffer
+        )
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception(f"not an index snapshot: {path}")
+        offsets_end = SNAPSHOT_HEADER.size + 8 * (self.count + 1)
+        self.offsets = memoryview(self.buffer)[SNAPSHOT_HEADER.size : offsets_end].cast(
+            "Q"
+        )
+        self.records_start = offsets_end
+
+    def __len__(self) -> int:
+        return self.count
+
+    def raw_record(self, i: int) -> bytes:
+        start = self.records_start + self.offsets[i]
+        end = self.records_start + self.offsets[i + 1]
+        return self.buffer[start:end]
+
+    def record(self, i: int) -> Tuple[str, str, str]:
+        url, artist, entry = self.raw_record(i).decode("utf-8").split("\t")
+        return url, artist, entry
+
+    def find(self, url: str) -> Union[Tuple[str, str], None]:
+        """(artist, entry) of an url, by binary search"""
+        needle = url.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.raw_record(middle).split(b"\t", 1)[0] < needle:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            record_url, artist, entry = self.record(low)
+            if record_url == url:
+                return artist, entry
+        return None
+
+
+def load_index_snapshot() -> IndexSnapshot:
+    """(re)builds the snapshot when index.json changed since it was written"""
+    if index_snapshot_file.exists():
+        snapshot = IndexSnapshot()
+        if snapshot.source_mtime_ns == os.stat(index_json).st_mtime_ns:
+            return snapshot
+        del snapshot
+    build_index_snapshot()
+    return IndexSnapshot()
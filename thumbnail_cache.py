@@ -0,0 +1,177 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+from PIL import Image
+
+from archive_registry import hash_file, new_hasher
+from cbz_store import read_member, split_archive_path
+from json_store import read_json, write_json
+from log_setup import log
+from phash_index import get_stored_page, get_stored_pages, get_thumbnail_page_number
+from state import load_index
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 320))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", 1280))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+# previews of every page, not only of the thumbnail page
+PREVIEW_ALL_PAGES = os.getenv("PREVIEW_ALL_PAGES", "false").lower() == "true"
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_MB", 1024)) * 1024 * 1024
+WORKERS = int(os.getenv("THUMBNAIL_WORKERS", os.cpu_count() or 1))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()
+Image.init()
+if THUMBNAIL_FORMAT.upper() not in Image.SAVE:
+    log.warning(f"pillow can't write {THUMBNAIL_FORMAT}, using webp")
+    THUMBNAIL_FORMAT = "webp"
+
+data_dir = Path.cwd() / "data"
+thumbnails_dir = Path.cwd() / "thumbnails"
+thumbnails_json = thumbnails_dir / "thumbnails.json"
+
+# page path relative to data_dir -> {"mtime": page mtime_ns, "hash": page content hash}.
+# cached files are named after the content hash, so identical pages share them and
+# a page only gets re-hashed when its mtime changes. pages of entry archives are
+# paths below the archive and use its mtime. the library server fills this from
+# several threads, so it's only touched under thumbnails_lock
+thumbnails_data: Dict[str, Dict[str, Union[int, str]]] = read_json(thumbnails_json, {})
+thumbnails_dirty = False
+thumbnails_lock = threading.Lock()
+
+
+def get_cache_path(page_hash: str, size: int) -> Path:
+    return thumbnails_dir / page_hash[:2] / f"{page_hash}-{size}.{THUMBNAIL_FORMAT}"
+
+
+def get_page_hash(page: Path) -> str:
+    global thumbnails_dirty
+    page_path = page.relative_to(data_dir).as_posix()
+    archive_member = split_archive_path(page)
+    mtime = (archive_member[0] if archive_member else page).stat().st_mtime_ns
+    with thumbnails_lock:
+        cached = thumbnails_data.get(page_path)
+    if cached and cached["mtime"] == mtime:
+        return str(cached["hash"])
+    if archive_member:
+        hasher = new_hasher()
+        hasher.update(read_member(*archive_member))
+        page_hash = hasher.hexdigest()
+    else:
+        page_hash = hash_file(page)
+    with thumbnails_lock:
+        thumbnails_data[page_path] = {"mtime": mtime, "hash": page_hash}
+        thumbnails_dirty = True
+    return page_hash
+
+
+def make_preview(source: str, dest: str, size: int) -> int:
+    """downscales a page, letting the jpeg decoder skip most of the work via draft()"""
+    if archive_member := split_archive_path(Path(source)):
+        img = Image.open(BytesIO(read_member(*archive_member)))
+    else:
+        img = Image.open(source)
+    img.draft("RGB", (size, size))
+    img = img.convert("RGBA" if img.mode in ["RGBA", "LA", "P"] else "RGB")
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    dest_path = Path(dest)
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dest_path.with_name(f"{dest_path.name}.tmp")
+    img.save(tmp_path, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_path, dest_path)
+    return dest_path.stat().st_size
+
+
+def get_preview(page: Path, size: int = THUMBNAIL_SIZE) -> Path:
+    """cached preview of a page, generated in-process on a miss"""
+    cache_path = get_cache_path(get_page_hash(page), size)
+    if cache_path.exists():
+        os.utime(cache_path)
+    else:
+        make_preview(str(page), str(cache_path), size)
+    return cache_path
+
+
+def get_thumbnail(entry_path: Path) -> Union[Path, None]:
+    page = get_stored_page(entry_path, get_thumbnail_page_number(entry_path))
+    return get_preview(page) if page else None
+
+
+def evict(max_bytes: int = THUMBNAIL_CACHE_MAX_BYTES):
+    """drops the least recently used previews until the cache fits in max_bytes"""
+    files: List[Tuple[float, int, Path]] = []
+    for cached in thumbnails_dir.glob(f"*/*.{THUMBNAIL_FORMAT}"):
+        stat = cached.stat()
+        files.append((stat.st_mtime, stat.st_size, cached))
+    total = sum(size for _mtime, size, _cached in files)
+    if total <= max_bytes:
+        return
+    files.sort()
+    evicted = 0
+    for _mtime, size, cached in files:
+        if total <= max_bytes:
+            break
+        cached.unlink(missing_ok=True)
+        total -= size
+        evicted += 1
+    log.info(f"evicted {evicted} previews, cache is {total / 1024 / 1024:.1f} MiB")
+
+
+def page_exists(page: Path) -> bool:
+    if archive_member := split_archive_path(page):
+        return archive_member[0].exists()
+    return page.exists()
+
+
+def save_thumbnails(prune: bool = True):
+    """writes thumbnails.json, dropping pages that are gone unless prune is off"""
+    global thumbnails_dirty
+    with thumbnails_lock:
+        if not thumbnails_dirty:
+            return
+        if prune:
+            for page_path in list(thumbnails_data.keys()):
+                if not page_exists(data_dir / page_path):
+                    del thumbnails_data[page_path]
+        snapshot = dict(thumbnails_data)
+        thumbnails_dirty = False
+    thumbnails_dir.mkdir(exist_ok=True)
+    write_json(thumbnails_json, snapshot, sort_keys=True)
+
+
+def build_thumbnails():
+    log.info("========== building thumbnails ==========")
+    pending: Dict[Path, Tuple[Path, int]] = {}
+    for artist, entries in load_index().items():
+        for entry in entries.keys():
+            entry_path = data_dir / artist / entry
+            page = get_stored_page(entry_path, get_thumbnail_page_number(entry_path))
+            if page:
+                cache_path = get_cache_path(get_page_hash(page), THUMBNAIL_SIZE)
+                if not cache_path.exists():
+                    pending[cache_path] = (page, THUMBNAIL_SIZE)
+            if PREVIEW_ALL_PAGES:
+                for page in get_stored_pages(entry_path):
+                    cache_path = get_cache_path(get_page_hash(page), PREVIEW_SIZE)
+                    if not cache_path.exists():
+                        pending[cache_path] = (page, PREVIEW_SIZE)
+    save_thumbnails()
+
+    log.info(f"generating {len(pending)} previews")
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        written = sum(
+            executor.map(
+                make_preview,
+                (str(page) for page, _size in pending.values()),
+                (str(cache_path) for cache_path in pending.keys()),
+                (size for _page, size in pending.values()),
+                chunksize=8,
+            )
+        )
+    log.info(f"wrote {written / 1024 / 1024:.1f} MiB of previews")
+    evict()
+
+
+if __name__ == "__main__":
+    build_thumbnails()
@@ -0,0 +1,201 @@
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+from PIL import Image
+
+from archive_registry import save_registry, update_page_hash
+from json_store import JsonStore
+from log_setup import count, log
+from phash_index import get_entry_pages
+from state import load_index
+
+# "png": optimized png, "webp": lossless webp, "none": leave pngs alone
+TRANSCODE_PNG = os.getenv("TRANSCODE_PNG", "png")
+# "jpegtran": optimized progressive jpeg, "none": leave jpegs alone. jpeg xl isn't
+# offered, pillow and every script reading pages only know IMAGE_SUFFIXES
+TRANSCODE_JPEG = os.getenv("TRANSCODE_JPEG", "jpegtran")
+WORKERS = int(os.getenv("TRANSCODE_WORKERS", os.cpu_count() or 1))
+OXIPNG = shutil.which("oxipng")
+JPEGTRAN = shutil.which("jpegtran")
+ORIENTATION_TAG = 0x0112
+
+data_dir = Path.cwd() / "data"
+transcode_progress_json = Path.cwd() / "transcode_progress.json"
+
+# "artist/entry" -> {"pages": number of pages, "bytes": size after transcoding,
+# "saved": bytes saved, "failed": pages that could not be transcoded}, entries whose
+# pages still add up to that and had no failures are skipped
+progress_store = JsonStore(transcode_progress_json, {}, sort_keys=True, flush_every=1)
+
+
+def run(*args: str):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def get_color_info(img: Image.Image) -> Dict[str, Any]:
+    """what decides how a page is shown besides its pixels, kept by the re-saves"""
+    info = {}
+    if icc_profile := img.info.get("icc_profile"):
+        info["icc_profile"] = icc_profile
+    if exif := img.info.get("exif"):
+        info["exif"] = exif
+    return info
+
+
+def decodes_identically(original: Path, transcoded: Path) -> bool:
+    """same pixels, color profile and orientation"""
+    with Image.open(original) as a, Image.open(transcoded) as b:
+        if a.size != b.size:
+            return False
+        if a.info.get("icc_profile") != b.info.get("icc_profile"):
+            return False
+        if a.getexif().get(ORIENTATION_TAG) != b.getexif().get(ORIENTATION_TAG):
+            return False
+        mode = "RGBA" if "A" in a.getbands() or a.mode == "P" else "RGB"
+        return a.convert(mode).tobytes() == b.convert(mode).tobytes()
+
+
+def transcode_page(source: str) -> Tuple[str, int, int]:
+    """(new page path, size before, size after), pages that don't get smaller or
+    don't decode to the same pixels are left as they were"""
+    page = Path(source)
+    before = page.stat().st_size
+    suffix = page.suffix.lower()
+    dest = page
+    if suffix == ".png" and TRANSCODE_PNG == "webp":
+        dest = page.with_suffix(".webp")
+    tmp_path = dest.with_name(f"{dest.name}.tmp{dest.suffix}")
+
+    try:
+        if suffix == ".png" and TRANSCODE_PNG == "png":
+            if OXIPNG:
+                run(
+                    OXIPNG, "-o", "2", "--strip", "safe", "--out", str(tmp_path), source
+                )
+            else:
+                with Image.open(page) as img:
+                    img.save(
+                        tmp_path, format="PNG", optimize=True, **get_color_info(img)
+                    )
+            verified = decodes_identically(page, tmp_path)
+        elif suffix == ".png" and TRANSCODE_PNG == "webp":
+            with Image.open(page) as img:
+                img.save(
+                    tmp_path,
+                    format="WEBP",
+                    lossless=True,
+                    quality=100,
+                    method=6,
+                    **get_color_info(img),
+                )
+            verified = decodes_identically(page, tmp_path)
+        elif suffix in [".jpg", ".jpeg"] and TRANSCODE_JPEG == "jpegtran" and JPEGTRAN:
+            with Image.open(page) as img:
+                oriented = img.getexif().get(ORIENTATION_TAG, 1) != 1
+            run(
+                JPEGTRAN,
+                "-copy",
+                # the orientation lives in the exif, which "icc" would drop
+                "all" if oriented else "icc",
+                "-optimize",
+                "-progressive",
+                "-outfile",
+                str(tmp_path),
+                source,
+            )
+            verified = decodes_identically(page, tmp_path)
+        else:
+            return source, before, before
+    except (subprocess.CalledProcessError, OSError) as err:
+        tmp_path.unlink(missing_ok=True)
+        raise Exception(f"could not transcode {page}: {err}")
+
+    after = tmp_path.stat().st_size
+    if not verified or after >= before:
+        tmp_path.unlink()
+        return source, before, before
+    stat = page.stat()
+    os.replace(tmp_path, dest)
+    # keeps the page's dates, fetch_metadata uses them as the archive date
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    if dest != page:
+        page.unlink()
+    return str(dest), before, after
+
+
+def transcode_all():
+    log.info("========== transcoding pages ==========")
+    if TRANSCODE_PNG == "png" and not OXIPNG:
+        log.info("oxipng not found, optimizing pngs with pillow")
+    if TRANSCODE_JPEG == "jpegtran" and not JPEGTRAN:
+        log.warning("jpegtran not found, leaving jpegs alone")
+    if TRANSCODE_JPEG not in ["jpegtran", "none"]:
+        raise Exception(
+            f"TRANSCODE_JPEG={TRANSCODE_JPEG} isn't supported, the other scripts "
+            "only read .jpg, .jpeg, .png and .webp pages"
+        )
+
+    progress_data = progress_store.data
+    total_before = 0
+    total_after = 0
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        for artist, entries in load_index().items():
+            for entry in entries.keys():
+                entry_path = data_dir / artist / entry
+                if not entry_path.is_dir():
+                    continue
+                pages = get_entry_pages(entry_path)
+                progress = progress_data.get(f"{artist}/{entry}")
+                if (
+                    progress
+                    and not progress.get("failed")
+                    and progress["pages"] == len(pages)
+                    and progress["bytes"] == sum(page.stat().st_size for page in pages)
+                ):
+                    continue
+
+                before = 0
+                after = 0
+                failed = 0
+                futures = [executor.submit(transcode_page, str(page)) for page in pages]
+                for source, future in zip(pages, futures):
+                    try:
+                        dest, page_before, page_after = future.result()
+                    except Exception as err:
+                        # the page stays as it was, the entry is tried again next run
+                        log.error(f"skipping {source}: {err}")
+                        count("transcode_all_failed_pages")
+                        failed += 1
+                        dest = str(source)
+                        page_before = page_after = source.stat().st_size
+                    before += page_before
+                    after += page_after
+                    if page_after != page_before:
+                        update_page_hash(source, Path(dest))
+                save_registry()
+                total_before += before
+                total_after += after
+                progress_data[f"{artist}/{entry}"] = {
+                    "pages": len(pages),
+                    "bytes": after,
+                    "saved": (progress["saved"] if progress else 0) + before - after,
+                    "failed": failed,
+                }
+                progress_store.changed()
+                log.info(
+                    f"{artist}/{entry}: saved {(before - after) / 1024 / 1024:.1f} MiB"
+                )
+
+    progress_store.flush()
+    log.info(
+        f"saved {(total_before - total_after) / 1024 / 1024:.1f} MiB this run, "
+        f"{sum(p['saved'] for p in progress_data.values()) / 1024 / 1024:.1f} MiB in total"
+    )
+
+
+if __name__ == "__main__":
+    transcode_all()
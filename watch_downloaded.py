@@ -0,0 +1,293 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+from typing import Any, Dict, List, Tuple, Union
+
+from archive_registry import get_skipped, reload_registry, save_registry
+from json_store import read_json, write_json
+from log_setup import count, log, timed
+from process_downloaded import (
+    data_dir,
+    downloaded_dir,
+    downloaded_json,
+    get_artist,
+    get_entry_name,
+    index_data,
+    index_store,
+    process_download,
+)
+
+# inotify, poll, or auto for inotify where the kernel has it
+WATCH_MODE = os.getenv("WATCH_MODE", "auto")
+# seconds without new events before a burst of archives is processed
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2))
+# seconds between scans of downloaded/ when polling
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 5))
+# seconds an archive may wait for download_all_favorites to write its url
+WATCH_UNKNOWN_TIMEOUT = float(os.getenv("WATCH_UNKNOWN_TIMEOUT", 300))
+WATCH_STATUS = Path(os.getenv("WATCH_STATUS", Path.cwd() / "watch_status.json"))
+WATCH_HISTORY = 20
+
+# chrome writes into a .crdownload and renames it once finished, so a finalized
+# archive shows up as moved to, or as closed after writing when copied in by hand
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+EVENT_HEADER = struct.Struct("iIII")
+
+favorited_json = Path.cwd() / "favorited.json"
+stopping = False
+status: Dict[str, Any] = {
+    "pid": os.getpid(),
+    "mode": None,
+    "started": datetime.now().isoformat(timespec="seconds"),
+    "updated": None,
+    "pending": [],
+    "processed": 0,
+    "skipped": 0,
+    "failed": 0,
+    "recent": [],
+}
+
+
+class Inotify:
+    """the few inotify calls needed, through libc since the stdlib doesn't wrap them"""
+
+    def __init__(self, path: Path, mask: int):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def read(self) -> List[Tuple[int, str]]:
+        """masks and names of the events queued so far"""
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_inotify() -> Union[Inotify, None]:
+    if WATCH_MODE == "poll":
+        return None
+    try:
+        return Inotify(downloaded_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+    except (OSError, AttributeError) as e:
+        if WATCH_MODE == "inotify":
+            raise
+        log.warning(f"inotify not available ({e}), polling {downloaded_dir} instead")
+        return None
+
+
+def scan_archives() -> Dict[str, Tuple[int, int]]:
+    return {
+        archive.name: (archive.stat().st_size, archive.stat().st_mtime_ns)
+        for archive in downloaded_dir.glob("*.cbz")
+    }
+
+
+def is_processed(url: str) -> bool:
+    """whether the url is indexed and its entry is already in data/, or was skipped
+    as an exact duplicate of another entry"""
+    if get_skipped(url):
+        return True
+    for artist, entries in index_data.items():
+        for entry, entry_url in entries.items():
+            if entry_url == url:
+                entry_path = data_dir / artist / entry
+                return (
+                    entry_path.exists() or entry_path.with_name(f"{entry}.cbz").exists()
+                )
+    return False
+
+
+def get_backlog() -> List[str]:
+    """archives an earlier run or process_downloaded.py didn't get to"""
+    downloaded_data: Dict[str, str] = read_json(downloaded_json, default={})
+    return [
+        f"{download_name}.cbz"
+        for url, download_name in downloaded_data.items()
+        if (downloaded_dir / f"{download_name}.cbz").exists() and not is_processed(url)
+    ]
+
+
+def set_result(name: str, result: str, entry: str = ""):
+    status[result] += 1
+    status["recent"] = [
+        {
+            "archive": name,
+            "result": result,
+            "entry": entry,
+            "at": datetime.now().isoformat(timespec="seconds"),
+        },
+        *status["recent"],
+    ][:WATCH_HISTORY]
+
+
+def write_status(pending: Dict[str, float]):
+    status["pending"] = sorted(pending)
+    status["updated"] = datetime.now().isoformat(timespec="seconds")
+    write_json(WATCH_STATUS, status)
+
+
+def ingest(name: str, first_seen: float) -> bool:
+    """one archive of downloaded/ into the library, False while its url isn't
+    known yet and it should be tried again"""
+    download_name = name[: -len(".cbz")]
+    downloaded_data: Dict[str, str] = read_json(downloaded_json, default={})
+    url = next(
+        (url for url, value in downloaded_data.items() if value == download_name),
+        None,
+    )
+    if not url:
+        if monotonic() - first_seen < WATCH_UNKNOWN_TIMEOUT:
+            return False
+        log.warning(f"{name} is not in {downloaded_json.name}, leaving it")
+        set_result(name, "skipped")
+        return True
+    if is_processed(url):
+        log.info(f"{name} is already in the library")
+        set_result(name, "skipped")
+        return True
+    artist = get_artist(url, read_json(favorited_json, default={}).get(url, ""))
+    if not artist:
+        log.warning(f"no artist known for {name}, leaving it in downloaded/")
+        set_result(name, "skipped")
+        return True
+    try:
+        with timed("watch_downloaded_archive"):
+            entry_path = process_download(url, download_name, artist)
+    except Exception:
+        log.exception(f"could not process {name}")
+        count("watch_downloaded_failed")
+        set_result(name, "failed")
+        return True
+    count("watch_downloaded_archives")
+    if entry_path:
+        log.info(f"added {artist}/{get_entry_name(entry_path)}")
+        set_result(name, "processed", f"{artist}/{get_entry_name(entry_path)}")
+    else:
+        set_result(name, "skipped")
+    return True
+
+
+def process_pending(pending: Dict[str, float], first_seen: Dict[str, float]):
+    """every archive whose burst of events is over, then the index once for them"""
+    now = monotonic()
+    ready = [name for name, seen in pending.items() if now - seen >= WATCH_DEBOUNCE]
+    if ready:
+        # process_downloaded.py or fetch_metadata.py may have written these since
+        index_store.reload()
+        reload_registry()
+    for name in ready:
+        if not (downloaded_dir / name).exists():
+            log.info(f"{name} is gone, dropping it")
+        elif not ingest(name, first_seen[name]):
+            # downloaded.json is flushed a bit after the archive lands
+            pending[name] = now
+            continue
+        del pending[name]
+        del first_seen[name]
+    if ready:
+        index_store.flush()
+        save_registry()
+
+
+def add_pending(pending: Dict[str, float], first_seen: Dict[str, float], name: str):
+    pending[name] = monotonic()
+    first_seen.setdefault(name, pending[name])
+
+
+def stop(_signum, _frame):
+    global stopping
+    stopping = True
+
+
+def get_snapshot(pending: Dict[str, float]) -> Tuple[Any, ...]:
+    return (sorted(pending), status["processed"], status["skipped"], status["failed"])
+
+
+def watch():
+    log.info(f"========== watching {downloaded_dir} ==========")
+    # signals write to a pipe so they also end a select waiting without a timeout
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    inotify = open_inotify()
+    status["mode"] = "inotify" if inotify else "poll"
+    pending: Dict[str, float] = {}
+    first_seen: Dict[str, float] = {}
+    for name in get_backlog():
+        add_pending(pending, first_seen, name)
+    known = scan_archives() if not inotify else {}
+    write_status(pending)
+    written = get_snapshot(pending)
+    try:
+        while not stopping:
+            if inotify:
+                # with nothing pending this sleeps until the kernel has events
+                timeout = WATCH_DEBOUNCE if pending else None
+                readable, _, _ = select.select(
+                    [inotify.fd, wakeup_read], [], [], timeout
+                )
+                for mask, name in inotify.read() if inotify.fd in readable else []:
+                    if mask & IN_Q_OVERFLOW:
+                        log.warning("inotify queue overflowed, rescanning")
+                        for backlog_name in get_backlog():
+                            add_pending(pending, first_seen, backlog_name)
+                    elif name.endswith(".cbz"):
+                        add_pending(pending, first_seen, name)
+            else:
+                timeout = min(WATCH_DEBOUNCE, WATCH_POLL_INTERVAL)
+                select.select(
+                    [wakeup_read], [], [], timeout if pending else WATCH_POLL_INTERVAL
+                )
+                scanned = scan_archives()
+                # a changed size or mtime restarts the debounce of a growing file
+                for name, stat in scanned.items():
+                    if known.get(name) != stat:
+                        add_pending(pending, first_seen, name)
+                known = scanned
+            if pending and not stopping:
+                process_pending(pending, first_seen)
+            if get_snapshot(pending) != written:
+                write_status(pending)
+                written = get_snapshot(pending)
+    finally:
+        signal.set_wakeup_fd(-1)
+        os.close(wakeup_read)
+        os.close(wakeup_write)
+        if inotify:
+            inotify.close()
+        index_store.flush()
+        save_registry()
+        status["mode"] = "stopped"
+        write_status(pending)
+
+
+if __name__ == "__main__":
+    watch()